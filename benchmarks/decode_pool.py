@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Compares the decode throughput of DecodePool with different numbers of
+worker processes. Worker count 0 decodes inline, as TMClient does without
+decode_processes.
+
+Example:
+
+    python3 benchmarks/decode_pool.py --workers 0 1 2 4 8
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType
+from telemetric.pipeline import DecodePool
+from payloads import PROTOS, make_compact, make_kv
+
+def bench_inline(decoder, messages):
+    start = time.time()
+    for msg_type, payload in messages:
+        if msg_type == TCPMsgType.GPB_COMPACT:
+            decoder.compact_to_dict(payload)
+        else:
+            decoder.kv_to_dict(payload)
+    return len(messages) / (time.time() - start)
+
+def bench_pool(workers, messages, sessions):
+    done = threading.Event()
+    counter = [0]
+    def callback(key, msg_type, record):
+        counter[0] += 1
+        if counter[0] == target[0]:
+            done.set()
+    pool = DecodePool(callback, PROTOS, processes=workers)
+
+    # Wait for all workers to start up.
+    target = [workers * 2]
+    for msg_type, payload in messages[:target[0]]:
+        pool.submit('warmup', msg_type, payload)
+    done.wait()
+    done.clear()
+
+    counter[0] = 0
+    target[0] = len(messages)
+    start = time.time()
+    for i, (msg_type, payload) in enumerate(messages):
+        pool.submit(i % sessions, msg_type, payload)
+    done.wait()
+    elapsed = time.time() - start
+    pool.close()
+    return len(messages) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--workers", type=int, nargs='*',
+                        default=[0, 1, 2, 4, 8])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=100,
+                        help="Rows per compact message and entries per KV message")
+    parser.add_argument("--sessions", type=int, default=16,
+                        help="Number of simulated connections")
+    args = parser.parse_args()
+
+    decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+    compact = make_compact(decoder, args.rows)
+    kv = make_kv(decoder, args.rows)
+
+    print("{:>8} {:>16} {:>16}".format("workers", "compact msg/s", "kv msg/s"))
+    for workers in args.workers:
+        rates = []
+        for msg_type, payload in ((TCPMsgType.GPB_COMPACT, compact),
+                                  (TCPMsgType.GPB_KEY_VALUE, kv)):
+            messages = [(msg_type, payload)] * args.messages
+            if workers == 0:
+                rates.append(bench_inline(decoder, messages))
+            else:
+                rates.append(bench_pool(workers, messages, args.sessions))
+        print("{:>8} {:>16.0f} {:>16.0f}".format(workers, *rates))
+
+if __name__ == '__main__':
+    main()
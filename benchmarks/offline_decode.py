@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Measures the throughput of decode_capture() with an increasing number of
+worker processes.
+
+Example:
+
+    python3 benchmarks/offline_decode.py --frames 20000 --processes 1 2 4 8
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType, TCP_FLAG_ZLIB_COMPRESSION
+from telemetric.capture import CaptureWriter
+from telemetric.offline import decode_capture
+from payloads import PROTOS, make_compact, make_kv
+
+def write_capture(filename, decoder, frames, sessions, rows, reset_every):
+    """
+    Write compressed key-value frames and compact frames from the given
+    number of sessions, resetting the compressor every reset_every frames.
+    """
+    messages = [make_kv(decoder, rows), make_compact(decoder, rows)]
+    compressors = [None] * sessions
+    writer = CaptureWriter(filename)
+    for i in range(frames):
+        session = i % sessions
+        peer = '10.0.0.{}:57400'.format(session)
+        if i // sessions % reset_every == 0:
+            writer.write_tcp(peer, 2, TCPMsgType.RESET_COMPRESSOR, 0, b'')
+            compressors[session] = zlib.compressobj()
+        if i % 2:
+            writer.write_tcp(peer, 2, TCPMsgType.GPB_COMPACT, 0, messages[1])
+        else:
+            compressor = compressors[session]
+            payload = compressor.compress(messages[0]) \
+                    + compressor.flush(zlib.Z_SYNC_FLUSH)
+            writer.write_tcp(peer, 2, TCPMsgType.GPB_KEY_VALUE,
+                             TCP_FLAG_ZLIB_COMPRESSION, payload)
+    writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--frames", type=int, default=5000)
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=20,
+                        help="Rows per compact message and entries per KV message")
+    parser.add_argument("--reset-every", type=int, default=50,
+                        help="Frames per session between compressor resets")
+    parser.add_argument("--chunk-size", type=int, default=1,
+                        help="The approximate chunk size in MB")
+    parser.add_argument("--format", default='ndjson')
+    parser.add_argument("--processes", type=int, nargs='*',
+                        default=[1, multiprocessing.cpu_count()])
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'bench.cap')
+        decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        write_capture(filename, decoder, args.frames, args.sessions,
+                      args.rows, args.reset_every)
+        size = os.path.getsize(filename)
+
+        print("{:>10} {:>12} {:>10} {:>9}".format("processes", "frames/s",
+                                                  "MB/s", "chunks"))
+        for processes in args.processes:
+            output_dir = os.path.join(tmp_dir, 'output{}'.format(processes))
+            start = time.time()
+            results = decode_capture(filename, output_dir, protos=PROTOS,
+                                     processes=processes,
+                                     chunk_size=args.chunk_size*1024*1024,
+                                     output_format=args.format)
+            elapsed = time.time() - start
+            frames = sum(r['frames'] for r in results)
+            print("{:>10} {:>12.1f} {:>10.2f} {:>9}".format(
+                  processes, frames / elapsed, size / elapsed / 1e6,
+                  len(results)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Payloads shared by the benchmarks.
+"""
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+dirname = os.path.dirname(__file__)
+SCHEMA_PATH = "RootOper.InfraStatistics.Interface.Latest.GenericCounters"
+PROTOS = [os.path.join(dirname, '..', 'tests', 'data',
+                       'ifstatsbag_generic.proto')]
+
+def make_compact(decoder, rows, identifier='router1'):
+    """
+    Returns a serialized compact message with the given number of
+    interface counter rows.
+    """
+    telemetry_pb2 = decoder.modules['telemetry_pb2']
+    row_class = decoder.decoders[SCHEMA_PATH]
+    header = telemetry_pb2.TelemetryHeader(encoding=0x87654321,
+                                           policy_name='ifstats',
+                                           identifier=identifier,
+                                           start_time=1500000000000,
+                                           end_time=1500000000100)
+    table = header.tables.add(policy_path=SCHEMA_PATH)
+    for i in range(rows):
+        row = row_class(interface_name='GigabitEthernet0/0/0/{}'.format(i),
+                        packets_received=i * 1000,
+                        bytes_received=i * 1500000,
+                        packets_sent=i * 900,
+                        bytes_sent=i * 1400000,
+                        input_drops=i,
+                        output_drops=i,
+                        last_data_time=1500000000,
+                        carrier_transitions=2,
+                        availability_flag=True,
+                        state=1)
+        table.row.append(row.SerializeToString())
+    return header.SerializeToString()
+
+def make_kv(decoder, entries, base_path='Cisco-IOS-XR-infra-statsd-oper:'
+                                        'infra-statistics/interfaces/'
+                                        'interface/latest/generic-counters'):
+    """
+    Returns a serialized key-value message with the given number of
+    interface entries.
+    """
+    telemetry_kv_pb2 = decoder.modules['telemetry_kv_pb2']
+    header = telemetry_kv_pb2.Telemetry(collection_id=1,
+                                        base_path=base_path,
+                                        subscription_identifier='sub1',
+                                        msg_timestamp=1500000000000)
+    counters = ['packets-received', 'bytes-received', 'packets-sent',
+                'bytes-sent', 'input-drops', 'output-drops',
+                'carrier-transitions']
+    for i in range(entries):
+        entry = header.fields.add(timestamp=1500000000000 + i)
+        keys = entry.fields.add(name='keys')
+        keys.fields.add(name='interface-name',
+                        string_value='GigabitEthernet0/0/0/{}'.format(i))
+        content = entry.fields.add(name='content')
+        for n, name in enumerate(counters):
+            content.fields.add(name=name, uint64_value=i * 1000 + n)
+    return header.SerializeToString()
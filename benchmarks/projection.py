@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Compares projected decoding of a few leaves against full decoding with
+ParseFromString() and proto_to_dict().
+
+Example:
+
+    python3 benchmarks/projection.py --rows 500
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from payloads import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+def rate(func, message, repeat):
+    start = time.time()
+    for i in range(repeat):
+        for item in func(message):
+            pass
+    return repeat / (time.time() - start)
+
+def kv_base_path(decoder, message):
+    return decoder.kv_to_dict(message)['base_path']
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--rows", type=int, default=200,
+                        help="Rows per compact message and entries per KV message")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+    compact = make_compact(decoder, args.rows)
+    kv = make_kv(decoder, args.rows)
+    decoder.set_compact_projection(SCHEMA_PATH, ['interface_name',
+                                                 'bytes_received',
+                                                 'bytes_sent'])
+    decoder.set_kv_projection(kv_base_path(decoder, kv),
+                              ['keys/interface-name',
+                               'content/bytes-received',
+                               'content/bytes-sent'])
+
+    def full_compact(message):
+        return decoder.compact_to_dict(message)['tables'][0]['row']
+
+    def full_kv(message):
+        return decoder.kv_to_dict(message)['fields']
+
+    print("{:>8} {:>14} {:>14} {:>9}".format("format", "full msg/s",
+                                             "projected/s", "speedup"))
+    for name, message, full, projected in (
+            ("compact", compact, full_compact, decoder.project_compact),
+            ("kv", kv, full_kv, decoder.project_kv)):
+        full_rate = rate(full, message, args.repeat)
+        projected_rate = rate(projected, message, args.repeat)
+        print("{:>8} {:>14.1f} {:>14.1f} {:>8.1f}x".format(
+              name, full_rate, projected_rate, projected_rate / full_rate))
+
+if __name__ == '__main__':
+    main()
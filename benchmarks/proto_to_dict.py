@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Compares the compiled proto_to_dict() converters against the generic
+conversion that looks up every field's conversion function per message.
+
+Example:
+
+    python3 benchmarks/proto_to_dict.py --rows 500
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+from google.protobuf.descriptor import FieldDescriptor
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.protoutil import field_type_to_fn, is_repeated, proto_to_dict
+from payloads import PROTOS, make_compact, make_kv
+
+def generic_proto_to_dict(msg):
+    result_dict = {}
+    for field, value in msg.ListFields():
+        if field.type == FieldDescriptor.TYPE_MESSAGE:
+            conversion_fn = generic_proto_to_dict
+        else:
+            conversion_fn = field_type_to_fn(msg, field)
+        if not field.is_extension:
+            if is_repeated(field):
+                result_dict[field.name] = [conversion_fn(v) for v in value]
+            else:
+                result_dict[field.name] = conversion_fn(value)
+    return result_dict
+
+def rate(func, messages, repeat):
+    start = time.time()
+    for i in range(repeat):
+        for message in messages:
+            func(message)
+    return repeat * len(messages) / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--rows", type=int, default=200,
+                        help="Rows per compact message and entries per KV message")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+    compact = decoder.decode_compact_lazy(make_compact(decoder, args.rows))
+    rows = list(compact.tables[0])
+    kv = [decoder.parse_kv(make_kv(decoder, args.rows))]
+
+    print("{:>8} {:>14} {:>14} {:>9}".format("format", "generic msg/s",
+                                             "compiled/s", "speedup"))
+    for name, messages in (("compact", rows), ("kv", kv)):
+        generic_rate = rate(generic_proto_to_dict, messages, args.repeat)
+        compiled_rate = rate(proto_to_dict, messages, args.repeat)
+        print("{:>8} {:>14.1f} {:>14.1f} {:>8.1f}x".format(
+              name, generic_rate, compiled_rate, compiled_rate / generic_rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Measures the GPBDecoder startup time with many schemas, with an empty
+compilation cache (cold) and a populated one (warm), and with lazy
+schema loading.
+
+Example:
+
+    python3 benchmarks/startup.py --protos 400
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+PROTO = '''syntax = "proto2";
+package bench{index};
+
+import "cisco.proto";
+
+message counters{index} {{
+    option (cisco_msg).schema_path = "RootOper.Bench.Counters{index}";
+    optional string interface_name = 1;
+    optional uint64 packets_received = 2;
+    optional uint64 bytes_received = 3;
+    optional uint64 packets_sent = 4;
+    optional uint64 bytes_sent = 5;
+    optional state{index} state = 6;
+    repeated queue{index} queues = 7;
+}}
+
+enum state{index} {{
+    DOWN = 0;
+    UP = 1;
+}}
+
+message queue{index} {{
+    optional uint32 queue_id = 1;
+    optional uint64 packets = 2;
+}}
+'''
+
+def start(proto_dir, output_dir, count, lazy=False):
+    """
+    Returns the time it takes to create a decoder. Every decoder is
+    created in a fresh interpreter, as the protobuf descriptor pool does
+    not allow loading the same modules twice.
+    """
+    code = ("import sys, glob, time;"
+            "sys.path.insert(0, {!r});"
+            "from telemetric.gpb import GPBDecoder;"
+            "begin = time.time();"
+            "d = GPBDecoder(sorted(glob.glob({!r})), {!r}, [],"
+            "               lazy_schemas={!r});"
+            "print(time.time() - begin);"
+            "assert len(d.schemas.index) == {}").format(
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                os.path.join(proto_dir, '*.proto'), output_dir, lazy, count)
+    return float(subprocess.check_output([sys.executable, '-c', code]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--protos", type=int, default=100,
+                        help="The number of schemas to load")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        proto_dir = os.path.join(tmp_dir, 'protos')
+        output_dir = os.path.join(tmp_dir, 'compiled')
+        os.mkdir(proto_dir)
+        for index in range(args.protos):
+            filename = os.path.join(proto_dir, 'bench{}.proto'.format(index))
+            with open(filename, 'w') as f:
+                f.write(PROTO.format(index=index))
+
+        lazy_output_dir = os.path.join(tmp_dir, 'lazy')
+        lazy_cold = start(proto_dir, lazy_output_dir, args.protos, lazy=True)
+        lazy_warm = start(proto_dir, lazy_output_dir, args.protos, lazy=True)
+        cold = start(proto_dir, output_dir, args.protos)
+        warm = start(proto_dir, output_dir, args.protos)
+        print("{} protos: cold start {:.2f}s, warm start {:.2f}s".format(
+              args.protos, cold, warm))
+        print("{} protos, lazy: cold start {:.2f}s, warm start {:.2f}s".format(
+              args.protos, lazy_cold, lazy_warm))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Runs the decode path microbenchmarks on seeded synthetic payloads and
+writes the results as JSON, optionally comparing them to a baseline.
+
+Example:
+
+    python3 benchmarks/suite.py --output baseline.json
+    python3 benchmarks/suite.py --baseline baseline.json --threshold 0.1
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import json
+import platform
+import argparse
+import tracemalloc
+import google.protobuf
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType, JSONv1Handler, JSONv2Handler
+from telemetric.framing import parse_header
+from telemetric.protoutil import proto_to_dict
+from telemetric.synthetic import PayloadGenerator
+from telemetric.jsonscan import scan_json_keys
+from payloads import PROTOS
+
+def split_frame(frame):
+    """
+    Returns (version, msg_type, flags, payload) like FrameReader.
+    """
+    version, msg_type, flags, start, end = parse_header(frame, 0, len(frame))
+    return version, msg_type, flags, frame[start:end]
+
+def v1_case(generator, setup, count):
+    frames = [split_frame(f)[3] for f in generator.v1_stream(count)]
+    def run(handler, payload):
+        handler[0].handle_payload(payload, json_dump=True)
+    return setup, run, frames
+
+def v2_case(generator, setup, msg_type, payloads, compress):
+    frames = [split_frame(f)
+              for f in generator.v2_stream(msg_type, payloads, compress)]
+    def run(handler, frame):
+        version, msg_type, flags, payload = frame
+        handler[1].handle_payload(msg_type, flags, payload, json_dump=True)
+    return setup, run, frames
+
+def build_cases(decoder, seed, count):
+    """
+    Returns a dict mapping case names to (setup, run, messages). setup()
+    returns the state passed to run(state, message) with each message in
+    turn; the messages of a case are always processed in order.
+    """
+    generator = PayloadGenerator(decoder, seed)
+    json_msgs = [generator.json(entries=20) for i in range(count)]
+    # Large messages with the routing key after the data, which has to be
+    # skipped to find it.
+    json_tail_msgs = [generator.json(entries=500)[:-1]
+                      + b', "encoding_path": "synthetic"}'
+                      for i in range(max(1, count // 10))]
+    compact_msgs = [generator.compact(tables=4, rows=25) for i in range(count)]
+    kv_msgs = [generator.kv(entries=10, depth=4, fanout=3)
+               for i in range(count)]
+    rows = [row for message in compact_msgs[:max(1, count // 25)]
+            for table in decoder.decode_compact_lazy(message).tables
+            for row in table]
+    kv_headers = [decoder.parse_kv(m) for m in kv_msgs]
+    devnull = open(os.devnull, 'w')
+
+    # Decoded messages are printed, so send them to /dev/null. measure()
+    # restores stdout.
+    def decoder_setup():
+        sys.stdout = devnull
+        return decoder
+
+    def handler_setup():
+        sys.stdout = devnull
+        return JSONv1Handler(decoder), JSONv2Handler(decoder)
+
+    def forward_setup():
+        forward = bytearray().extend
+        return (JSONv1Handler(decoder, forward_json=forward),
+                JSONv2Handler(decoder, forward_json=forward))
+
+    def scan_keys(state, message):
+        scan_json_keys(message, ('Identifier', 'Policy'))
+
+    def scan_tail_key(state, message):
+        scan_json_keys(message, ('encoding_path',))
+
+    def parse_json(state, message):
+        json.loads(message.decode('utf-8'))
+
+    def decode_compact(decoder, message):
+        decoder.decode_compact(message, json_dump=True)
+
+    def decode_kv(decoder, message):
+        decoder.decode_kv(message, json_dump=True)
+
+    def convert(state, message):
+        proto_to_dict(message)
+
+    cases = {
+        'jsonv1_handler': v1_case(generator, handler_setup, count),
+        'jsonv2_handler_json': v2_case(generator, handler_setup,
+                                       TCPMsgType.JSON, json_msgs, False),
+        'jsonv2_handler_json_zlib': v2_case(generator, handler_setup,
+                                            TCPMsgType.JSON, json_msgs, True),
+        'jsonv2_forward_json': v2_case(generator, forward_setup,
+                                       TCPMsgType.JSON, json_msgs, False),
+        'jsonv2_forward_json_zlib': v2_case(generator, forward_setup,
+                                            TCPMsgType.JSON, json_msgs, True),
+        'scan_json_keys': (lambda: None, scan_keys, json_msgs),
+        'scan_json_keys_after_data': (lambda: None, scan_tail_key,
+                                      json_tail_msgs),
+        'json_loads_after_data': (lambda: None, parse_json, json_tail_msgs),
+        'jsonv2_handler_compact': v2_case(generator, handler_setup,
+                                          TCPMsgType.GPB_COMPACT,
+                                          compact_msgs, False),
+        'jsonv2_handler_compact_zlib': v2_case(generator, handler_setup,
+                                               TCPMsgType.GPB_COMPACT,
+                                               compact_msgs, True),
+        'jsonv2_handler_kv': v2_case(generator, handler_setup,
+                                     TCPMsgType.GPB_KEY_VALUE,
+                                     kv_msgs, False),
+        'decode_compact': (decoder_setup, decode_compact, compact_msgs),
+        'decode_kv': (decoder_setup, decode_kv, kv_msgs),
+        'proto_to_dict_row': (lambda: None, convert, rows),
+        'proto_to_dict_kv': (lambda: None, convert, kv_headers),
+    }
+    return cases
+
+def message_size(message):
+    if isinstance(message, tuple):
+        message = message[3]
+    if hasattr(message, 'ByteSize'):
+        return message.ByteSize()
+    return len(message)
+
+def measure(setup, run, messages, repeat):
+    """
+    Returns messages/s, bytes/s, and the peak traced memory per message.
+    CPython does not count allocations, so the peak of the memory
+    allocated while processing a message stands in for them.
+    """
+    stdout = sys.stdout
+    try:
+        nbytes = sum(message_size(m) for m in messages)
+        best = None
+        for i in range(repeat):
+            state = setup()
+            start = time.time()
+            for message in messages:
+                run(state, message)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        state = setup()
+        peak = 0
+        tracemalloc.start()
+        try:
+            for message in messages:
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                run(state, message)
+                peak += tracemalloc.get_traced_memory()[1] - current
+        finally:
+            tracemalloc.stop()
+    finally:
+        sys.stdout = stdout
+    return {'messages_per_sec': len(messages) / best,
+            'bytes_per_sec': nbytes / best,
+            'peak_alloc_bytes_per_msg': peak / len(messages)}
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of every case against the baseline. Returns the
+    names of the cases whose throughput dropped by more than threshold.
+    """
+    regressions = []
+    print("{:<30} {:>14} {:>14} {:>8}".format("case", "baseline msg/s",
+                                               "msg/s", "change"))
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        change = result['messages_per_sec'] / old['messages_per_sec'] - 1
+        print("{:<30} {:>14.1f} {:>14.1f} {:>+7.1f}%".format(
+              name, old['messages_per_sec'], result['messages_per_sec'],
+              change * 100))
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--messages", type=int, default=200,
+                        help="Messages per case")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs per case; the fastest one counts")
+    parser.add_argument("--cases", nargs='*', default=None,
+                        help="Only run these cases")
+    parser.add_argument("--output", default=None,
+                        help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="Compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Fail if a case is slower than the baseline by this fraction")
+    args = parser.parse_args()
+
+    decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+    cases = build_cases(decoder, args.seed, args.messages)
+    results = {}
+    for name in sorted(cases):
+        if args.cases and name not in args.cases:
+            continue
+        setup, run, messages = cases[name]
+        results[name] = measure(setup, run, messages, args.repeat)
+        print("{:<30} {:>12.1f} msg/s {:>12.0f} B/s {:>10.0f} B peak/msg".format(
+              name, results[name]['messages_per_sec'],
+              results[name]['bytes_per_sec'],
+              results[name]['peak_alloc_bytes_per_msg']))
+
+    report = {'meta': {'time': time.time(),
+                       'python': platform.python_version(),
+                       'protobuf': google.protobuf.__version__,
+                       'platform': platform.platform(),
+                       'seed': args.seed,
+                       'messages': args.messages},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Slower than the baseline: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
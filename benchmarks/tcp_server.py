@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Measures how the asyncio TCP server scales with the number of concurrent
+router sessions. Every session sends a stream of zlib compressed JSONv2
+messages; the collector runs in a separate process.
+
+Example:
+
+    python3 benchmarks/tcp_server.py --connections 1 10 100 1000
+"""
+from __future__ import print_function
+import os
+import sys
+import zlib
+import time
+import json
+import struct
+import socket
+import asyncio
+import argparse
+import resource
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric import TMClient
+from telemetric.client import TCPMsgType, TCP_FLAG_ZLIB_COMPRESSION
+from telemetric.aio import AsyncTCPServer
+
+def make_stream(messages, size):
+    """
+    Returns the bytes of one session: a compressed JSONv2 stream.
+    """
+    comp = zlib.compressobj()
+    body = json.dumps({"encoding_path": "Cisco-IOS-XR-infra-statsd-oper",
+                       "data": "x" * size}).encode('ascii')
+    data = bytearray()
+    for i in range(messages):
+        chunk = comp.compress(body) + comp.flush(zlib.Z_SYNC_FLUSH)
+        data += struct.pack(">III", TCPMsgType.JSON,
+                            TCP_FLAG_ZLIB_COMPRESSION, len(chunk))
+        data += chunk
+    return bytes(data)
+
+def serve(sock, counter):
+    def callback(msg_type, payload, peer):
+        counter.value += 1
+    client = TMClient('127.0.0.1', 0, callback=callback)
+    server = AsyncTCPServer(client)
+    server.serve_forever(sock)
+
+async def run_sessions(address, connections, stream):
+    start = time.time()
+    conns = await asyncio.gather(*[asyncio.open_connection(*address)
+                                   for i in range(connections)])
+    connected = time.time()
+    for reader, writer in conns:
+        writer.write(stream)
+    await asyncio.gather(*[writer.drain() for reader, writer in conns])
+    return conns, connected - start
+
+def bench(address, counter, connections, messages, size):
+    stream = make_stream(messages, size)
+    expected = counter.value + connections * messages
+    loop = asyncio.new_event_loop()
+    start = time.time()
+    conns, connect_time = loop.run_until_complete(
+        run_sessions(address, connections, stream))
+    while counter.value < expected:
+        time.sleep(0.001)
+    elapsed = time.time() - start
+    for reader, writer in conns:
+        writer.close()
+    loop.close()
+    return connections / connect_time, connections * messages / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--connections", type=int, nargs='*',
+                        default=[1, 10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=100,
+                        help="Messages sent per session")
+    parser.add_argument("--size", type=int, default=1024,
+                        help="Uncompressed JSON payload size in bytes")
+    args = parser.parse_args()
+
+    # Each session needs one descriptor on either side.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, 2 * max(args.connections) + 64)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(max(args.connections))
+    counter = multiprocessing.Value('L', 0, lock=False)
+    server = multiprocessing.Process(target=serve,
+                                     args=(sock, counter))
+    server.daemon = True
+    server.start()
+
+    # Wait for the collector to come up before taking measurements.
+    bench(sock.getsockname(), counter, 1, 1, args.size)
+
+    print("{:>12} {:>14} {:>14}".format("connections", "sessions/s", "messages/s"))
+    for connections in args.connections:
+        sessions_rate, message_rate = bench(sock.getsockname(), counter,
+                                            connections, args.messages,
+                                            args.size)
+        print("{:>12} {:>14.0f} {:>14.0f}".format(connections,
+                                                  sessions_rate,
+                                                  message_rate))
+    server.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -19,9 +19,12 @@ setup(name='telemetric',
       package_dir={'telemetric': 'telemetric'},
       packages=find_packages(),
       include_package_data=True,
-      scripts=['scripts/telemetric'],
+      scripts=['scripts/telemetric',
+               'scripts/telemetric-decode',
+               'scripts/telemetric-loadgen'],
       install_requires = ['protobuf',
                           'Exscript>=2.4'],
+      extras_require = {'columnar': ['numpy']},
       test_suite='tests',
       keywords=' '.join(['telemetric',
                          'telemetry',
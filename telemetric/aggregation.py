@@ -0,0 +1,275 @@
+from __future__ import absolute_import
+import time
+import threading
+import weakref
+from array import array
+from collections import namedtuple
+from .client import TCPMsgType
+from .series import iter_compact_samples, iter_kv_samples, kv_node
+
+Aggregate = namedtuple('Aggregate', ['node',
+                                     'path',
+                                     'timestamp',
+                                     'count',
+                                     'min',
+                                     'max',
+                                     'mean',
+                                     'last',
+                                     'rate'])
+
+def counter_delta(previous, value, wrap):
+    """
+    Returns the increase of a counter from previous to value. A counter
+    that went down wrapped around if it was in the upper half of its
+    range, otherwise it was reset (e.g. cleared or rebooted) and counts
+    from 0.
+    """
+    if value >= previous:
+        return value - previous
+    if previous >= wrap // 2:
+        return value + wrap - previous
+    return value
+
+class Aggregator(object):
+    """
+    Aggregates numeric samples of decoded compact rows and key-value
+    leaves into windows of a fixed interval, instead of passing on every
+    sample. Each series, identified by (node, path), gets the count, min,
+    max, mean and last value of its samples per window. Unsigned integer
+    series are treated as counters and also get a rate per second, with
+    wrap-around handling (see counter_delta()).
+
+    Every sample is folded into the window in O(1); raw samples are not
+    kept. The state of all series lives in flat columns indexed by series
+    number, and series that stop reporting are dropped after
+    max_idle windows. Counters are kept as integers, so that 64 bit
+    counters keep all their digits and their deltas are exact.
+
+    Series paths are built by iter_compact_samples() and
+    iter_kv_samples(); state fields like strings and booleans are not
+    aggregated.
+    """
+
+    def __init__(self, callback, interval=60, max_idle=10):
+        """
+        @type callback: callable
+        @param callback: Called as callback(aggregates) with a list of
+            Aggregate tuples at the end of every window.
+        @type interval: float
+        @param interval: The window length in seconds.
+        @type max_idle: int
+        @param max_idle: The number of windows without samples after
+            which a series is forgotten.
+        """
+        self.callback = callback
+        self.interval = interval
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.series = {}
+        self.keys = []
+        self.free = []
+        self.row_fields = weakref.WeakKeyDictionary()
+        self.window = 0
+        self.window_end = time.time() + interval
+
+        # Per series state. The window statistics are reset after every
+        # window; counters keep their previous value across windows. The
+        # minimum, maximum and last value of counters are in the integer
+        # columns and in previous, those of gauges in the float columns.
+        # Integer columns are lists, as arrays of Python 2 cannot hold
+        # 64 bit values everywhere; timestamps in milliseconds are exact
+        # as doubles.
+        self.count = array('L')
+        self.min = array('d')
+        self.max = array('d')
+        self.counter_min = []
+        self.counter_max = []
+        self.sum = array('d')
+        self.last = array('d')
+        self.timestamp = array('d')
+        self.delta = []
+        self.delta_time = array('d')
+        self.seen = array('L')
+        self.previous = []
+        self.wraps = []
+
+    def _index(self, key, wrap):
+        index = self.series.get(key)
+        if index is not None:
+            return index
+        if self.free:
+            index = self.free.pop()
+            self.keys[index] = key
+            self.previous[index] = None
+            self.wraps[index] = wrap
+        else:
+            index = len(self.keys)
+            self.keys.append(key)
+            self.previous.append(None)
+            self.wraps.append(wrap)
+            for column in (self.count, self.min, self.max,
+                           self.counter_min, self.counter_max, self.sum,
+                           self.last, self.timestamp, self.delta,
+                           self.delta_time, self.seen):
+                column.append(0)
+        self.count[index] = 0
+        self.delta[index] = 0
+        self.delta_time[index] = 0
+        self.series[key] = index
+        return index
+
+    def add_sample(self, node, path, value, timestamp, wrap=None):
+        """
+        Add a sample to the current window of its series.
+
+        @type node: str
+        @param node: The node (router) the sample is from.
+        @type path: str
+        @param path: The path of the series.
+        @type value: int|float
+        @param value: The value.
+        @type timestamp: int
+        @param timestamp: The time of the sample, in milliseconds.
+        @type wrap: int
+        @param wrap: For counters, the value at which they wrap around;
+            None for gauges.
+        """
+        with self.lock:
+            self._add(node, path, value, timestamp, wrap)
+
+    def _add(self, node, path, value, timestamp, wrap):
+        index = self._index((node, path), wrap)
+        count = self.count[index]
+        if wrap is None:
+            minimum, maximum = self.min, self.max
+        else:
+            minimum, maximum = self.counter_min, self.counter_max
+        if count == 0:
+            minimum[index] = maximum[index] = value
+            self.sum[index] = value
+        else:
+            if value < minimum[index]:
+                minimum[index] = value
+            if value > maximum[index]:
+                maximum[index] = value
+            self.sum[index] += value
+        self.count[index] = count + 1
+        self.seen[index] = self.window
+
+        if wrap is None:
+            self.last[index] = value
+        else:
+            previous = self.previous[index]
+            if previous is not None and timestamp > self.timestamp[index]:
+                delta = counter_delta(previous, value, wrap)
+                self.delta[index] += delta
+                self.delta_time[index] += timestamp - self.timestamp[index]
+            self.previous[index] = value
+        self.timestamp[index] = timestamp
+
+    def add_compact(self, message, node=None):
+        """
+        Add the rows of a CompactMessage (see
+        GPBDecoder.decode_compact_lazy()). node defaults to the identifier
+        of the message. See iter_compact_samples() for the series paths.
+        """
+        node = node or message.identifier
+        with self.lock:
+            for path, value, timestamp, wrap in iter_compact_samples(
+                    message, self.row_fields):
+                self._add(node, path, value, timestamp, wrap)
+        self.flush_expired()
+
+    def add_kv(self, header, node=None, peer=None):
+        """
+        Add the entries of a key-value Telemetry message (see
+        GPBDecoder.parse_kv()) from the given peer. node defaults to
+        the subscription identifier qualified with the peer (see
+        kv_node()). See iter_kv_samples() for the series paths.
+        """
+        node = node or kv_node(header.subscription_identifier, peer)
+        with self.lock:
+            for path, value, timestamp, wrap in iter_kv_samples(header):
+                self._add(node, path, value, timestamp, wrap)
+        self.flush_expired()
+
+    def add_message(self, decoder, msg_type, payload, node=None,
+                    peer=None):
+        """
+        Decode a compact or key-value message with the given GPBDecoder
+        and add it, e.g. from the callback of a TMClient. Other messages
+        are ignored. peer is the one passed to the callback.
+        """
+        if msg_type == TCPMsgType.GPB_COMPACT:
+            self.add_compact(decoder.decode_compact_lazy(payload), node)
+        elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+            self.add_kv(decoder.parse_kv(payload), node, peer)
+
+    def flush_expired(self):
+        """
+        End the current window if its interval is over. Windows are also
+        ended when compact or key-value messages are added; call this
+        regularly if the input may stop.
+        """
+        self._flush(expired=True)
+
+    def flush(self):
+        """
+        End the current window now.
+        """
+        self._flush()
+
+    def _flush(self, expired=False):
+        # With expired, the deadline is checked under the lock, so that
+        # concurrent callers end the window only once.
+        with self.lock:
+            if expired and time.time() < self.window_end:
+                return
+            aggregates = self._end_window()
+        # The callback runs without the lock, so it may add samples.
+        if aggregates:
+            self.callback(aggregates)
+
+    def _end_window(self):
+        aggregates = []
+        window = self.window
+        for index, key in enumerate(self.keys):
+            if key is None:
+                continue
+            count = self.count[index]
+            if count:
+                rate = None
+                if self.wraps[index] is None:
+                    minimum = self.min[index]
+                    maximum = self.max[index]
+                    last = self.last[index]
+                else:
+                    minimum = self.counter_min[index]
+                    maximum = self.counter_max[index]
+                    last = self.previous[index]
+                    elapsed = self.delta_time[index]
+                    if elapsed:
+                        rate = self.delta[index] * 1000.0 / elapsed
+                aggregates.append(Aggregate(key[0], key[1],
+                                            int(self.timestamp[index]),
+                                            count,
+                                            minimum,
+                                            maximum,
+                                            self.sum[index] / count,
+                                            last,
+                                            rate))
+                self.count[index] = 0
+                self.delta[index] = 0
+                self.delta_time[index] = 0
+            elif window - self.seen[index] >= self.max_idle:
+                del self.series[key]
+                self.keys[index] = None
+                self.previous[index] = None
+                self.free.append(index)
+
+        self.window += 1
+        now = time.time()
+        self.window_end += self.interval
+        if self.window_end <= now:
+            self.window_end = now + self.interval
+        return aggregates
@@ -0,0 +1,233 @@
+from __future__ import absolute_import
+import asyncio
+import logging
+from collections import deque
+from .client import LISTEN_BACKLOG
+from .framing import parse_header
+from .queues import BLOCK
+from .metrics import timer
+
+logger = logging.getLogger()
+
+# Frames queued behind a decompression on the inflate pool before the
+# session stops reading from its socket.
+MAX_BACKLOG = 256
+
+class TelemetryProtocol(asyncio.Protocol):
+    """
+    Frames the TCP stream of a single router. Every connection owns its
+    own JSONv1Handler and JSONv2Handler, so the compressor state of one
+    session never leaks into another.
+
+    If the client has an inflate pool, large compressed messages are
+    decompressed there. The frames that follow wait in a backlog until
+    that is done, so the messages of a session are still handled in order.
+
+    A decode queue with the block policy cannot make the event loop wait
+    for room. Instead, the frames of one read are queued regardless, and
+    the session stops reading until the queue is half empty again.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.v1handler = None
+        self.v2handler = None
+        self.buffer = bytearray()
+        self.transport = None
+        self.peer = None
+        self.messages = 0
+        self.inflating = False
+        self.backlog = deque()
+        self.paused = False
+        self.queue_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        self.v1handler = self.server.client.create_v1handler(self.peer)
+        self.v2handler = self.server.client.create_v2handler(self.peer)
+        self.server.session_opened(self)
+
+    def connection_lost(self, exc):
+        self.server.session_closed(self)
+
+    def data_received(self, data):
+        self.buffer.extend(data)
+        try:
+            consumed = self.process(self.buffer)
+        except Exception as e:
+            logger.error("Dropping TCP session from {}: {}".format(self.peer, e))
+            self.transport.close()
+            return
+        if consumed:
+            del self.buffer[:consumed]
+        self.throttle()
+
+    def process(self, buf):
+        """
+        Decode all complete messages in the given buffer. Returns the
+        number of bytes consumed; an incomplete trailing message is left
+        for the next call.
+        """
+        client = self.server.client
+        metrics = client.metrics
+        end = len(buf)
+        pos = 0
+        count = 0
+
+        while True:
+            if metrics is not None:
+                started = timer()
+            header = parse_header(buf, pos, end)
+            if header is None or header[4] > end:
+                break
+            version, msg_type, flags, start, frame_end = header
+            payload = bytes(memoryview(buf)[start:frame_end])
+            if metrics is not None:
+                metrics.framing.observe(timer() - started)
+            frame = version, msg_type, flags, payload
+            if self.inflating:
+                self.backlog.append(frame)
+            else:
+                self.handle(frame)
+            count += 1
+            pos = frame_end
+
+        if len(self.backlog) > MAX_BACKLOG and not self.paused:
+            self.paused = True
+            if not self.queue_paused:
+                self.transport.pause_reading()
+
+        self.messages += count
+        self.server.messages += count
+        return pos
+
+    def handle(self, frame):
+        """
+        Handle a frame, or start decompressing it on the inflate pool.
+        """
+        client = self.server.client
+        version, msg_type, flags, payload = frame
+        if not client.offload_inflate(version, flags, payload):
+            client.handle_frame(self.v1handler, self.v2handler, self.peer,
+                                version, msg_type, flags, payload,
+                                wait=False)
+            return
+
+        client.record_frame(self.peer, version, msg_type, flags, payload)
+        if version == 1:
+            future = client.inflate_pool.submit(self.v1handler.inflate, payload)
+        else:
+            future = client.inflate_pool.submit(self.v2handler.inflate,
+                                                msg_type, flags, payload)
+        self.inflating = True
+        loop = self.server.loop
+        future.add_done_callback(
+            lambda f: loop.call_soon_threadsafe(self.inflated, frame, f))
+
+    def inflated(self, frame, future):
+        """
+        Called on the event loop when the given frame was decompressed.
+        Decodes it, then handles the frames that were waiting for it.
+        """
+        client = self.server.client
+        version, msg_type, flags, payload = frame
+        self.inflating = False
+        try:
+            client.dispatch(self.v1handler, self.v2handler, self.peer,
+                            version, msg_type, future.result(), wait=False)
+            while self.backlog and not self.inflating:
+                self.handle(self.backlog.popleft())
+        except Exception as e:
+            logger.error("Dropping TCP session from {}: {}".format(self.peer, e))
+            self.backlog.clear()
+            self.transport.close()
+            return
+        if self.paused and len(self.backlog) <= MAX_BACKLOG // 2:
+            self.paused = False
+            if not self.queue_paused:
+                self.transport.resume_reading()
+        self.throttle()
+
+    def throttle(self):
+        """
+        Stop reading while the decode queue is full, if it blocks.
+        """
+        queue = self.server.client.decode_queue
+        if queue is None or queue.policy != BLOCK or self.queue_paused \
+          or not queue.full():
+            return
+        self.queue_paused = True
+        if not self.paused:
+            self.transport.pause_reading()
+        loop = self.server.loop
+        queue.when_room(lambda: loop.call_soon_threadsafe(self.queue_resumed))
+
+    def queue_resumed(self):
+        """
+        Called on the event loop once the decode queue has room again.
+        """
+        self.queue_paused = False
+        if not self.paused:
+            self.transport.resume_reading()
+
+class AsyncTCPServer(object):
+    """
+    Accepts TCP dial-out sessions from any number of routers on a single
+    asyncio event loop.
+    """
+
+    def __init__(self, client, loop=None, backlog=LISTEN_BACKLOG):
+        """
+        @type client: TMClient
+        @param client: Provides the decoder, callback and output options.
+        @type loop: asyncio.AbstractEventLoop
+        @param loop: The event loop to use. A new one is created by default.
+        @type backlog: int
+        @param backlog: The listen backlog of the server socket.
+        """
+        self.client = client
+        self.loop = loop or asyncio.new_event_loop()
+        self.backlog = backlog
+        self.server = None
+        self.sessions = 0
+        self.active_sessions = 0
+        self.messages = 0
+
+    def session_opened(self, protocol):
+        self.sessions += 1
+        self.active_sessions += 1
+        if self.client.metrics is not None:
+            self.client.metrics.session_opened(protocol.peer)
+        logger.info("Got TCP connection from %s", protocol.peer)
+
+    def session_closed(self, protocol):
+        self.active_sessions -= 1
+        if self.client.metrics is not None:
+            self.client.metrics.session_closed(protocol.peer)
+        logger.info("TCP connection from %s closed", protocol.peer)
+
+    def start(self, sock):
+        """
+        Start serving on the given bound TCP socket without running the
+        event loop.
+        """
+        sock.setblocking(False)
+        coro = self.loop.create_server(lambda: TelemetryProtocol(self),
+                                       sock=sock,
+                                       backlog=self.backlog)
+        self.server = self.loop.run_until_complete(coro)
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.server = None
+
+    def serve_forever(self, sock):
+        self.start(sock)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stop()
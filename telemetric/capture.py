@@ -0,0 +1,271 @@
+from __future__ import absolute_import
+import os
+import mmap
+import time
+import struct
+import threading
+from collections import namedtuple
+
+# A capture file starts with MAGIC, followed by one record per frame:
+#
+#   timestamp (uint64, microseconds since the epoch)
+#   payload length (uint32)
+#   transport (uint8, TRANSPORT_TCP or TRANSPORT_UDP)
+#   version (uint8, 1 or 2 for TCP frames, 0 for UDP)
+#   msg_type (uint32), flags (uint32), both 0 unless version is 2
+#   peer length (uint16)
+#   peer (UTF-8, "host:port")
+#   payload
+#
+# When the file is closed, the offsets of all records are appended as
+# uint64 values, followed by the trailer: the offset of that index, the
+# number of records, and INDEX_MAGIC. Files without a trailer, e.g. from a
+# collector that crashed, are indexed by scanning the records.
+MAGIC = b'TMCAPT01'
+INDEX_MAGIC = b'TMCAPIDX'
+TRANSPORT_TCP = 1
+TRANSPORT_UDP = 2
+
+_record = struct.Struct('>QIBBIIH')
+_offset = struct.Struct('>Q')
+_trailer = struct.Struct('>QQ8s')
+
+CaptureFrame = namedtuple('CaptureFrame', ['timestamp',
+                                           'transport',
+                                           'peer',
+                                           'version',
+                                           'msg_type',
+                                           'flags',
+                                           'payload'])
+
+def format_peer(address):
+    """
+    Returns the given socket address as a "host:port" string.
+    """
+    if address is None:
+        return ''
+    if isinstance(address, tuple):
+        return '{}:{}'.format(address[0], address[1])
+    return str(address)
+
+def peer_host(address):
+    """
+    Returns the host of the given socket address or "host:port" string,
+    which, unlike the port, stays the same when a router reconnects.
+    """
+    if address is None:
+        return ''
+    if isinstance(address, tuple):
+        return address[0]
+    return address.rpartition(':')[0] or address
+
+class CaptureWriter(object):
+    """
+    Appends received frames to a capture file, exactly as they are passed
+    to JSONv1Handler, JSONv2Handler and the UDP decoder. Safe to use from
+    several receiving threads.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(os.path.expanduser(filename), 'wb')
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        # The index, as written to the file.
+        self.offsets = bytearray()
+        self.lock = threading.Lock()
+
+    def write(self, transport, peer, version, msg_type, flags, payload,
+              timestamp=None):
+        """
+        Append a frame. peer is a socket address or a string; the
+        timestamp defaults to the current time.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        peer = format_peer(peer).encode('utf-8')
+        header = _record.pack(int(timestamp * 1000000),
+                              len(payload),
+                              transport,
+                              version,
+                              msg_type or 0,
+                              flags or 0,
+                              len(peer))
+        with self.lock:
+            self.file.write(header)
+            self.file.write(peer)
+            self.file.write(payload)
+            self.offsets += _offset.pack(self.offset)
+            self.offset += len(header) + len(peer) + len(payload)
+
+    def write_tcp(self, peer, version, msg_type, flags, payload):
+        self.write(TRANSPORT_TCP, peer, version, msg_type, flags, payload)
+
+    def write_udp(self, peer, payload):
+        self.write(TRANSPORT_UDP, peer, 0, 0, 0, payload)
+
+    def close(self):
+        """
+        Write the index and close the file.
+        """
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(self.offsets)
+            self.file.write(_trailer.pack(self.offset,
+                                          len(self.offsets) // _offset.size,
+                                          INDEX_MAGIC))
+            self.file.close()
+
+class CaptureReader(object):
+    """
+    Reads a capture file through a memory map, so that the file is never
+    loaded as a whole. Frames are available by index or in order; their
+    payloads are memoryviews into the map, which must be released (or
+    copied) before the reader is closed. On Python 2, they are copies.
+    """
+
+    def __init__(self, filename):
+        self.file = open(os.path.expanduser(filename), 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(MAGIC):
+            self.file.close()
+            raise ValueError("{} is not a capture file".format(filename))
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("{} is not a capture file".format(filename))
+        try:
+            self.view = memoryview(self.map)
+        except TypeError:
+            # Python 2 can not view a memory map; slices are copies.
+            self.view = self.map
+
+        # Use the index if the file was closed properly.
+        self.end = size
+        self.index_offset = None
+        self.offsets = None
+        if size >= len(MAGIC) + _trailer.size:
+            index_offset, count, magic = _trailer.unpack_from(
+                self.map, size - _trailer.size)
+            if magic == INDEX_MAGIC:
+                self.end = self.index_offset = index_offset
+                self.count = count
+        if self.index_offset is None:
+            # Build the index in the format of the file.
+            self.offsets = bytearray()
+            for offset, frame in self.scan():
+                self.offsets += _offset.pack(offset)
+            self.count = len(self.offsets) // _offset.size
+
+    def read(self, offset):
+        """
+        Returns the frame at the given offset in the file, or None if it is
+        truncated.
+        """
+        return self._read(offset)[0]
+
+    def _read(self, offset):
+        timestamp, length, transport, version, msg_type, flags, peer_length = \
+            _record.unpack_from(self.map, offset)
+        peer_start = offset + _record.size
+        start = peer_start + peer_length
+        end = start + length
+        if end > self.end:
+            return None, end
+        peer = bytes(self.view[peer_start:start]).decode('utf-8')
+        return CaptureFrame(timestamp / 1000000.0,
+                            transport,
+                            peer,
+                            version,
+                            msg_type,
+                            flags,
+                            self.view[start:end]), end
+
+    def scan(self):
+        """
+        Yields (offset, frame) for each frame in file order. Stops at a
+        truncated record.
+        """
+        offset = len(MAGIC)
+        while offset + _record.size <= self.end:
+            frame, end = self._read(offset)
+            if frame is None:
+                break
+            yield offset, frame
+            offset = end
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("frame index out of range")
+        if self.offsets is not None:
+            offset = _offset.unpack_from(self.offsets,
+                                         index * _offset.size)[0]
+        else:
+            offset = _offset.unpack_from(self.map,
+                                         self.index_offset + index * _offset.size)[0]
+        return self._read(offset)[0]
+
+    def __iter__(self):
+        for offset, frame in self.scan():
+            yield frame
+
+    def close(self):
+        if isinstance(getattr(self, 'view', None), memoryview):
+            self.view.release()
+        self.view = None
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def replay(frames, client, speed=1.0):
+    """
+    Feed captured frames through the decode pipeline of the given TMClient,
+    as if they were received again. Every TCP peer gets its own handlers,
+    like a live session.
+
+    @type frames: iterable(CaptureFrame)
+    @param frames: The frames, e.g. a CaptureReader.
+    @type client: TMClient
+    @param client: The client whose handlers and decoder are used.
+    @type speed: float
+    @param speed: A multiple of the original speed, e.g. 1 to replay in
+        real time or 10 to replay ten times faster. None or 0 replays as
+        fast as possible.
+    Returns the number of frames replayed.
+    """
+    handlers = {}
+    started = time.time()
+    first = None
+    count = 0
+    for frame in frames:
+        if speed:
+            if first is None:
+                first = frame.timestamp
+            delay = (frame.timestamp - first) / speed - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        if frame.transport == TRANSPORT_UDP:
+            client.handle_udp_message(frame.peer, frame.payload)
+        else:
+            session = handlers.get(frame.peer)
+            if session is None:
+                session = handlers[frame.peer] = (
+                    client.create_v1handler(frame.peer),
+                    client.create_v2handler(frame.peer))
+            client.handle_frame(session[0], session[1], frame.peer,
+                                frame.version, frame.msg_type, frame.flags,
+                                frame.payload)
+        count += 1
+    return count
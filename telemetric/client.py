@@ -4,21 +4,34 @@ import zlib
 import struct
 import socket
 import logging
+import threading
+import time
 from Exscript.util.ipv4 import is_ip as is_ipv4
 from Exscript.util.ipv6 import is_ip as is_ipv6
 from .util import print_json
 from .gpb import GPBDecoder
 from .message import TMMessage
+from .framing import FrameReader
+from .capture import CaptureWriter, CaptureReader, replay
+from .metrics import CollectorMetrics, MetricsServer, timer
 
 logger = logging.getLogger()
 TCP_FLAG_ZLIB_COMPRESSION = 0x1
 
+# Pending connections the kernel queues on the TCP socket, so that a burst
+# of routers dialing out is not refused while sessions are being started.
+LISTEN_BACKLOG = 1024
+
+# Not exported by the socket module; this is the value used by Linux.
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+
 # Should use enum.Enum but not available in python2.7.1 on EnXR
 class TCPMsgType(object):
     RESET_COMPRESSOR = 1
     JSON = 2
     GPB_COMPACT = 3
     GPB_KEY_VALUE = 4
+    VALID = frozenset((RESET_COMPRESSOR, JSON, GPB_COMPACT, GPB_KEY_VALUE))
 
     @classmethod
     def to_string(self, value):
@@ -33,28 +46,61 @@ class TCPMsgType(object):
         else:
             raise ValueError("{} is not a valid TCP message type".format(value))
 
-def unpack_int(raw_data):
-    return struct.unpack_from(">I", raw_data, 0)[0]
+def unpack_int(raw_data, offset=0):
+    return struct.unpack_from(">I", raw_data, offset)[0]
 
-def open_sockets(ip_address, port):
+def socket_family(ip_address):
     # Figure out if the supplied address is ipv4 or ipv6 and set the socet type
     # appropriately
     if is_ipv4(ip_address):
-        socket_type = socket.AF_INET
+        return socket.AF_INET
     elif is_ipv6(ip_address):
-        socket_type = socket.AF_INET6
-    else:
-        raise AttributeError("Invalid ip address ", ip_address)
+        return socket.AF_INET6
+    raise AttributeError("Invalid ip address ", ip_address)
 
-    # Bind to two sockets to handle either UDP or TCP data
-    udp_sock = socket.socket(socket_type, socket.SOCK_DGRAM)
+def open_udp_socket(ip_address, port, reuseport=False, rcvbuf=None):
+    """
+    Open a bound UDP socket.
+
+    @type reuseport: bool
+    @param reuseport: Whether to set SO_REUSEPORT, so that several sockets
+        can share the port and the kernel balances datagrams between them.
+    @type rcvbuf: int
+    @param rcvbuf: The requested kernel receive buffer size in bytes.
+    """
+    udp_sock = socket.socket(socket_family(ip_address), socket.SOCK_DGRAM)
     udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if rcvbuf:
+        set_rcvbuf(udp_sock, rcvbuf)
     udp_sock.bind((ip_address, port))
+    return udp_sock
+
+def set_rcvbuf(sock, size):
+    """
+    Set the kernel receive buffer of the given socket. SO_RCVBUFFORCE is
+    tried first, because SO_RCVBUF is silently capped by
+    net.core.rmem_max. Returns the size actually used by the kernel.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+    except (OSError, socket.error):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if actual < size:
+        logger.warning("UDP receive buffer is {} bytes instead of {};"
+                       " consider raising net.core.rmem_max".format(actual, size))
+    return actual
+
+def open_sockets(ip_address, port, udp=True):
+    # Bind to two sockets to handle either UDP or TCP data
+    udp_sock = open_udp_socket(ip_address, port) if udp else None
 
-    tcp_sock = socket.socket(socket_type)
+    tcp_sock = socket.socket(socket_family(ip_address))
     tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     tcp_sock.bind((ip_address, port))
-    tcp_sock.listen(1)
+    tcp_sock.listen(LISTEN_BACKLOG)
 
     return tcp_sock, udp_sock
 
@@ -63,14 +109,64 @@ class JSONHandler(object):
     Abstract base.
     """
 
-    def __init__(self):
+    def __init__(self, gpbdecoder=None, callback=None, metrics=None,
+                 peer=None, forward_json=None):
+        """
+        @type gpbdecoder: GPBDecoder
+        @param gpbdecoder: The decoder used for GPB messages.
+        @type callback: callable
+        @param callback: If given, called as callback(msg_type, payload,
+            peer) with every decompressed message instead of decoding and
+            printing it.
+        @type metrics: CollectorMetrics
+        @param metrics: If given, the decompress and sink stages are timed.
+        @type peer: object
+        @param peer: The peer of the session, passed to the callback and
+            counted for in the compression metrics.
+        @type forward_json: callable
+        @param forward_json: If given, JSON messages are passed to it as
+            forward_json(payload) exactly as received (after
+            decompression), instead of being decoded or passed to the
+            callback. payload may be a memoryview into a buffer that is
+            reused, so it must be copied if kept.
+        """
+        self.gpbdecoder = gpbdecoder
+        self.callback = callback
+        self.forward_json = forward_json
+        self.peer = peer
+        self.metrics = metrics
+        self.peer_metrics = None if metrics is None else metrics.peer(peer)
         self.deco = zlib.decompressobj()
 
-    def get_data(self, conn, length):
-        data = b""
-        while len(data) < length:
-            data += conn.recv(length - len(data))
-        return data
+    def decompress(self, data):
+        if self.metrics is None:
+            return self.deco.decompress(data)
+        start = timer()
+        try:
+            msg = self.deco.decompress(data)
+        except Exception:
+            self.peer_metrics.decompress_errors.inc()
+            raise
+        self.metrics.decompress.observe(timer() - start)
+        self.peer_metrics.compressed.inc(len(data))
+        self.peer_metrics.decompressed.inc(len(msg))
+        if len(data):
+            self.metrics.compression_ratio.observe(len(msg) / float(len(data)))
+        return msg
+
+    def deliver(self, msg_type, payload):
+        if self.metrics is None:
+            return self.callback(msg_type, payload, self.peer)
+        start = timer()
+        self.callback(msg_type, payload, self.peer)
+        self.metrics.sink.observe(timer() - start)
+
+    def forward(self, payload):
+        if self.metrics is None:
+            return self.forward_json(payload)
+        start = timer()
+        self.forward_json(payload)
+        self.metrics.sink.observe(timer() - start)
 
 class JSONv1Handler(JSONHandler):
     """
@@ -78,45 +174,82 @@ class JSONv1Handler(JSONHandler):
     """
 
     def unpack_message(self, data):
-        while len(data) > 0:
-            _type = unpack_int(data)
-            data = data[4:]
+        """
+        Yields (type, value) for each TLV in the given message body. If data
+        is a memoryview, the values are slices of it rather than copies.
+        """
+        pos = 0
+        end = len(data)
+        while pos < end:
+            _type = unpack_int(data, pos)
+            pos += 4
 
             if _type == 1:
-                data = data[4:]
+                pos += 4
                 yield 1, None
             elif _type == 2:
-                msg_length = unpack_int(data)
-                msg = data[4:msg_length]
-                data = data[4+msg_length:]
-                yield 2, msg
-
-    def get_message(self, length, conn, json_dump=False, print_all=True):
-        logger.info("  Message Type: JSONv1 (COMPRESSED)")
-        data = self.get_data(conn, length)
+                msg_length = unpack_int(data, pos)
+                pos += 4
+                yield 2, data[pos:pos+msg_length]
+                pos += msg_length
+            else:
+                # The length of unknown TLVs is unknown, so stop here.
+                yield _type, None
+                return
 
+    def inflate(self, data):
+        """
+        Decompress the TLVs of a complete v1 message body (without the
+        leading length field). Returns a list with the decompressed
+        messages. Only touches the decompressor, so it may run on another
+        thread while no other message of the session is handled.
+        """
+        debug = logger.isEnabledFor(logging.INFO)
+        if debug:
+            logger.info("  Message Type: JSONv1 (COMPRESSED)")
+        messages = []
         for thetype, msg in self.unpack_message(data):
             if thetype == 1:
-                logger.info("  Reset Compressor TLV")
+                if debug:
+                    logger.info("  Reset Compressor TLV")
                 self.deco = zlib.decompressobj()
                 continue
 
             if thetype == 2:
-                logger.info("  Message TLV")
-                msg_b = self.deco.decompress(msg)
-                if json_dump:
-                    # Print the message as-is
-                    print(msg_b)
-                else:
-                    # Decode and pretty-print the message
-                    print_json(msg_b)
-
-                #yield Message(TCPMsgType.JSON,
-                #              {},
-                #              msg_b)
+                if debug:
+                    logger.info("  Message TLV")
+                messages.append(self.decompress(msg))
                 continue
 
             raise ValueError('invalid TLV type: {}'.format(thetype))
+        return messages
+
+    def dispatch(self, messages, json_dump=False, print_all=True):
+        """
+        Pass on the messages returned by inflate().
+        """
+        for msg_b in messages:
+            if self.forward_json is not None:
+                self.forward(msg_b)
+            elif self.callback is not None:
+                self.deliver(TCPMsgType.JSON, msg_b)
+            elif json_dump:
+                # Print the message as-is
+                print(msg_b)
+            else:
+                # Decode and pretty-print the message
+                print_json(msg_b)
+
+            #yield Message(TCPMsgType.JSON,
+            #              {},
+            #              msg_b)
+
+    def handle_payload(self, data, json_dump=False, print_all=True):
+        """
+        Decode the TLVs of a complete v1 message body (without the leading
+        length field).
+        """
+        self.dispatch(self.inflate(data), json_dump, print_all)
 
 class JSONv2Handler(JSONHandler):
     """
@@ -131,46 +264,65 @@ class JSONv2Handler(JSONHandler):
         else:
             return "|".join(strings)
 
-    def get_message(self, msg_type, conn, json_dump=False, print_all=True):
-        try:
-            msg_type_str = TCPMsgType.to_string(msg_type)
-            logger.info("  Message type: {})".format(msg_type_str))
-        except Exception as err:
-            logger.error("  Invalid message type: {}".format(msg_type))
-
-        t = conn.recv(4)
-        flags = unpack_int(t)
-        logger.info("  Flags: {}".format(self.tcp_flags_to_string(flags)))
-        t = conn.recv(4)
-        length = unpack_int(t)
-        logger.info("  Length: {}".format(length))
-
-        # Read all the bytes of the message according to the length in the header
-        data = self.get_data(conn, length)
+    def inflate(self, msg_type, flags, data):
+        """
+        Decompress the body of a v2 message whose header was already read,
+        if necessary, and reset the decompressor on RESET_COMPRESSOR.
+        Returns the message, or None if there is nothing to decode. Only
+        touches the decompressor, so it may run on another thread while no
+        other message of the session is handled.
+        """
+        debug = logger.isEnabledFor(logging.INFO)
+        if msg_type not in TCPMsgType.VALID:
+            logger.error("  Invalid message type: %s", msg_type)
+        elif debug:
+            logger.info("  Message type: %s)", TCPMsgType.to_string(msg_type))
+        if debug:
+            logger.info("  Flags: %s", self.tcp_flags_to_string(flags))
+            logger.info("  Length: %s", len(data))
+
+        if msg_type == TCPMsgType.RESET_COMPRESSOR:
+            self.deco = zlib.decompressobj()
+            return None
 
         # Decompress the message if necessary. Otherwise use as-is
-        if flags & TCP_FLAG_ZLIB_COMPRESSION != 0:
-            try:
+        if flags & TCP_FLAG_ZLIB_COMPRESSION == 0:
+            return data
+        try:
+            if debug:
                 logger.info("Decompressing message")
-                msg = self.deco.decompress(data)
-            except Exception as err:
-                logger.error("failed to decompress message: {}".format(err))
-                msg = None
-        else:
-            msg = data
+            return self.decompress(data)
+        except Exception as err:
+            logger.error("failed to decompress message: {}".format(err))
+            return None
+
+    def dispatch(self, msg_type, msg, json_dump=False, print_all=True):
+        """
+        Decode a message returned by inflate(), or pass it to the callback.
+        """
+        if msg is None:
+            return
 
         # Decode the data according to the message type in the header
-        logger.info("Decoding message")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Decoding message")
         try:
-            if msg_type == TCPMsgType.GPB_COMPACT:
-                message = gpbdecoder.decode_compact(msg, json_dump=json_dump,
-                                                    print_all=print_all)
+            if self.forward_json is not None and msg_type == TCPMsgType.JSON:
+                self.forward(msg)
+            elif self.callback is not None:
+                self.deliver(msg_type, bytes(msg))
+            elif msg_type == TCPMsgType.GPB_COMPACT:
+                message = self.gpbdecoder.decode_compact(msg,
+                                                         json_dump=json_dump,
+                                                         print_all=print_all)
                 #TODO: yield message
             elif msg_type == TCPMsgType.GPB_KEY_VALUE:
-                message = gpbdecoder.decode_kv(msg, json_dump=json_dump,
-                                               print_all=print_all)
+                message = self.gpbdecoder.decode_kv(msg,
+                                                    json_dump=json_dump,
+                                                    print_all=print_all)
                 #TODO: yield message
             elif msg_type == TCPMsgType.JSON:
+                msg = bytes(msg)
                 if json_dump:
                     # Print the message as-is
                     print(msg)
@@ -181,17 +333,41 @@ class JSONv2Handler(JSONHandler):
                 #TODO: yield Message(TCPMsgType.JSON,
                 #              {},
                 #              msg_b)
-            elif msg_type == TCPMsgType.RESET_COMPRESSOR:
-                self.deco = zlib.decompressobj()
         except Exception as err:
             logger.error("failed to decode TCP message: {}".format(err))
 
+    def handle_payload(self, msg_type, flags, data, json_dump=False,
+                       print_all=True):
+        """
+        Decompress and decode the body of a v2 message whose header was
+        already read. data may be a memoryview; it is passed to the
+        decompressor and the GPB decoder without being copied.
+        """
+        self.dispatch(msg_type, self.inflate(msg_type, flags, data),
+                      json_dump, print_all)
+
 class TMClient(object):
     def __init__(self, ipaddress, port, protos=None,
                  proto_output_dir='~/.telemetric/proto',
                  proto_include_dir=(),
                  json_dump=False,
-                 print_all=False):
+                 print_all=False,
+                 callback=None,
+                 decode_processes=0,
+                 udp_processes=0,
+                 udp_rcvbuf=32*1024*1024,
+                 lazy_schemas=False,
+                 max_schemas=None,
+                 capture_file=None,
+                 metrics_port=None,
+                 inflate_threads=0,
+                 inflate_min_size=64*1024,
+                 forward_json=None,
+                 queue_size=0,
+                 queue_policy='block',
+                 queue_threads=1,
+                 shard_by_device=False,
+                 shard_aggregate=None):
         """
         @type ipaddress: str
         @param ipaddress: An IPv4 or IPv6 address.
@@ -203,45 +379,351 @@ class TMClient(object):
         @param json_dump: Whether to dump all json output to stdout.
         @type print_all: str
         @param print_all: Whether to print all messages to stdout.
+        @type callback: callable
+        @param callback: Called as callback(msg_type, payload, peer) for
+            every decompressed TCP message and every UDP message instead
+            of printing it, where peer is the socket address of the
+            router.
+        @type decode_processes: int
+        @param decode_processes: If not 0, messages are decoded by this
+            many worker processes instead of the receiving threads. The
+            callback then receives callback(msg_type, record, peer) with the
+            decoded record; without a callback, records are dumped as JSON.
+        @type udp_processes: int
+        @param udp_processes: If not 0, UDP is received by this many worker
+            processes, each with its own SO_REUSEPORT socket. See UDPIngest.
+        @type udp_rcvbuf: int
+        @param udp_rcvbuf: The kernel receive buffer size of the UDP
+            sockets used by the worker processes.
+        @type lazy_schemas: bool
+        @param lazy_schemas: Only compile and import the schemas of the
+            receiving process when their schema path first shows up.
+        @type max_schemas: int
+        @param max_schemas: The maximum number of schemas the receiving
+            process keeps loaded.
+        @type capture_file: str
+        @param capture_file: If given, every received frame is recorded in
+            this file; see CaptureWriter and replay(). Not supported with
+            udp_processes.
+        @type metrics_port: int
+        @param metrics_port: If given, per-stage latencies, per-peer
+            traffic, errors and queue depths are collected and served in
+            the Prometheus text format on this port of localhost, at
+            /metrics. Not collected by worker processes.
+        @type inflate_threads: int
+        @param inflate_threads: If not 0, the asyncio server decompresses
+            large messages on a pool of this many threads, so that
+            several cores inflate in parallel while the event loop keeps
+            receiving. The threaded server decompresses on the thread of
+            each connection.
+        @type inflate_min_size: int
+        @param inflate_min_size: Compressed messages smaller than this
+            are decompressed inline, as handing them off costs more.
+        @type forward_json: callable
+        @param forward_json: If given, TCP JSON messages are passed to it
+            undecoded; see JSONHandler. Use scan_json_keys() to read the
+            fields a message is routed by.
+        @type queue_size: int
+        @param queue_size: If not 0, decompressed TCP messages and UDP
+            messages are put in a BoundedQueue of this size and decoded
+            by queue_threads threads, so that receiving never waits for
+            decoding. Decompression stays on the receiving side, as the
+            zlib state of a session spans messages.
+        @type queue_policy: str
+        @param queue_policy: What the queue does when it is full; see
+            BoundedQueue. Under run_async(), block stops reading from the
+            TCP sessions rather than blocking the event loop.
+        @type queue_threads: int
+        @param queue_threads: The number of decoding threads. Messages
+            are only decoded in order with a single thread.
+        @type shard_by_device: bool
+        @param shard_by_device: With decode_processes, route messages to
+            the workers by the device they are from rather than by
+            connection, so that every device is decoded by one worker, in
+            order; see ShardedPipeline.
+        @type shard_aggregate: float
+        @param shard_aggregate: With shard_by_device, the workers
+            aggregate the messages of their devices over windows of this
+            many seconds (see Aggregator), and the callback is called as
+            callback(None, aggregates, None) with the Aggregate tuples of each
+            window instead of the records.
         """
-        #TODO: the client should provide a callback for retrieving messages,
-        # making json_dump and print_all obsolete.
-        self.gpbdecoder = GPBDecoder(protos or [],
+        self.protos = protos or []
+        self.proto_output_dir = proto_output_dir
+        self.proto_include_dir = proto_include_dir
+        self.gpbdecoder = GPBDecoder(self.protos,
                                      proto_output_dir,
-                                     proto_include_dir)
-        self.v1handler = JSONv1Handler()
-        self.v2handler = JSONv2Handler()
+                                     proto_include_dir,
+                                     lazy_schemas=lazy_schemas,
+                                     max_schemas=max_schemas)
+        self.callback = callback
+        self.forward_json = forward_json
+        self.metrics = None
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics = CollectorMetrics()
+            self.metrics_server = MetricsServer(self.metrics.registry,
+                                                port=metrics_port)
+            self.gpbdecoder.metrics = self.metrics
+            schemas = self.gpbdecoder.schemas
+            self.metrics.queue_depth.labels('schema_loads').set_function(
+                lambda: len(schemas.requests))
+        self.decode_processes = decode_processes
+        self.decode_pool = None
+        self.inflate_threads = inflate_threads
+        self.inflate_min_size = inflate_min_size
+        self.inflate_pool = None
+        self.decode_queue = None
+        self.decode_queue_started = False
+        if queue_size:
+            from .queues import BoundedQueue
+            self.decode_queue = BoundedQueue('decode', queue_size,
+                                             queue_policy,
+                                             schema=self._queued_schema,
+                                             metrics=self.metrics)
+        self.queue_threads = queue_threads
+        self.shard_by_device = shard_by_device
+        self.shard_aggregate = shard_aggregate
+        self.udp_processes = udp_processes
+        self.udp_rcvbuf = udp_rcvbuf
+        self.udp_ingest = None
+        self.v1handler = self.create_v1handler('tcp')
+        self.v2handler = self.create_v2handler('tcp')
         self.ipaddress = ipaddress
         self.port = port
         self.json_dump = json_dump
         self.print_all = print_all
+        self.capture = None
+        if capture_file is not None:
+            if udp_processes:
+                raise ValueError("capture_file cannot be used with udp_processes")
+            self.capture = CaptureWriter(capture_file)
 
-    def get_message(self, conn):
+    def create_v1handler(self, key=None):
+        """
+        Create a handler for a v1 session. key identifies the session; the
+        messages of one key are delivered in order.
+        """
+        return JSONv1Handler(self.gpbdecoder, self._handler_callback(key),
+                             self.metrics, key, self.forward_json)
+
+    def create_v2handler(self, key=None):
+        """
+        Like create_v1handler(), but for v2 sessions.
+        """
+        return JSONv2Handler(self.gpbdecoder, self._handler_callback(key),
+                             self.metrics, key, self.forward_json)
+
+    def _handler_callback(self, key):
+        if not self.decode_processes:
+            return self.callback
+        return self._submit
+
+    def _submit(self, msg_type, payload, peer):
+        self.decode_pool.submit(peer, msg_type, payload)
+
+    def _deliver(self, key, msg_type, record):
+        if self.callback is not None:
+            self.callback(msg_type, record, key)
+        else:
+            print(json.dumps(record))
+
+    def _deliver_aggregates(self, aggregates):
+        if self.callback is not None:
+            self.callback(None, aggregates, None)
+        else:
+            for aggregate in aggregates:
+                print(json.dumps(aggregate._asdict()))
+
+    def start_decode_pool(self):
+        """
+        Start the worker processes if decode_processes was given. Called by
+        run() and run_async().
+        """
+        if not self.decode_processes or self.decode_pool is not None:
+            return
+        if self.shard_by_device:
+            from .shards import ShardedPipeline
+            callback = self._deliver
+            if self.shard_aggregate:
+                callback = self._deliver_aggregates
+            self.decode_pool = ShardedPipeline(callback,
+                                               self.protos,
+                                               self.proto_output_dir,
+                                               self.proto_include_dir,
+                                               processes=self.decode_processes,
+                                               aggregate_interval=self.shard_aggregate)
+            if self.metrics is not None:
+                self.decode_pool.register_metrics(self.metrics.registry)
+        else:
+            from .pipeline import DecodePool
+            self.decode_pool = DecodePool(self._deliver,
+                                          self.protos,
+                                          self.proto_output_dir,
+                                          self.proto_include_dir,
+                                          processes=self.decode_processes)
+        if self.metrics is not None:
+            self.metrics.queue_depth.labels('decode_pool').set_function(
+                self.decode_pool.queued)
+
+    def start_decode_queue(self):
+        """
+        Start the threads that decode queued messages if queue_size was
+        given. Called by run() and run_async().
+        """
+        if self.decode_queue is None or self.decode_queue_started:
+            return
+        self.decode_queue_started = True
+        self.decode_queue.serve(self._dequeued, self.queue_threads)
+
+    def _queued_schema(self, item):
+        from .queues import schema_path
+        handler, version, msg_type, msg = item
+        if version == 1:
+            return schema_path(TCPMsgType.JSON, msg[0], 'Policy') \
+                   if msg else ''
+        return schema_path(msg_type, msg)
+
+    def _dequeued(self, item, peer):
+        handler, version, msg_type, msg = item
+        if version == 1:
+            handler.dispatch(msg, self.json_dump, self.print_all)
+        elif version == 2:
+            handler.dispatch(msg_type, msg, self.json_dump, self.print_all)
+        else:
+            self._decode_udp(msg, peer)
+
+    def dispatch(self, v1handler, v2handler, peer, version, msg_type, msg,
+                 wait=True):
+        """
+        Decode a message returned by the inflate() method of the handler
+        of its version, or queue it for decoding. wait is passed to
+        BoundedQueue.put().
+        """
+        if self.decode_queue is None:
+            if version == 1:
+                return v1handler.dispatch(msg, self.json_dump, self.print_all)
+            return v2handler.dispatch(msg_type, msg, self.json_dump,
+                                      self.print_all)
+        if not msg:
+            return
+        if version == 1:
+            self.decode_queue.put((v1handler, 1, TCPMsgType.JSON, msg), peer,
+                                  wait)
+        else:
+            # The message may be a view into the buffer of the reader.
+            self.decode_queue.put((v2handler, 2, msg_type, bytes(msg)), peer,
+                                  wait)
+
+    def start_inflate_pool(self):
+        """
+        Start the decompression threads if inflate_threads was given.
+        Called by run_async().
+        """
+        if not self.inflate_threads or self.inflate_pool is not None:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        self.inflate_pool = ThreadPoolExecutor(self.inflate_threads)
+
+    def start_metrics(self):
+        """
+        Start serving the metrics if metrics_port was given. Called by
+        run() and run_async().
+        """
+        if self.metrics_server is not None and self.metrics_server.httpd is None:
+            self.metrics_server.start()
+
+    def get_message(self, reader, peer=None, handlers=None):
         """
         Handle a received TCP message.
 
-        @type conn: socket
-        @param conn: The TCP connection
+        @type reader: FrameReader
+        @param reader: Reads messages from the TCP connection.
+        @type peer: tuple
+        @param peer: The address of the router, recorded in captures.
+        @type handlers: tuple
+        @param handlers: The (v1handler, v2handler) of the connection. The
+            handlers of the client are used by default.
         """
         #TODO: this method should yield messages.
-        logger.info("Getting TCP message")
-
-        # v1 message header (from XR6.0) consists of just a 4-byte length
-        # v2 message header (from XR6.1 onwards) consists of 3 4-byte fields:
-        #     Type,Flags,Length
-        # If the first 4 bytes read is <=4 then it is too small to be a
-        # valid length. Assume it is v2 instead
-        t = conn.recv(4)
-        msg_type = unpack_int(t)
-        if msg_type > 4: # V1 message - compressed JSON
-            handler = v1handler
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Getting TCP message")
+        if handlers is None:
+            handlers = self.v1handler, self.v2handler
+        version, msg_type, flags, payload = reader.read_frame()
+        return self.handle_frame(handlers[0], handlers[1], peer,
+                                 version, msg_type, flags, payload)
+
+    def handle_frame(self, v1handler, v2handler, peer, version, msg_type,
+                     flags, payload, wait=True):
+        """
+        Pass the payload of a TCP frame to the handler of its version,
+        recording it first if a capture file is open. See dispatch() for
+        wait.
+        """
+        self.record_frame(peer, version, msg_type, flags, payload)
+        if version == 1: # V1 message - compressed JSON
+            msg = v1handler.inflate(payload)
         else:
-            handler = v2handler
+            msg = v2handler.inflate(msg_type, flags, payload)
+        return self.dispatch(v1handler, v2handler, peer, version, msg_type,
+                             msg, wait)
 
-        # V2 message
-        return handler.get_message(msg_type, conn,
-                                   json_dump=self.json_dump,
-                                   print_all=self.print_all)
+    def record_frame(self, peer, version, msg_type, flags, payload):
+        """
+        Write a received TCP frame to the capture file, if one is open,
+        and count it in the metrics.
+        """
+        if self.capture is not None:
+            self.capture.write_tcp(peer, version, msg_type, flags, payload)
+        if self.metrics is not None:
+            peer_metrics = self.metrics.peer(peer)
+            peer_metrics.bytes.inc(len(payload))
+            peer_metrics.messages.inc()
+
+    def offload_inflate(self, version, flags, payload):
+        """
+        Returns True if the given frame should be decompressed on the
+        inflate pool.
+        """
+        if self.inflate_pool is None or len(payload) < self.inflate_min_size:
+            return False
+        return version == 1 or flags & TCP_FLAG_ZLIB_COMPRESSION != 0
+
+    def handle_udp_message(self, address, raw_message):
+        """
+        Decode a UDP message, recording it first if a capture file is open.
+        """
+        if self.capture is not None:
+            self.capture.write_udp(address, raw_message)
+        if self.metrics is not None:
+            peer_metrics = self.metrics.peer(address)
+            peer_metrics.bytes.inc(len(raw_message))
+            peer_metrics.messages.inc()
+        if self.decode_queue is not None:
+            self.decode_queue.put((None, 0, TCPMsgType.GPB_COMPACT,
+                                   bytes(raw_message)), address)
+            return
+        self._decode_udp(raw_message, address)
+
+    def _decode_udp(self, raw_message, address):
+        # All UDP packets contain compact GPB messages
+        if self.decode_pool is not None:
+            self.decode_pool.submit(address,
+                                    TCPMsgType.GPB_COMPACT,
+                                    bytes(raw_message))
+            return
+        if self.callback is not None:
+            message = bytes(raw_message)
+            if self.metrics is None:
+                return self.callback(TCPMsgType.GPB_COMPACT, message, address)
+            start = timer()
+            self.callback(TCPMsgType.GPB_COMPACT, message, address)
+            self.metrics.sink.observe(timer() - start)
+            return
+        self.gpbdecoder.decode_compact(raw_message,
+                                       json_dump=self.json_dump,
+                                       print_all=self.print_all)
 
     def _tcp_loop(self, tcp_sock):
         """
@@ -252,11 +734,27 @@ class TMClient(object):
             logger.info("Waiting for TCP connection")
             conn, addr = tcp_sock.accept()
             logger.info("Got TCP connection")
-            try:
-                while True:
-                     self.get_message(conn)
-            except Exception as e:
-                logger.error("Failed to get TCP message. Attempting to reopen connection: {}".format(e))
+            thread = threading.Thread(target=self._tcp_session,
+                                      args=(conn, addr))
+            thread.daemon = True
+            thread.start()
+
+    def _tcp_session(self, conn, addr):
+        # Every connection has its own handlers, so that the compression
+        # state of one session never leaks into another.
+        reader = FrameReader(conn, metrics=self.metrics)
+        if self.metrics is not None:
+            self.metrics.session_opened(addr)
+        handlers = self.create_v1handler(addr), self.create_v2handler(addr)
+        try:
+            while True:
+                 self.get_message(reader, addr, handlers)
+        except Exception as e:
+            logger.error("Failed to get TCP message. Closing connection: {}".format(e))
+        finally:
+            conn.close()
+            if self.metrics is not None:
+                self.metrics.session_closed(addr)
 
     def _udp_loop(self, udp_sock):
         """
@@ -264,25 +762,108 @@ class TMClient(object):
         """
         #TODO: this method should provide a callback for retrieving messages.
         while True:
-            logger.info("Waiting for UDP message")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Waiting for UDP message")
+            start = timer()
             raw_message, address = udp_sock.recvfrom(2**16)
-            # All UDP packets contain compact GPB messages
-            gpbdecoder.decode_compact(raw_message,
-                                      json_dump=self.json_dump,
-                                      print_all=self.print_all)
+            if self.metrics is not None:
+                self.metrics.recv.observe(timer() - start)
+            self.handle_udp_message(address, raw_message)
+
+    def start_udp(self, udp_sock):
+        """
+        Start receiving UDP messages, either on a thread reading udp_sock
+        or, if udp_processes was given, on UDPIngest worker processes.
+        The workers decode and print the messages themselves, unless there
+        is a callback or a decode pool to pass them to; then they forward
+        them to this process.
+        """
+        if not self.udp_processes:
+            udp_thread = threading.Thread(target=self._udp_loop,
+                                          args=(udp_sock,))
+            udp_thread.daemon = True
+            udp_thread.start()
+            return
+
+        from .udp import UDPIngest
+        deliver = None
+        if self.callback is not None or self.decode_processes:
+            deliver = self.handle_udp_message
+        self.udp_ingest = UDPIngest(self.ipaddress, self.port,
+                                    self.protos,
+                                    self.proto_output_dir,
+                                    self.proto_include_dir,
+                                    processes=self.udp_processes,
+                                    rcvbuf=self.udp_rcvbuf,
+                                    json_dump=self.json_dump,
+                                    print_all=self.print_all,
+                                    deliver=deliver)
+        self.udp_ingest.start()
 
     def run(self):
-        tcp_sock, udp_sock = open_sockets(self.ipaddress, self.port)
+        self.start_metrics()
+        self.start_decode_pool()
+        self.start_decode_queue()
+        tcp_sock, udp_sock = open_sockets(self.ipaddress, self.port,
+                                          udp=not self.udp_processes)
         tcp_thread = threading.Thread(target=self._tcp_loop, args=(tcp_sock,))
         tcp_thread.daemon = True
         tcp_thread.start()
-
-        udp_thread = threading.Thread(target=self._udp_loop, args=(udp_sock,))
-        udp_thread.daemon = True
-        udp_thread.start()
+        self.start_udp(udp_sock)
 
         while True:
             try:
                 time.sleep(60)
             except KeyboardInterrupt:
+                self.close_capture()
                 return
+            if self.udp_ingest is not None:
+                self.udp_ingest.report()
+
+    def run_async(self, loop=None):
+        """
+        Like run(), but serves TCP connections from a single asyncio event
+        loop, so that any number of routers can stream concurrently. UDP
+        is still received on a separate thread.
+        """
+        from .aio import AsyncTCPServer
+        self.start_metrics()
+        self.start_decode_pool()
+        self.start_decode_queue()
+        self.start_inflate_pool()
+        tcp_sock, udp_sock = open_sockets(self.ipaddress, self.port,
+                                          udp=not self.udp_processes)
+        self.start_udp(udp_sock)
+
+        server = AsyncTCPServer(self, loop=loop)
+        if self.udp_ingest is not None:
+            def report():
+                self.udp_ingest.report()
+                server.loop.call_later(60, report)
+            server.loop.call_later(60, report)
+        try:
+            server.serve_forever(tcp_sock)
+        except KeyboardInterrupt:
+            self.close_capture()
+            return
+
+    def close_capture(self):
+        """
+        Finish the capture file, if one is open.
+        """
+        if self.capture is not None:
+            self.capture.close()
+
+    def replay(self, filename, speed=1.0):
+        """
+        Decode the frames recorded in a capture file instead of listening
+        on the network. See telemetric.capture.replay() for speed.
+        Returns the number of frames replayed.
+        """
+        self.start_decode_pool()
+        self.start_decode_queue()
+        with CaptureReader(filename) as reader:
+            count = replay(reader, self, speed=speed)
+        if self.decode_queue is not None:
+            self.decode_queue.join()
+        return count
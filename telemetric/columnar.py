@@ -0,0 +1,260 @@
+from __future__ import absolute_import
+import time
+import threading
+import weakref
+from google.protobuf.descriptor import FieldDescriptor
+from .protoutil import is_repeated
+from .gpb import iter_kv_leaves
+from .series import kv_node
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Column types for the scalar fields of compact rows.
+FIELD_DTYPES = {
+    FieldDescriptor.TYPE_DOUBLE: 'float64',
+    FieldDescriptor.TYPE_FLOAT: 'float32',
+    FieldDescriptor.TYPE_INT32: 'int32',
+    FieldDescriptor.TYPE_INT64: 'int64',
+    FieldDescriptor.TYPE_UINT32: 'uint32',
+    FieldDescriptor.TYPE_UINT64: 'uint64',
+    FieldDescriptor.TYPE_SINT32: 'int32',
+    FieldDescriptor.TYPE_SINT64: 'int64',
+    FieldDescriptor.TYPE_FIXED32: 'uint32',
+    FieldDescriptor.TYPE_FIXED64: 'uint64',
+    FieldDescriptor.TYPE_SFIXED32: 'int32',
+    FieldDescriptor.TYPE_SFIXED64: 'int64',
+    FieldDescriptor.TYPE_BOOL: 'bool',
+    FieldDescriptor.TYPE_ENUM: 'int32',
+    FieldDescriptor.TYPE_STRING: 'object',
+    FieldDescriptor.TYPE_BYTES: 'object',
+}
+
+# Column types for the values of key-value leaves, by oneof member.
+KV_DTYPES = {
+    'bytes_value': 'object',
+    'string_value': 'object',
+    'bool_value': 'bool',
+    'uint32_value': 'uint32',
+    'uint64_value': 'uint64',
+    'sint32_value': 'int32',
+    'sint64_value': 'int64',
+    'double_value': 'float64',
+    'float_value': 'float32',
+}
+
+TIMESTAMP_COLUMN = 'timestamp'
+NODE_COLUMN = 'node'
+
+def _scalar_fields(descriptor, prefix=''):
+    """
+    Yields (column_name, attribute_names, dtype) for the scalar fields of a
+    message, descending into non-repeated sub-messages. Repeated fields are
+    not representable as a column and are skipped.
+    """
+    for field in descriptor.fields:
+        if is_repeated(field):
+            continue
+        name = prefix + field.name
+        if field.type == FieldDescriptor.TYPE_MESSAGE:
+            for column, attrs, dtype in _scalar_fields(field.message_type,
+                                                       name + '.'):
+                yield column, (field.name,) + attrs, dtype
+        else:
+            yield name, (field.name,), FIELD_DTYPES[field.type]
+
+class ColumnBatch(object):
+    """
+    The rows collected for one schema path, as one NumPy array per column.
+    The "timestamp" and "node" columns are always present.
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[TIMESTAMP_COLUMN])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+class _ColumnBuffer(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.columns = {}
+        self.size = 0
+        self.created = time.time()
+        self.add_column(TIMESTAMP_COLUMN, 'uint64')
+        self.add_column(NODE_COLUMN, 'object')
+
+    def add_column(self, name, dtype):
+        column = numpy.zeros(self.capacity, dtype=dtype)
+        if dtype == 'object':
+            column[:] = None
+        self.columns[name] = column
+        return column
+
+    def to_batch(self, path):
+        size = self.size
+        if size == self.capacity:
+            columns = self.columns
+        else:
+            # Do not keep the unused part of the buffer alive.
+            columns = dict((name, column[:size].copy())
+                           for name, column in self.columns.items())
+        return ColumnBatch(path, columns)
+
+class ColumnarBatcher(object):
+    """
+    Collects decoded compact rows and key-value entries into columnar
+    buffers, one per schema path, and passes them on as ColumnBatch
+    objects. A buffer is flushed when it holds max_rows rows, or when its
+    first row is older than max_delay milliseconds; a background thread
+    flushes the buffers of idle streams on time.
+
+    Compact rows are copied from the protobuf objects straight into typed
+    arrays. Each key-value entry (top-level field) becomes one row whose
+    columns are the key paths of its leaves. Cells of a row that lacks a
+    column hold 0, False or None.
+    """
+
+    def __init__(self, callback, max_rows=10000, max_delay=1000):
+        """
+        @type callback: callable
+        @param callback: Called as callback(batch) with each ColumnBatch,
+            from the thread that adds the rows or from the flush thread.
+        @type max_rows: int
+        @param max_rows: The number of rows per batch.
+        @type max_delay: int
+        @param max_delay: The maximum time in milliseconds a row waits to
+            be flushed. If infinite, no flush thread is started, and rows
+            are only flushed when a batch is full or flush() is called.
+        """
+        if numpy is None:
+            raise ImportError("ColumnarBatcher requires numpy")
+        self.callback = callback
+        self.max_rows = max_rows
+        self.max_delay = max_delay / 1000.0
+        self.buffers = {}
+        self.row_fields = weakref.WeakKeyDictionary()
+        self.lock = threading.RLock()
+        self.closed = threading.Event()
+        self.thread = None
+        if self.max_delay != float('inf'):
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        # Wake up when the oldest buffer expires.
+        while True:
+            with self.lock:
+                created = [buf.created for buf in self.buffers.values()]
+            timeout = self.max_delay
+            if created:
+                timeout = max(min(created) + self.max_delay - time.time(), 0)
+            if self.closed.wait(timeout):
+                return
+            self.flush_expired()
+
+    def _get_buffer(self, path):
+        buf = self.buffers.get(path)
+        if buf is None:
+            buf = self.buffers[path] = _ColumnBuffer(self.max_rows)
+        return buf
+
+    def _row_added(self, path, buf):
+        buf.size += 1
+        if buf.size >= self.max_rows:
+            self.flush(path)
+
+    def add_compact(self, message):
+        """
+        Add the rows of a CompactMessage (see
+        GPBDecoder.decode_compact_lazy()). Tables without a known schema
+        are skipped.
+        """
+        node = message.identifier
+        timestamp = message.end_time or message.start_time
+        with self.lock:
+            for table in message.tables:
+                row_class = table.row_class
+                if row_class is None:
+                    continue
+                fields = self.row_fields.get(row_class)
+                if fields is None:
+                    fields = list(_scalar_fields(row_class.DESCRIPTOR))
+                    self.row_fields[row_class] = fields
+                path = table.policy_path
+                for row in table:
+                    buf = self._get_buffer(path)
+                    columns = buf.columns
+                    index = buf.size
+                    columns[TIMESTAMP_COLUMN][index] = timestamp
+                    columns[NODE_COLUMN][index] = node
+                    for name, attrs, dtype in fields:
+                        column = columns.get(name)
+                        if column is None:
+                            column = buf.add_column(name, dtype)
+                        value = row
+                        for attr in attrs:
+                            value = getattr(value, attr)
+                        column[index] = value
+                    self._row_added(path, buf)
+            self.flush_expired()
+
+    def add_kv(self, header, peer=None):
+        """
+        Add the entries of a key-value Telemetry message (see
+        GPBDecoder.parse_kv()) from the given peer. Their node is the
+        subscription identifier qualified with the peer (see kv_node()).
+        """
+        path = header.base_path
+        node = kv_node(header.subscription_identifier, peer)
+        with self.lock:
+            for entry in header.fields:
+                buf = self._get_buffer(path)
+                columns = buf.columns
+                index = buf.size
+                columns[TIMESTAMP_COLUMN][index] = entry.timestamp or header.msg_timestamp
+                columns[NODE_COLUMN][index] = node
+                for key_path, value_name, value, timestamp \
+                  in iter_kv_leaves(entry):
+                    column = columns.get(key_path)
+                    if column is None:
+                        column = buf.add_column(key_path, KV_DTYPES[value_name])
+                    column[index] = value
+                self._row_added(path, buf)
+            self.flush_expired()
+
+    def flush(self, path=None):
+        """
+        Pass on the rows of the given schema path, or of all schema paths.
+        """
+        with self.lock:
+            paths = list(self.buffers) if path is None else [path]
+            for path in paths:
+                buf = self.buffers.pop(path, None)
+                if buf is not None and buf.size:
+                    self.callback(buf.to_batch(path))
+
+    def flush_expired(self):
+        """
+        Pass on the rows of all buffers older than max_delay.
+        """
+        with self.lock:
+            deadline = time.time() - self.max_delay
+            for path, buf in list(self.buffers.items()):
+                if buf.created <= deadline:
+                    self.flush(path)
+
+    def close(self):
+        """
+        Stop the flush thread and pass on all buffered rows.
+        """
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+try:
+    from collections.abc import Sequence
+except ImportError: # Python 2
+    from collections import Sequence
+
+_unresolved = object()
+
+class CompactTable(Sequence):
+    """
+    The rows of one TelemetryTable. Rows are only parsed when they are
+    accessed, and each row is parsed at most once.
+    """
+
+    def __init__(self, decoder, policy_path, rows):
+        """
+        @type decoder: GPBDecoder
+        @param decoder: Provides the row class for the policy path.
+        @type policy_path: str
+        @param policy_path: The schema path of the table.
+        @type rows: list(bytes)
+        @param rows: The serialized rows.
+        """
+        self.decoder = decoder
+        self.policy_path = policy_path
+        self.raw_rows = rows
+        self._row_class = _unresolved
+        self._rows = [None] * len(rows)
+
+    @property
+    def row_class(self):
+        """
+        The protobuf class of the rows, or None if the schema is unknown.
+        """
+        if self._row_class is _unresolved:
+            self._row_class = self.decoder.get_row_class(self.policy_path)
+        return self._row_class
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        row = self._rows[index]
+        if row is not None:
+            return row
+        row_class = self.row_class
+        if row_class is None:
+            raise ValueError("No decoder available for schema path {}".format(
+                             self.policy_path))
+        row = row_class()
+        row.ParseFromString(self.raw_rows[index])
+        self._rows[index] = row
+        return row
+
+class CompactMessage(object):
+    """
+    A GPB compact message whose header fields are available right away,
+    while the rows of its tables are parsed on demand.
+    """
+
+    def __init__(self, decoder, header):
+        """
+        @type decoder: GPBDecoder
+        @param decoder: Provides the row classes.
+        @type header: TelemetryHeader
+        @param header: The parsed message header.
+        """
+        self.header = header
+        self.encoding = header.encoding
+        self.policy_name = header.policy_name
+        self.version = header.version
+        self.identifier = header.identifier
+        self.start_time = header.start_time
+        self.end_time = header.end_time
+        self.tables = [CompactTable(decoder, t.policy_path, t.row)
+                       for t in header.tables]
+
+    def find_tables(self, policy_path):
+        """
+        Returns the tables with the given policy path.
+        """
+        return [t for t in self.tables if t.policy_path == policy_path]
@@ -0,0 +1,261 @@
+from __future__ import absolute_import
+import sys
+import threading
+import weakref
+from array import array
+from .client import TCPMsgType
+from .series import Sample, iter_compact_samples, iter_kv_samples, kv_node
+
+if sys.version_info[0] >= 3:
+    long = int
+    # hash() returns a Py_ssize_t.
+    _HASH_TYPECODE = 'q'
+else:
+    # hash() returns a C long, and there is no array('q').
+    _HASH_TYPECODE = 'l'
+
+# How values are kept: numbers that a double holds exactly and booleans
+# in the values array, other values (short strings, big integers) as they
+# are, and long strings and bytes as their type, length and hash.
+_FLOAT = 0
+_INT = 1
+_BOOL = 2
+_OBJECT = 3
+_DIGEST = 4
+_EXACT = 2**53
+_STRINGS = (bytes, type(u''))
+
+# Strings and bytes longer than this are only kept as a hash.
+MAX_VALUE_SIZE = 64
+
+def _encode(value):
+    # Returns the kind of a value, its number and its object.
+    if isinstance(value, bool):
+        return _BOOL, int(value), None
+    if isinstance(value, float):
+        return _FLOAT, value, None
+    if isinstance(value, (int, long)) and -_EXACT <= value <= _EXACT:
+        return _INT, value, None
+    if isinstance(value, _STRINGS) and len(value) > MAX_VALUE_SIZE:
+        return _DIGEST, 0, (type(value), len(value), hash(value))
+    return _OBJECT, 0, value
+
+class ChangeFilter(object):
+    """
+    Drops samples whose value did not change since the previous sample of
+    the same series, e.g. the admin status of an interface or the counters
+    of an idle one. Every series is still forwarded after heartbeat
+    suppressed samples in a row, so that consumers can tell that it is
+    alive.
+
+    The last value of each series, identified by (node, path), is kept in
+    a table of at most max_entries series. Series are stored by the hash
+    of (node, path), so an entry takes a fixed amount of memory however
+    long its path is. Values are compared exactly, including their type
+    (1, 1.0 and True differ), except for strings and bytes longer than
+    MAX_VALUE_SIZE, which are compared by type, length and hash. When
+    the table is full, a series is evicted with the CLOCK algorithm:
+    series that were seen since the clock hand last passed them get a
+    second chance. The next sample of an evicted series is forwarded.
+
+    Hash collisions can make two series share an entry or hide a change
+    of a long string; with 64-bit hashes this is rare enough to ignore.
+    """
+
+    def __init__(self, callback, max_entries=1000000, heartbeat=10):
+        """
+        @type callback: callable
+        @param callback: Called as callback(samples) with a list of the
+            Sample tuples of a message that are forwarded.
+        @type max_entries: int
+        @param max_entries: The maximum number of series remembered.
+        @type heartbeat: int
+        @param heartbeat: Forward an unchanged series after this many
+            suppressed samples; 0 suppresses it forever.
+        """
+        if max_entries < 1:
+            raise ValueError("max_entries must be positive")
+        self.callback = callback
+        self.max_entries = max_entries
+        self.heartbeat = heartbeat
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.row_fields = weakref.WeakKeyDictionary()
+        self.hand = 0
+
+        # Per slot state.
+        self.keys = array(_HASH_TYPECODE)
+        self.values = array('d')
+        self.kinds = bytearray()
+        self.objects = {}
+        self.suppressed = array('L')
+        self.referenced = bytearray()
+
+        self.hits = 0
+        self.misses = 0
+        self.changes = 0
+        self.heartbeats = 0
+        self.dropped = 0
+        self.evictions = 0
+
+    def _evict(self):
+        # Advance the hand past referenced slots, clearing their bit.
+        referenced = self.referenced
+        size = len(self.keys)
+        hand = self.hand
+        while referenced[hand]:
+            referenced[hand] = 0
+            hand = (hand + 1) % size
+        self.hand = (hand + 1) % size
+        del self.slots[self.keys[hand]]
+        self.objects.pop(hand, None)
+        self.evictions += 1
+        return hand
+
+    def _store(self, slot, kind, number, obj):
+        self.kinds[slot] = kind
+        self.values[slot] = number
+        if kind >= _OBJECT:
+            self.objects[slot] = obj
+        else:
+            self.objects.pop(slot, None)
+
+    def _filter(self, node, path, value):
+        key = hash((node, path))
+        kind, number, obj = _encode(value)
+        slot = self.slots.get(key)
+        if slot is None:
+            self.misses += 1
+            if len(self.keys) < self.max_entries:
+                slot = len(self.keys)
+                self.keys.append(key)
+                self.values.append(0)
+                self.kinds.append(kind)
+                self.suppressed.append(0)
+                self.referenced.append(1)
+            else:
+                slot = self._evict()
+                self.keys[slot] = key
+                self.suppressed[slot] = 0
+                self.referenced[slot] = 1
+            self._store(slot, kind, number, obj)
+            self.slots[key] = slot
+            return True
+
+        self.hits += 1
+        self.referenced[slot] = 1
+        if kind != self.kinds[slot] or (self.objects[slot] != obj
+                                        if kind >= _OBJECT
+                                        else self.values[slot] != number):
+            self._store(slot, kind, number, obj)
+            self.suppressed[slot] = 0
+            self.changes += 1
+            return True
+        suppressed = self.suppressed[slot] + 1
+        if suppressed == self.heartbeat:
+            self.suppressed[slot] = 0
+            self.heartbeats += 1
+            return True
+        self.suppressed[slot] = suppressed
+        self.dropped += 1
+        return False
+
+    def filter(self, node, path, value):
+        """
+        Returns whether a sample should be forwarded, and remembers its
+        value.
+        """
+        with self.lock:
+            return self._filter(node, path, value)
+
+    def _forward(self, node, samples):
+        with self.lock:
+            forwarded = [Sample(node, path, timestamp, value)
+                         for path, value, timestamp, wrap in samples
+                         if self._filter(node, path, value)]
+        if forwarded:
+            self.callback(forwarded)
+
+    def add_compact(self, message, node=None):
+        """
+        Filter the fields of the rows of a CompactMessage (see
+        GPBDecoder.decode_compact_lazy()), including state fields like
+        strings and enums. node defaults to the identifier of the message.
+        """
+        self._forward(node or message.identifier,
+                      iter_compact_samples(message, self.row_fields,
+                                           states=True))
+
+    def add_kv(self, header, node=None, peer=None):
+        """
+        Filter the leaves of a key-value Telemetry message (see
+        GPBDecoder.parse_kv()) from the given peer. node defaults to
+        the subscription identifier qualified with the peer (see
+        kv_node()).
+        """
+        self._forward(node or kv_node(header.subscription_identifier, peer),
+                      iter_kv_samples(header, states=True))
+
+    def add_message(self, decoder, msg_type, payload, node=None,
+                    peer=None):
+        """
+        Decode a compact or key-value message with the given GPBDecoder
+        and filter it, e.g. from the callback of a TMClient. Other
+        messages are ignored. peer is the one passed to the callback.
+        """
+        if msg_type == TCPMsgType.GPB_COMPACT:
+            self.add_compact(decoder.decode_compact_lazy(payload), node)
+        elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+            self.add_kv(decoder.parse_kv(payload), node, peer)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def memory_size(self):
+        """
+        Returns the approximate number of bytes used by the table.
+        """
+        return (sys.getsizeof(self.slots) + sys.getsizeof(self.objects) +
+                sum(sys.getsizeof(column)
+                    for column in (self.keys, self.values, self.kinds,
+                                   self.suppressed, self.referenced)))
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.slots),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hit_ratio,
+                    'changes': self.changes,
+                    'heartbeats': self.heartbeats,
+                    'suppressed': self.dropped,
+                    'evictions': self.evictions,
+                    'memory_bytes': self.memory_size()}
+
+    def register_metrics(self, registry):
+        """
+        Add the statistics of the filter to a MetricsRegistry.
+        """
+        r = registry
+        r.gauge('telemetric_dedup_entries',
+                'Series remembered by the change filter') \
+         .labels().set_function(lambda: len(self.slots))
+        r.gauge('telemetric_dedup_memory_bytes',
+                'Approximate memory used by the change filter') \
+         .labels().set_function(self.memory_size)
+        r.gauge('telemetric_dedup_hit_ratio',
+                'Share of samples whose series was remembered') \
+         .labels().set_function(lambda: self.hit_ratio)
+        samples = r.gauge('telemetric_dedup_samples',
+                          'Samples seen by the change filter, by outcome',
+                          ('result',))
+        for result, attr in (('hit', 'hits'),
+                             ('miss', 'misses'),
+                             ('change', 'changes'),
+                             ('heartbeat', 'heartbeats'),
+                             ('suppressed', 'dropped'),
+                             ('eviction', 'evictions')):
+            samples.labels(result).set_function(
+                lambda attr=attr: getattr(self, attr))
@@ -0,0 +1,367 @@
+from __future__ import absolute_import
+import io
+import os
+import csv
+import json
+import gzip
+import zlib
+import time
+import logging
+import datetime
+import threading
+from collections import deque
+from .queues import BLOCK, DROP_OLDEST, DROP_NEWEST
+
+logger = logging.getLogger()
+
+def _as_dict(record):
+    # Records are dicts or namedtuples like Sample and Aggregate.
+    if hasattr(record, '_asdict'):
+        return record._asdict()
+    return record
+
+class NDJSONFormat(object):
+    """
+    One JSON object per line.
+    """
+    extension = '.ndjson'
+
+    def header(self):
+        return b''
+
+    def encode(self, record):
+        return (json.dumps(_as_dict(record), default=str) + '\n').encode('utf-8')
+
+class CSVFormat(object):
+    """
+    Comma-separated values with a header line in every file. The columns
+    default to the fields of the first record; other fields are ignored,
+    and values that are not scalars are written as JSON.
+    """
+    extension = '.csv'
+
+    def __init__(self, columns=None):
+        self.columns = list(columns) if columns else None
+
+    def header(self):
+        if self.columns is None:
+            return b''
+        return self._row(self.columns)
+
+    def _row(self, values):
+        buf = io.StringIO() if str is not bytes else io.BytesIO()
+        csv.writer(buf, lineterminator='\n').writerow(values)
+        line = buf.getvalue()
+        return line.encode('utf-8') if not isinstance(line, bytes) else line
+
+    def _value(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, default=str)
+        return value
+
+    def encode(self, record):
+        record = _as_dict(record)
+        if self.columns is None:
+            self.columns = list(record)
+        return self._row([self._value(record.get(c)) for c in self.columns])
+
+def _escape_key(value):
+    return str(value).replace('\\', '\\\\').replace(',', r'\,') \
+                     .replace('=', r'\=').replace(' ', r'\ ')
+
+def _field_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        # Signed integers are 64 bit; larger counters are unsigned, and
+        # anything beyond that can only be a float.
+        if -2**63 <= value < 2**63:
+            return '{}i'.format(value)
+        if 0 <= value < 2**64:
+            return '{}u'.format(value)
+        return repr(float(value))
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', r'\"'))
+
+class LineProtocolFormat(object):
+    """
+    The InfluxDB line protocol. The tag fields of a record become tags,
+    its timestamp (in milliseconds, as in telemetry messages) the time in
+    nanoseconds, and its other scalar fields the fields of the point.
+    None and nested values are left out. Integers above the signed 64 bit
+    range, like big uint64 counters, are written as unsigned integers.
+    """
+    extension = '.lp'
+
+    def __init__(self, measurement='telemetric', tags=('node', 'path'),
+                 time_field='timestamp'):
+        self.measurement = _escape_key(measurement)
+        self.tags = tuple(tags)
+        self.time_field = time_field
+
+    def header(self):
+        return b''
+
+    def encode(self, record):
+        record = _as_dict(record)
+        line = [self.measurement]
+        for tag in self.tags:
+            value = record.get(tag)
+            if value not in (None, ''):
+                line.append(',{}={}'.format(_escape_key(tag), _escape_key(value)))
+        fields = ['{}={}'.format(_escape_key(name), _field_value(value))
+                  for name, value in record.items()
+                  if name not in self.tags
+                  and name != self.time_field
+                  and value is not None
+                  and not isinstance(value, (dict, list, tuple))]
+        if not fields:
+            return b''
+        line.append(' ')
+        line.append(','.join(fields))
+        timestamp = record.get(self.time_field)
+        if timestamp:
+            line.append(' {}'.format(int(timestamp) * 1000000))
+        line.append('\n')
+        return ''.join(line).encode('utf-8')
+
+FORMATS = {'ndjson': NDJSONFormat,
+           'csv': CSVFormat,
+           'influx': LineProtocolFormat}
+
+class _ZlibFile(object):
+    # A file object that writes a zlib stream to another one.
+
+    def __init__(self, fileobj, level):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(level)
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+COMPRESSIONS = {'gzip': '.gz', 'zlib': '.zz'}
+
+class FileExporter(object):
+    """
+    Writes records to files in one of the FORMATS, without blocking the
+    caller on the disk: write() only appends the encoded record to a
+    buffer in memory, which a background thread writes out in large
+    chunks once it holds buffer_size bytes, or every flush_interval
+    seconds.
+
+    The output is rotated to a new file once the current one reaches
+    max_bytes or is older than max_age seconds. File names are made from
+    a template with the fields index (counting from 0) and time (a UTC
+    datetime), e.g. "/var/lib/telemetric/{time:%Y%m%d-%H%M%S}.ndjson".
+
+    If the writer falls behind by more than max_buffered bytes, the
+    policy decides what happens (see BoundedQueue): by default further
+    records are dropped and counted in dropped, rather than holding up
+    the decoding thread or growing without bound.
+    """
+
+    def __init__(self, filename, format=None, compression=None, level=6,
+                 max_bytes=None, max_age=None, buffer_size=1024*1024,
+                 flush_interval=1.0, max_buffered=64*1024*1024,
+                 policy=DROP_NEWEST):
+        """
+        @type filename: str
+        @param filename: The file name template.
+        @type format: object
+        @param format: An NDJSONFormat, CSVFormat or LineProtocolFormat
+            instance; defaults to NDJSON.
+        @type compression: str
+        @param compression: None, 'gzip' or 'zlib'.
+        @type max_bytes: int
+        @param max_bytes: Rotate when a file holds this many bytes (as
+            written to disk, i.e. after compression).
+        @type max_age: float
+        @param max_age: Rotate when a file is this many seconds old.
+        @type policy: str
+        @param policy: 'block', 'drop-oldest' or 'drop-newest'.
+        """
+        if policy not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("unsupported export policy: {}".format(policy))
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("unknown compression: {}".format(compression))
+        if (max_bytes or max_age) and '{' not in filename:
+            raise ValueError("rotated file names need {index} or {time}")
+        self.filename = os.path.expanduser(filename)
+        self.format = format or NDJSONFormat()
+        self.compression = compression
+        self.level = level
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.policy = policy
+        self.metrics = None
+
+        self.buffer = deque()
+        self.buffered = 0
+        self.dropped = 0
+        self.written = 0
+        self.files = []
+        self.index = 0
+        self.raw = None
+        self.file = None
+        self.opened = None
+
+        # The decoding threads only take lock; the writer takes
+        # write_lock while it touches the file.
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.space = threading.Condition(self.lock)
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def register_metrics(self, metrics):
+        """
+        Record the buffered records and drops in the given
+        CollectorMetrics, as the "export" queue.
+        """
+        self.metrics = metrics
+        metrics.queue_depth.labels('export').set_function(
+            lambda: len(self.buffer))
+
+    def _queue(self, chunks):
+        with self.lock:
+            if self.policy == BLOCK:
+                while self.buffered >= self.max_buffered and not self.closed:
+                    self.space.wait()
+            elif self.buffered >= self.max_buffered and self.policy == DROP_NEWEST:
+                self._dropped(len(chunks))
+                return
+            self.buffer.extend(chunks)
+            self.buffered += sum(len(chunk) for chunk in chunks)
+            if self.policy == DROP_OLDEST:
+                dropped = 0
+                while self.buffered > self.max_buffered and len(self.buffer) > 1:
+                    self.buffered -= len(self.buffer.popleft())
+                    dropped += 1
+                if dropped:
+                    self._dropped(dropped)
+            if self.buffered >= self.buffer_size:
+                self.ready.notify()
+
+    def _dropped(self, count):
+        self.dropped += count
+        if self.metrics is not None:
+            self.metrics.queue_dropped.labels('export', '', '').inc(count)
+
+    def write(self, record):
+        """
+        Queue a record (a dict or a namedtuple) for writing.
+        """
+        self._queue((self.format.encode(record),))
+
+    def write_all(self, records):
+        """
+        Like write(), for a list of records, e.g. from a ChangeFilter or
+        an Aggregator.
+        """
+        encode = self.format.encode
+        self._queue([encode(record) for record in records])
+
+    def write_raw(self, data):
+        """
+        Queue data that is already encoded, e.g. a JSON message passed
+        through unchanged, followed by a newline. data may be a
+        memoryview; it is copied once.
+        """
+        self._queue((b''.join((data, b'\n')),))
+
+    def _take(self):
+        with self.lock:
+            chunks = self.buffer
+            self.buffer = deque()
+            self.buffered = 0
+            self.space.notify_all()
+        return b''.join(chunks)
+
+    def _open(self):
+        name = self.filename.format(index=self.index,
+                                    time=datetime.datetime.utcnow())
+        if self.compression is not None and not name.endswith(COMPRESSIONS[self.compression]):
+            name += COMPRESSIONS[self.compression]
+        self.index += 1
+        self.raw = open(name, 'wb')
+        if self.compression == 'gzip':
+            self.file = gzip.GzipFile(fileobj=self.raw, mode='wb',
+                                      compresslevel=self.level)
+        elif self.compression == 'zlib':
+            self.file = _ZlibFile(self.raw, self.level)
+        else:
+            self.file = self.raw
+        self.opened = time.time()
+        self.files.append(name)
+        self.file.write(self.format.header())
+
+    def _close_file(self):
+        if self.file is None:
+            return
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.close()
+        self.file = self.raw = None
+
+    def _due(self):
+        if self.max_bytes and self.raw.tell() >= self.max_bytes:
+            return True
+        return bool(self.max_age) and time.time() - self.opened >= self.max_age
+
+    def flush(self):
+        """
+        Write out the buffered records now, from the calling thread.
+        """
+        with self.write_lock:
+            data = self._take()
+            if self.file is not None and self._due():
+                self._close_file()
+            if not data:
+                return
+            if self.file is None:
+                self._open()
+            self.file.write(data)
+            self.raw.flush()
+            self.written += len(data)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.buffered < self.buffer_size and not self.closed:
+                    self.ready.wait(self.flush_interval)
+                closed = self.closed
+            try:
+                self.flush()
+            except Exception as err:
+                logger.error("export to {} failed: {}".format(self.filename,
+                                                              err))
+            if closed:
+                return
+
+    def close(self):
+        """
+        Write out all buffered records and close the current file.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.ready.notify()
+            self.space.notify_all()
+        self.thread.join()
+        with self.write_lock:
+            self._close_file()
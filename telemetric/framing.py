@@ -0,0 +1,138 @@
+from __future__ import absolute_import
+import struct
+from .metrics import timer
+
+_length = struct.Struct(">I")
+_v2_header = struct.Struct(">III")
+
+V1_HEADER_SIZE = _length.size
+V2_HEADER_SIZE = _v2_header.size
+MAX_FRAME_LENGTH = 128 * 1024 * 1024
+
+def parse_header(buf, pos, end, max_length=MAX_FRAME_LENGTH):
+    """
+    Parse the header of the message starting at buf[pos]. Only the bytes
+    up to buf[end] are looked at.
+
+    v1 message header (from XR6.0) consists of just a 4-byte length
+    v2 message header (from XR6.1 onwards) consists of 3 4-byte fields:
+        Type,Flags,Length
+    If the first 4 bytes read is <=4 then it is too small to be a
+    valid length. Assume it is v2 instead.
+
+    Returns a tuple (version, msg_type, flags, start, frame_end), where
+    msg_type and flags are None for v1 messages and buf[start:frame_end] is
+    the payload. Returns None if the header is incomplete.
+    """
+    if end - pos < V1_HEADER_SIZE:
+        return None
+    first = _length.unpack_from(buf, pos)[0]
+    if first > 4:
+        version, msg_type, flags, length = 1, None, None, first
+        start = pos + V1_HEADER_SIZE
+    else:
+        if end - pos < V2_HEADER_SIZE:
+            return None
+        msg_type, flags, length = _v2_header.unpack_from(buf, pos)
+        version = 2
+        start = pos + V2_HEADER_SIZE
+    if length > max_length:
+        raise ValueError("message length {} exceeds the maximum of {}".format(
+                         length, max_length))
+    return version, msg_type, flags, start, start + length
+
+class FrameReader(object):
+    """
+    Reads v1 and v2 messages from a TCP connection into a reusable buffer.
+    Data is received with recv_into(), so payloads are never assembled by
+    concatenation, and a partial header or payload is simply completed by
+    the next receive.
+    """
+
+    def __init__(self, conn, size=64*1024, max_length=MAX_FRAME_LENGTH,
+                 metrics=None):
+        """
+        @type conn: socket
+        @param conn: The TCP connection.
+        @type size: int
+        @param size: The initial buffer size. The buffer grows as needed.
+        @type max_length: int
+        @param max_length: Messages larger than this are rejected.
+        @type metrics: CollectorMetrics
+        @param metrics: If given, the recv and framing stages are timed.
+        """
+        self.conn = conn
+        self.metrics = metrics
+        self.recv_time = 0
+        self.max_length = max_length
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def _make_room(self, needed):
+        """
+        Ensure that the buffer can hold the given number of bytes starting
+        at self.start, moving or reallocating the pending data.
+        """
+        pending = self.end - self.start
+        if needed > len(self.buffer):
+            size = max(needed, 2 * len(self.buffer))
+            buf = bytearray(size)
+            buf[:pending] = self.view[self.start:self.end]
+            self.buffer = buf
+            self.view = memoryview(buf)
+        else:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def _fill(self, needed):
+        """
+        Receive until at least the given number of bytes are pending.
+        """
+        if self.start + needed > len(self.buffer):
+            self._make_room(needed)
+        while self.end - self.start < needed:
+            if self.metrics is None:
+                received = self.conn.recv_into(self.view[self.end:])
+            else:
+                start = timer()
+                received = self.conn.recv_into(self.view[self.end:])
+                elapsed = timer() - start
+                self.metrics.recv.observe(elapsed)
+                self.recv_time += elapsed
+            if received == 0:
+                raise EOFError("connection closed by peer")
+            self.end += received
+
+    def read_frame(self):
+        """
+        Receive the next message.
+
+        Returns a tuple (version, msg_type, flags, payload), where payload
+        is a memoryview into the receive buffer. The view is only valid
+        until the next call to read_frame(); copy it to keep it.
+        """
+        if self.metrics is not None:
+            started = timer()
+            self.recv_time = 0
+        while True:
+            header = parse_header(self.buffer, self.start, self.end,
+                                  self.max_length)
+            if header is not None:
+                break
+            self._fill(self.end - self.start + 1)
+        version, msg_type, flags, start, frame_end = header
+        header_size = start - self.start
+        frame_size = frame_end - self.start
+        self._fill(frame_size)
+
+        # _fill() may have moved the pending data to the buffer start.
+        payload = self.view[self.start+header_size:self.start+frame_size]
+        self.start += frame_size
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.metrics is not None:
+            self.metrics.framing.observe(timer() - started - self.recv_time)
+        return version, msg_type, flags, payload
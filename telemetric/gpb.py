@@ -1,51 +1,17 @@
 from __future__ import print_function, absolute_import
 import os
 import sys
-import imp
 import json
-import re
 from google.protobuf.message import Message
 from google.protobuf.descriptor import FieldDescriptor
-from .protoutil import compile_proto_file, field_type_to_fn, proto_to_dict
+from .protoutil import compile_protos, compile_converter, proto_to_dict, \
+                       is_repeated
 from .util import print_indent, timestamp_to_string, bytes_to_string
-
-def _parse_schema_from_proto(input_file):
-    """
-    Find the schema path and corresponding message definition in a .proto file
-    """
-    message_re = re.compile(r'^message (\S+)')
-    schema_path_re = re.compile(r'.*schema_path = "(\S+)"')
-    message_name = None
-    schema_path = None
-
-    with open(input_file) as f:
-        for line in f.readlines():
-            # Look for the first instance of the string "message <message_name>"
-            if message_name is None:
-                match = message_re.match(line)
-                if match:
-                    message_name = match.group(1)
-                continue
-
-            # Look for "...schema_path = <schema_path>"
-            match = schema_path_re.search(line)
-            if match:
-                schema_path = match.group(1)
-                break
-
-    return schema_path, message_name
-
-def _load_modules(filenames):
-    modules = {}
-    for filename in filenames:
-        dirname = os.path.dirname(filename)
-        if dirname not in sys.path:
-            sys.path.append(dirname)
-        basename = os.path.basename(filename)
-        module_name, ext = os.path.splitext(basename)
-        module = imp.load_source(module_name, filename)
-        modules[module_name] = module
-    return modules
+from .compact import CompactMessage
+from .metrics import timer
+from .schema import SchemaRegistry, load_modules
+from .projection import as_buffer, compile_scanner, compile_kv_paths, \
+                        iter_compact_rows, iter_kv_entries
 
 def print_compact_hdr(header):
     """
@@ -79,12 +45,12 @@ def print_compact_msg(field, indent, print_all=True):
             # If the value is a sub-message then recursively call this function
             # to decode it. If the message is repeated then iterate over each
             # item.
-            if descriptor.label == descriptor.LABEL_REPEATED:
+            if is_repeated(descriptor):
                 print_indent(indent, "{} ({} items) [", descriptor.name, len(value))
                 for i, item in enumerate(value):
                     print_indent(indent, "{} {} {{", descriptor.name, i)
-                    self.print_compact_msg(item, indent+1, print_all=print_all)
-                    print_indent(indent, "}")
+                    print_compact_msg(item, indent+1, print_all=print_all)
+                    print_indent(indent, "}}")
                     if not print_all:
                         # Stop after the first item unless all have been
                         # requested
@@ -93,10 +59,10 @@ def print_compact_msg(field, indent, print_all=True):
             else:
                 print_indent(indent, "{} {{", descriptor.name)
                 print_compact_msg(value, indent+1, print_all=print_all)
-                print_at_indent(indent, "}")
+                print_indent(indent, "}}")
         elif descriptor.type == descriptor.TYPE_ENUM:
             # For enum types print the enum name
-            enum_name = descriptor.enum_type.values[value].name
+            enum_name = descriptor.enum_type.values_by_number[value].name
             print_indent(indent, "{}: {}", descriptor.name, enum_name)
         elif descriptor.type == descriptor.TYPE_BYTES:
             print_indent(indent, "{}: {}", descriptor.name, bytes_to_string(value))
@@ -137,23 +103,14 @@ def print_kv_field(field, indent):
     time = 0 if field.timestamp == 0 else timestamp_to_string(field.timestamp)
     
     # Find the datatype and print it
-    datatypes = ["bytes_value",
-                 "string_value",
-                 "bool_value",
-                 "uint32_value",
-                 "uint64_value",
-                 "sint32_value",
-                 "sint64_value",
-                 "double_value",
-                 "float_value"]
-    for d in datatypes:
-        datatype = d[:-6]
-        if field.HasField(d):
-            if datatype == "bytes":
-                value = bytes_to_string(field.bytes_value)
-            else:
-                value = getattr(field, d)
-            print_kv_field_data(field.name, value, datatype, time, indent)
+    value_name = field.WhichOneof('value_by_type')
+    if value_name is not None:
+        datatype = value_name[:-6]
+        if datatype == "bytes":
+            value = bytes_to_string(field.bytes_value)
+        else:
+            value = getattr(field, value_name)
+        print_kv_field_data(field.name, value, datatype, time, indent)
 
     # If 'fields' is used then recursively call this function to decode
     if field.fields:
@@ -164,14 +121,87 @@ def print_kv_field(field, indent):
 
         for child in field.fields:
             print_kv_field(child, indent+1)
-        print_indent(indent, "}")
+        print_indent(indent, "}}")
+
+class KeyPathCache(object):
+    """
+    Interns the key paths of key-value leaves. Every collection repeats
+    the same paths, so looking them up by parent path and name returns
+    the same string objects instead of allocating new ones. When more than
+    maxsize paths are cached, the cache is cleared and refilled.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.size = 0
+        self.children = {}
+
+    def join(self, parent, name):
+        """
+        Returns parent + "/" + name, or name if parent is empty.
+        """
+        children = self.children.get(parent)
+        if children is None:
+            children = self.children[parent] = {}
+        else:
+            path = children.get(name)
+            if path is not None:
+                return path
+        if self.size >= self.maxsize:
+            self.clear()
+            children = self.children[parent] = {}
+        path = children[name] = parent + '/' + name if parent else name
+        self.size += 1
+        return path
+
+    def clear(self):
+        self.children = {}
+        self.size = 0
+
+def iter_kv_leaves(field, path='', timestamp=0, paths=None):
+    """
+    Yields (path, value_name, value, timestamp) for each field below the
+    given TelemetryField that has a value, where path is the given path
+    joined with the names of the nested fields by "/", value_name is the
+    oneof member holding the value (e.g. "uint64_value"), and timestamp
+    is that of the closest field that has one. Fields without a name, like
+    the top-level entries of Cisco telemetry, do not add to the path.
+
+    @type paths: KeyPathCache
+    @param paths: If given, joins and interns the paths.
+    """
+    for child in field.fields:
+        name = child.name
+        if not name:
+            child_path = path
+        elif paths is not None:
+            child_path = paths.join(path, name)
+        else:
+            child_path = path + '/' + name if path else name
+        child_timestamp = child.timestamp or timestamp
+        value_name = child.WhichOneof('value_by_type')
+        if value_name is not None:
+            yield (child_path, value_name, getattr(child, value_name),
+                   child_timestamp)
+        if child.fields:
+            for leaf in iter_kv_leaves(child, child_path, child_timestamp,
+                                       paths):
+                yield leaf
 
 class GPBDecoder(object):
-    def __init__(self, protos, output_dir, include_dir):
+    def __init__(self, protos, output_dir, include_dir, lazy_schemas=False,
+                 max_schemas=None):
         """
         Compile the telemetry proto files if they don't already exist and
         create a mapping between policy paths and proto files specified on the 
         command line.
+
+        @type lazy_schemas: bool
+        @param lazy_schemas: If True, the given proto files are only
+            compiled and imported when their schema path first shows up.
+        @type max_schemas: int
+        @param max_schemas: The maximum number of schemas kept loaded; the
+            least recently used ones are unloaded.
         """
         # Build any proto files not already available
         data_dir = os.path.join(os.path.dirname(__file__), 'data')
@@ -180,23 +210,43 @@ class GPBDecoder(object):
                        "telemetry.proto",
                        "telemetry_kv.proto"]
         proto_files = [os.path.join(data_dir, f) for f in proto_files]
-        compiled_files = compile_proto_file(proto_files + protos,
-                                            output_dir,
-                                            include_dir)
-        self.modules = _load_modules(compiled_files)
+        include_dir = [data_dir] + list(include_dir)
+        compiled = compile_protos(proto_files, output_dir, include_dir)
+        self.modules = load_modules([c[0] for c in compiled])
 
-        # Load the decode methods from those modules.
-        self.decoders = {}
-        for proto in protos:
-            schema_path, message_name = _parse_schema_from_proto(proto)
-            self.decoders[schema_path] = getattr(module, message_name)
+        # Index the schemas of the given proto files, and load the decode
+        # methods from those modules.
+        self.schemas = SchemaRegistry(protos, output_dir, include_dir,
+                                      max_schemas=max_schemas)
+        if not lazy_schemas:
+            self.schemas.load_all()
+        self.decoders = self.schemas.row_classes
 
-    def decode_compact(self, message, json_dump=False, print_all=True):
+        # Field projections, see set_compact_projection() and
+        # set_kv_projection().
+        self.compact_scanners = {}
+        self.kv_trees = {}
+
+        # Interned key paths, see iter_kv_leaves().
+        self.kv_paths = KeyPathCache()
+
+        # A CollectorMetrics, if the decode, convert and sink stages are
+        # timed.
+        self.metrics = None
+
+    def get_row_class(self, policy_path):
         """
-        Decode and print a GPB compact message
+        Returns the protobuf class for the rows of the given schema path,
+        or None if no schema is available for it. Waits for the schema to
+        be loaded if necessary.
+        """
+        return self.schemas.get(policy_path)
+
+    def parse_compact_header(self, message):
+        """
+        Parse a GPB compact message into a TelemetryHeader. The rows of its
+        tables are left undecoded.
         """
-        #TODO: instead of printing, this method should return or yield messages.
-        #The json_dump and print_all arguments should disappear.
         telemetry_pb2 = self.modules['telemetry_pb2']
         header = telemetry_pb2.TelemetryHeader()
         header.ParseFromString(message)
@@ -206,49 +256,218 @@ class GPBDecoder(object):
         if header.encoding != ENCODING:
             raise ValueError("Invalid 'encoding' value {:#x} (expected {:#x})".format(
                       header.encoding, ENCODING))
+        return header
 
-        # Print the message header
-        json_dict = {}
+    def decode_compact_lazy(self, message):
+        """
+        Parse the header of a GPB compact message. Returns a CompactMessage
+        whose rows are only parsed when they are accessed.
+        """
+        if self.metrics is None:
+            return CompactMessage(self, self.parse_compact_header(message))
+        start = timer()
+        try:
+            compact = CompactMessage(self, self.parse_compact_header(message))
+        except Exception:
+            self.metrics.decode_error(None)
+            raise
+        self.metrics.decode.observe(timer() - start)
+        return compact
+
+    def compact_to_dict(self, message):
+        """
+        Decode a GPB compact message into a dict. The rows of each table are
+        decoded using the schema registered for its policy path.
+        """
+        return self._compact_to_dict(self.decode_compact_lazy(message))
+
+    def _compact_to_dict(self, compact):
+        if self.metrics is None:
+            return self._convert_compact(compact)
+        start = timer()
+        result = self._convert_compact(compact)
+        self.metrics.convert.observe(timer() - start)
+        return result
+
+    def _convert_compact(self, compact):
+        # Convert the protobuf into a dictionary in preparation for dumping
+        # it as JSON. The serialized rows are replaced with decoded dicts,
+        # so they are not converted along with the header.
+        header = compact.header
+        json_dict = compile_converter(header.DESCRIPTOR, ('tables',))(header)
+        tables = []
+        for table in compact.tables:
+            table_dict = {}
+            if table.policy_path:
+                table_dict["policy_path"] = table.policy_path
+            if table:
+                if table.row_class is None:
+                    rows = [bytes_to_string(r) for r in table.raw_rows]
+                    rows[0] = "<No decoder available>"
+                else:
+                    convert = compile_converter(table.row_class.DESCRIPTOR)
+                    try:
+                        rows = [convert(row_msg) for row_msg in table]
+                    except Exception:
+                        if self.metrics is not None:
+                            self.metrics.decode_error(table.policy_path)
+                        raise
+                table_dict["row"] = rows
+            tables.append(table_dict)
+        if tables:
+            json_dict["tables"] = tables
+        return json_dict
+
+    def decode_compact(self, message, json_dump=False, print_all=True):
+        """
+        Decode and print a GPB compact message
+        """
+        #TODO: instead of printing, this method should return or yield messages.
+        #The json_dump and print_all arguments should disappear.
+        compact = self.decode_compact_lazy(message)
+
+        # If schemas of the message are still being loaded, it is decoded
+        # once they are available, without holding up the caller.
+        paths = [table.policy_path for table in compact.tables]
+        if self.schemas.defer(paths, lambda: self._print_compact(compact,
+                                                                 json_dump,
+                                                                 print_all)):
+            return
+        self._print_compact(compact, json_dump, print_all)
+
+    def _print_compact(self, compact, json_dump, print_all):
         if json_dump:
-            # Convert the protobuf into a dictionary in preparation for dumping
-            # it as JSON.
-            json_dict = proto_to_dict(header)
-        else:
-            print_compact_hdr(header)
+            self._dump(self._compact_to_dict(compact))
+            return
+
+        # Print the message header
+        print_compact_hdr(compact.header)
 
         # Loop over the tables within the message to print them.
-        for table_name, entry in enumerate(header.tables):
-            schema_path = entry.policy_path
-            if not json_dump:
-                print_indent(1, "Schema Path:{}", schema_path)
-                warning = "" if print_all else " (Only first row displayed)"
-                print_indent(1, "# Rows:{}{}", len(entry.row), warning)
+        for table in compact.tables:
+            print_indent(1, "Schema Path:{}", table.policy_path)
+            warning = "" if print_all else " (Only first row displayed)"
+            print_indent(1, "# Rows:{}{}", len(table), warning)
 
             # Find a decoder.
-            decoder = self.decoders.get(schema_path)
-            if not decoder:
+            if table.row_class is None:
                 print_indent(1, "No decoder available")
-                if json_dump:
-                    json_dict["tables"][table_name]["row"][0] = "<No decoder available>"
                 continue
 
-            for i, row in enumerate(entry.row):
-                row_msg = decoder()
-                row_msg.ParseFromString(row)
-                if json_dump:
-                    # Replace the bytes in the 'row' field with a decoded dict
-                    table = json_dict["tables"][table_name]
-                    table["row"][i] = proto_to_dict(row_msg)
-                else:
-                    print_indent(2, "Row {}:", i)
-                    print_compact_msg(row_msg, 2, args)
-                    print("")
+            for i, row_msg in enumerate(table):
+                print_indent(2, "Row {}:", i)
+                print_compact_msg(row_msg, 2, print_all=print_all)
+                print("")
 
-                if not print_all and not json_dump:
+                if not print_all:
                     break
 
-        if json_dump:
-            print(json.dumps(json_dict))
+    def set_compact_projection(self, policy_path, field_paths):
+        """
+        Select the fields that project_compact() decodes from the rows of
+        the given schema path.
+
+        @type policy_path: str
+        @param policy_path: The schema path of the rows.
+        @type field_paths: list(str)
+        @param field_paths: Dotted field names, e.g. "bytes_received" or
+            "queues.packets".
+        """
+        row_class = self.get_row_class(policy_path)
+        if row_class is None:
+            raise ValueError("No decoder available for schema path {}".format(
+                             policy_path))
+        self.compact_scanners[policy_path] = compile_scanner(row_class.DESCRIPTOR,
+                                                             field_paths)
+
+    def project_compact(self, message):
+        """
+        Decode only the fields selected with set_compact_projection() from
+        a GPB compact message, straight from the wire format. Yields
+        (policy_path, row) for each row of the selected schema paths, where
+        row is a dict like proto_to_dict() returns. Tables of other schema
+        paths are skipped.
+        """
+        return iter_compact_rows(as_buffer(message), self.compact_scanners)
+
+    def set_kv_projection(self, base_path, key_paths):
+        """
+        Select the leaves that project_kv() decodes from messages with the
+        given base path.
+
+        @type base_path: str
+        @param base_path: The base path of the messages.
+        @type key_paths: list(str)
+        @param key_paths: The names of the nested fields leading to each
+            leaf, joined by "/", e.g. "content/bytes-received".
+        """
+        self.kv_trees[base_path] = compile_kv_paths(key_paths)
+
+    def project_kv(self, message):
+        """
+        Decode only the leaves selected with set_kv_projection() from a GPB
+        key-value message, straight from the wire format. Yields
+        (base_path, timestamp, values) for each top-level field, where
+        values maps the key paths to the leaf values.
+        """
+        return iter_kv_entries(as_buffer(message), self.kv_trees)
+
+    def parse_kv(self, message):
+        """
+        Parse a GPB key-value message into a Telemetry message.
+        """
+        telemetry_kv_pb2 = self.modules['telemetry_kv_pb2']
+        header = telemetry_kv_pb2.Telemetry()
+        if self.metrics is None:
+            header.ParseFromString(message)
+            return header
+        start = timer()
+        try:
+            header.ParseFromString(message)
+        except Exception:
+            self.metrics.decode_error(None)
+            raise
+        self.metrics.decode.observe(timer() - start)
+        return header
+
+    def iter_kv_records(self, message):
+        """
+        Decode a GPB key-value message into a flat stream of records.
+        Yields (path, value, timestamp) for each leaf, where path is the
+        base path joined with the names of the nested fields by "/", value
+        has the type of the leaf, and timestamp is inherited from the
+        closest enclosing field that has one, or the message timestamp.
+        """
+        header = self.parse_kv(message)
+        leaves = iter_kv_leaves(header, header.base_path,
+                                header.msg_timestamp, self.kv_paths)
+        return ((path, value, timestamp)
+                for path, value_name, value, timestamp in leaves)
+
+    def kv_to_dict(self, message):
+        """
+        Decode a GPB key-value message into a dict.
+        """
+        header = self.parse_kv(message)
+        if self.metrics is None:
+            return proto_to_dict(header)
+        start = timer()
+        try:
+            result = proto_to_dict(header)
+        except Exception:
+            self.metrics.decode_error(header.base_path)
+            raise
+        self.metrics.convert.observe(timer() - start)
+        return result
+
+    def _dump(self, record):
+        # Print a record as JSON, timed as the sink stage.
+        if self.metrics is None:
+            print(json.dumps(record))
+            return
+        start = timer()
+        print(json.dumps(record))
+        self.metrics.sink.observe(timer() - start)
 
     def decode_kv(self, message, json_dump=False, print_all=True):
         """
@@ -256,14 +475,12 @@ class GPBDecoder(object):
         """
         #TODO: instead of printing, this method should return or yield messages.
         #The json_dump and print_all arguments should disappear.
-        telemetry_kv_pb2 = self.modules['telemetry_kv_pb2']
-        header = telemetry_kv_pb2.Telemetry()
-        header.ParseFromString(message)
-
         if json_dump:
-            print(json.dumps(proto_to_dict(header)))
+            self._dump(self.kv_to_dict(message))
             return
 
+        header = self.parse_kv(message)
+
         # Print the message header
         print_kv_hdr(header)
 
@@ -272,6 +489,6 @@ class GPBDecoder(object):
         if print_all:
             for entry in header.fields:
                 print_kv_field(entry, 2)
-        elif len(header.fields) > 0 and not args.brief:
+        elif len(header.fields) > 0:
             print("  Displaying first entry only")
-            print_gpb_kv_field(header.fields[0], 1)
+            print_kv_field(header.fields[0], 1)
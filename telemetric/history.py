@@ -0,0 +1,339 @@
+from __future__ import absolute_import
+import fnmatch
+import threading
+import weakref
+from .client import TCPMsgType
+from .columnar import numpy
+from .series import iter_compact_samples, iter_kv_samples, kv_node
+
+DOWNSAMPLE_FUNCTIONS = ('mean', 'min', 'max', 'last')
+
+class HistoryStore(object):
+    """
+    Keeps the recent samples of every numeric series (counters and
+    gauges, see iter_compact_samples()) at full resolution, e.g. the last
+    hour, for troubleshooting straight from the collector.
+
+    Every series has a slot in two preallocated NumPy arrays of shape
+    (series, capacity), holding its timestamps and values as ring
+    buffers. The samples of a series are in time order, so the timestamps
+    are its time index: range queries are binary searches, and top_k()
+    searches the start of the window of every series at once.
+
+    The number of series is bounded by max_bytes. When it is reached, the
+    series updated least recently are evicted, evict_fraction of them at
+    a time.
+    """
+
+    def __init__(self, capacity=720, max_bytes=256*1024*1024,
+                 initial_series=1024, evict_fraction=0.05):
+        """
+        @type capacity: int
+        @param capacity: The number of samples kept per series, e.g. 720
+            for an hour of samples every five seconds.
+        @type max_bytes: int
+        @param max_bytes: The memory budget of the ring buffers.
+        @type initial_series: int
+        @param initial_series: The number of series to allocate at first;
+            the arrays double in size when full, up to max_bytes.
+        @type evict_fraction: float
+        @param evict_fraction: The share of the series evicted when the
+            budget is reached.
+        """
+        if numpy is None:
+            raise ImportError("HistoryStore requires numpy")
+        self.capacity = capacity
+        self.max_series = max_bytes // self._bytes_per_series()
+        if self.max_series < 1:
+            raise ValueError("max_bytes is too small for the capacity")
+        self.evict_fraction = evict_fraction
+        self.lock = threading.Lock()
+        self.row_fields = weakref.WeakKeyDictionary()
+        self.slots = {}
+        self.keys = []
+        self.free = []
+        self.evictions = 0
+        self.sequence = 0
+        self._allocate(min(initial_series, self.max_series))
+
+    def _bytes_per_series(self):
+        # Timestamps and values, plus the per series state.
+        return self.capacity * 16 + 32
+
+    def _allocate(self, size):
+        old = len(self.keys)
+        timestamps = numpy.zeros((size, self.capacity), dtype='int64')
+        values = numpy.zeros((size, self.capacity), dtype='float64')
+        heads = numpy.zeros(size, dtype='int64')
+        counts = numpy.zeros(size, dtype='int64')
+        wraps = numpy.zeros(size, dtype='float64')
+        updated = numpy.zeros(size, dtype='int64')
+        if old:
+            timestamps[:old] = self.timestamps
+            values[:old] = self.values
+            heads[:old] = self.heads
+            counts[:old] = self.counts
+            wraps[:old] = self.wraps
+            updated[:old] = self.updated
+        self.timestamps = timestamps
+        self.values = values
+        self.heads = heads        # Where the next sample goes.
+        self.counts = counts      # The number of samples held.
+        self.wraps = wraps        # Where a counter wraps, or 0.
+        self.updated = updated    # The sequence number of the last update.
+        self.free.extend(range(size - 1, old - 1, -1))
+        self.keys.extend([None] * (size - old))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def memory_size(self):
+        """
+        Returns the number of bytes allocated for the series.
+        """
+        return len(self.keys) * self._bytes_per_series()
+
+    def _evict(self):
+        count = max(1, int(len(self.slots) * self.evict_fraction))
+        used = numpy.array(sorted(self.slots.values()), dtype='int64')
+        order = numpy.argpartition(self.updated[used], count - 1)[:count]
+        for slot in used[order]:
+            slot = int(slot)
+            del self.slots[self.keys[slot]]
+            self.keys[slot] = None
+            self.counts[slot] = self.heads[slot] = 0
+            self.free.append(slot)
+        self.evictions += count
+
+    def _slot(self, key):
+        if not self.free:
+            size = len(self.keys)
+            if size < self.max_series:
+                self._allocate(min(size * 2, self.max_series))
+            else:
+                self._evict()
+        slot = self.free.pop()
+        self.slots[key] = slot
+        self.keys[slot] = key
+        return slot
+
+    def _update(self, node, path, value, timestamp, wrap):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        key = node, path
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self._slot(key)
+            self.wraps[slot] = wrap or 0
+        count = self.counts[slot]
+        head = self.heads[slot]
+        if count and timestamp < self.timestamps[slot, head - 1]:
+            # Out of order; the buffer must stay sorted.
+            return
+        self.timestamps[slot, head] = timestamp
+        self.values[slot, head] = value
+        self.heads[slot] = (head + 1) % self.capacity
+        if count < self.capacity:
+            self.counts[slot] = count + 1
+        self.sequence += 1
+        self.updated[slot] = self.sequence
+
+    def update(self, node, path, value, timestamp, wrap=None):
+        """
+        Store a sample. Samples that are older than the latest one of the
+        series, and values that are not numbers, are ignored.
+
+        @type timestamp: int
+        @param timestamp: The time of the sample, in milliseconds.
+        @type wrap: int
+        @param wrap: The value at which the counter wraps, for counters.
+        """
+        with self.lock:
+            self._update(node, path, value, timestamp, wrap)
+
+    def add_compact(self, message, node=None):
+        """
+        Store the counters and gauges of the rows of a CompactMessage (see
+        GPBDecoder.decode_compact_lazy()). node defaults to the identifier
+        of the message.
+        """
+        node = node or message.identifier
+        samples = list(iter_compact_samples(message, self.row_fields))
+        with self.lock:
+            for path, value, timestamp, wrap in samples:
+                self._update(node, path, value, timestamp, wrap)
+
+    def add_kv(self, header, node=None, peer=None):
+        """
+        Store the numeric leaves of a key-value Telemetry message (see
+        GPBDecoder.parse_kv()) from the given peer. node defaults to
+        the subscription identifier qualified with the peer (see
+        kv_node()).
+        """
+        node = node or kv_node(header.subscription_identifier, peer)
+        samples = list(iter_kv_samples(header))
+        with self.lock:
+            for path, value, timestamp, wrap in samples:
+                self._update(node, path, value, timestamp, wrap)
+
+    def add_message(self, decoder, msg_type, payload, node=None,
+                    peer=None):
+        """
+        Decode a compact or key-value message with the given GPBDecoder
+        and store it, e.g. from the callback of a TMClient. Other messages
+        are ignored. peer is the one passed to the callback.
+        """
+        if msg_type == TCPMsgType.GPB_COMPACT:
+            self.add_compact(decoder.decode_compact_lazy(payload), node)
+        elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+            self.add_kv(decoder.parse_kv(payload), node, peer)
+
+    def _ordered(self, slot):
+        # The positions of the samples of a slot, oldest first.
+        count = self.counts[slot]
+        start = self.heads[slot] - count
+        return numpy.arange(start, start + count) % self.capacity
+
+    def range(self, node, path, start=None, end=None):
+        """
+        Returns the samples of a series with start <= timestamp < end as a
+        tuple of arrays (timestamps, values), oldest first. Both are empty
+        if the series is unknown.
+        """
+        with self.lock:
+            slot = self.slots.get((node, path))
+            if slot is None:
+                return (numpy.zeros(0, dtype='int64'),
+                        numpy.zeros(0, dtype='float64'))
+            order = self._ordered(slot)
+            timestamps = self.timestamps[slot, order]
+            values = self.values[slot, order]
+        first = 0 if start is None else numpy.searchsorted(timestamps, start)
+        last = len(timestamps) if end is None \
+            else numpy.searchsorted(timestamps, end)
+        return timestamps[first:last], values[first:last]
+
+    def downsample(self, node, path, step, start=None, end=None, how='mean'):
+        """
+        Like range(), but combines the samples of each step milliseconds
+        (counting from start, or the first sample) into one, using one of
+        the DOWNSAMPLE_FUNCTIONS. Returns the start of every non-empty
+        bucket and its value.
+        """
+        if how not in DOWNSAMPLE_FUNCTIONS:
+            raise ValueError("unknown downsample function: {}".format(how))
+        timestamps, values = self.range(node, path, start, end)
+        if not len(timestamps):
+            return timestamps, values
+        origin = timestamps[0] if start is None else start
+        buckets = (timestamps - origin) // step
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+        bucket_times = origin + buckets[starts] * step
+        if how == 'mean':
+            counts = numpy.diff(numpy.append(starts, len(values)))
+            result = numpy.add.reduceat(values, starts) / counts
+        elif how == 'min':
+            result = numpy.minimum.reduceat(values, starts)
+        elif how == 'max':
+            result = numpy.maximum.reduceat(values, starts)
+        else:
+            result = values[numpy.append(starts[1:], len(values)) - 1]
+        return bucket_times, result
+
+    def _candidates(self, prefix, node):
+        # The slots of the series matching the path prefix and node
+        # pattern (see LastValueStore.query()).
+        if node == '*':
+            node = None
+        pattern = node is not None and any(c in node for c in '*?[')
+        return numpy.array([slot for (n, path), slot in self.slots.items()
+                            if path.startswith(prefix)
+                            and (node is None
+                                 or (fnmatch.fnmatchcase(n, node) if pattern
+                                     else n == node))],
+                           dtype='int64')
+
+    def _search(self, slots, starts, counts, bound):
+        # Binary search for the number of samples before bound in every
+        # series at once.
+        low = numpy.zeros(len(slots), dtype='int64')
+        high = counts.copy()
+        while True:
+            active = low < high
+            if not active.any():
+                return low
+            middle = (low + high) // 2
+            times = self.timestamps[slots, (starts + middle) % self.capacity]
+            before = active & (times < bound)
+            low = numpy.where(before, middle + 1, low)
+            high = numpy.where(active & ~before, middle, high)
+
+    def top_k(self, k, window, now=None, prefix='', node=None):
+        """
+        Returns the k series that grew fastest over the last window
+        milliseconds, as a list of (rate, node, path) with the rate in
+        units per second, fastest first. The rate is taken between the
+        first and the last sample in the window. Counters that wrapped
+        once are corrected; counters that were reset are left out.
+
+        @type now: int
+        @param now: The end of the window; defaults to the latest sample.
+        @type prefix: str
+        @param prefix: Only consider series whose path starts with this.
+        @type node: str
+        @param node: Only consider series of this node, or matching this
+            pattern (see fnmatch).
+        """
+        with self.lock:
+            slots = self._candidates(prefix, node)
+            slots = slots[self.counts[slots] >= 2]
+            if not len(slots):
+                return []
+            capacity = self.capacity
+            counts = self.counts[slots]
+            starts = self.heads[slots] - counts
+            if now is None:
+                last = (self.heads[slots] - 1) % capacity
+                now = self.timestamps[slots, last].max()
+            first = self._search(slots, starts, counts, now - window)
+            last = self._search(slots, starts, counts, now + 1) - 1
+            first_positions = (starts + first) % capacity
+            last_positions = (starts + last) % capacity
+            first_times = self.timestamps[slots, first_positions]
+            last_times = self.timestamps[slots, last_positions]
+            first_values = self.values[slots, first_positions]
+            last_values = self.values[slots, last_positions]
+            wraps = self.wraps[slots]
+            keys = [self.keys[slot] for slot in slots]
+
+        valid = (last > first) & (last_times > first_times)
+        delta = last_values - first_values
+        # A counter that went down wrapped if it was close to the wrap
+        # value (in its upper half), and was reset otherwise.
+        decreased = (delta < 0) & (wraps > 0)
+        wrapped = decreased & (first_values >= wraps / 2)
+        delta = numpy.where(wrapped, delta + wraps, delta)
+        valid &= ~(decreased & ~wrapped)
+        rates = numpy.where(valid, delta * 1000.0
+                            / numpy.maximum(last_times - first_times, 1),
+                            -numpy.inf)
+        k = min(k, int(valid.sum()))
+        if not k:
+            return []
+        top = numpy.argpartition(-rates, k - 1)[:k]
+        top = top[numpy.argsort(-rates[top], kind='stable')]
+        return [(float(rates[i]),) + keys[i] for i in top]
+
+    def register_metrics(self, registry):
+        """
+        Add the number of series and evictions to a MetricsRegistry.
+        """
+        registry.gauge('telemetric_history_series',
+                       'Series held by the history store') \
+                .labels().set_function(lambda: len(self.slots))
+        registry.gauge('telemetric_history_evictions',
+                       'Series evicted from the history store') \
+                .labels().set_function(lambda: self.evictions)
+        registry.gauge('telemetric_history_bytes',
+                       'Memory allocated by the history store') \
+                .labels().set_function(self.memory_size)
@@ -0,0 +1,155 @@
+from __future__ import absolute_import
+import re
+import json
+
+_open = re.compile(br'\s*\{')
+_member = re.compile(br'\s*"([^"\\]*(?:\\.[^"\\]*)*)"\s*:\s*', re.DOTALL)
+_string = re.compile(br'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_scalar = re.compile(br'[^\s,}\]]+')
+_separator = re.compile(br'\s*([,}])')
+_other = br'[^"{}\[\]]*'
+_token = re.compile(_other + br'(?:' + _string.pattern + _other
+                    + br')*(?:([{\[])|[}\]])', re.DOTALL)
+_string_end = re.compile(br'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_quoted = re.compile(br'"[^"]*"')
+_not_structure = bytes(bytearray(c for c in range(256)
+                                 if c not in bytearray(b'"{}[]')))
+_MIN_CHUNK = 1024
+_MAX_CHUNK = 65536
+_MAX_WALK = 128
+
+def _skip_tokens(data, pos, depth):
+    # Returns the position after the bracket that closes depth levels,
+    # going from bracket to bracket.
+    match = _token.match
+    while depth:
+        token = match(data, pos)
+        if token is None:
+            raise ValueError("unterminated JSON value")
+        pos = token.end()
+        if token.lastindex:
+            depth += 1
+        else:
+            depth -= 1
+    return pos
+
+def _skip_nested(data, pos):
+    # Returns the position after the object or array at pos, matching
+    # brackets and jumping over strings, without decoding anything.
+    # Chunks of growing size are reduced to their brackets with bytes
+    # methods, so that Python code only runs per chunk. The chunk that
+    # holds the end of the value is halved until it is short enough to
+    # walk bracket by bracket.
+    size = len(data)
+    pos += 1
+    depth = 1
+    in_string = False
+    chunk_size = _MIN_CHUNK
+    while True:
+        if pos >= size:
+            raise ValueError("unterminated JSON value")
+        end = min(pos + chunk_size, size)
+        chunk_size = min(chunk_size * 2, _MAX_CHUNK)
+        chunk = bytes(data[pos:end])
+        if b'\\' in chunk:
+            # Do not split an escape sequence, then drop the escaped
+            # backslashes and quotes.
+            while chunk.endswith(b'\\') and end < size:
+                end += 1
+                chunk = bytes(data[pos:end])
+            chunk = chunk.replace(b'\\\\', b'').replace(b'\\"', b'')
+        skeleton = chunk.translate(None, _not_structure)
+        if in_string:
+            skeleton = b'"' + skeleton
+        ends_in_string = skeleton.count(b'"') % 2 == 1
+        if ends_in_string:
+            skeleton = skeleton[:skeleton.rfind(b'"')]
+        # Removing two adjacent quotes drops an empty string or joins two
+        # strings; either way, no bracket changes sides.
+        skeleton = skeleton.replace(b'""', b'')
+        if b'"' in skeleton:
+            skeleton = _quoted.sub(b'', skeleton)
+        # Cancel matching pairs, which leaves the closing brackets of
+        # the levels above the chunk followed by the opening ones it
+        # leaves open.
+        while True:
+            reduced = skeleton.replace(b'{}', b'').replace(b'[]', b'')
+            if len(reduced) == len(skeleton):
+                break
+            skeleton = reduced
+        closed = len(skeleton) - len(skeleton.lstrip(b'}]'))
+        if closed >= depth and end - pos > _MAX_WALK:
+            # The value ends in this chunk; look closer.
+            chunk_size = (end - pos) // 2
+            continue
+        if closed >= depth:
+            if in_string:
+                match = _string_end.match(data, pos)
+                if match is None:
+                    raise ValueError("unterminated JSON string at offset "
+                                     "{}".format(pos))
+                pos = match.end()
+            return _skip_tokens(data, pos, depth)
+        depth += len(skeleton) - 2 * closed
+        in_string = ends_in_string
+        pos = end
+
+def _skip(data, pos):
+    # Returns the position after the JSON value at pos.
+    first = data[pos:pos + 1]
+    if first == b'"':
+        match = _string.match(data, pos)
+    elif first == b'{' or first == b'[':
+        return _skip_nested(data, pos)
+    else:
+        match = _scalar.match(data, pos)
+    if match is None:
+        raise ValueError("expected a JSON value at offset {}".format(pos))
+    return match.end()
+
+def scan_json_keys(data, keys):
+    """
+    Returns the values of the given top-level keys of a JSON object,
+    without decoding the rest of it, e.g. to route a message by its
+    "encoding_path" or "node_id_str" while passing the payload on as-is.
+    The members of the object are scanned in order, and the scan stops as
+    soon as all keys are found; as telemetry messages put their data
+    last, this rarely reads past the header fields. The bytes are scanned
+    as they are: other values are skipped by matching their quotes and
+    brackets, and only the values of the keys are decoded. Missing keys
+    are left out of the result.
+
+    @type data: bytes|memoryview
+    @param data: The serialized JSON object, in UTF-8.
+    @type keys: list(str)
+    @param keys: The keys to look for.
+    @rtype: dict
+    @return: Maps the keys that were found to their values.
+    """
+    if isinstance(data, memoryview) and str is bytes:
+        # The re module of Python 2 cannot read a memoryview.
+        data = data.tobytes()
+    wanted = set(keys)
+    result = {}
+    match = _open.match(data)
+    if match is None:
+        raise ValueError("not a JSON object")
+    pos = match.end()
+    while wanted:
+        match = _member.match(data, pos)
+        if match is None:
+            break
+        key = bytes(match.group(1)).decode('utf-8')
+        if '\\' in key:
+            key = json.loads('"' + key + '"')
+        pos = match.end()
+        end = _skip(data, pos)
+        if key in wanted:
+            wanted.discard(key)
+            result[key] = json.loads(bytes(data[pos:end]).decode('utf-8'))
+        pos = end
+        match = _separator.match(data, pos)
+        if match is None or match.group(1) == b'}':
+            break
+        pos = match.end()
+    return result
@@ -0,0 +1,481 @@
+# The load generator is written with async/await and therefore requires
+# Python 3.5 or later; unlike the collector, it is not importable on
+# Python 2.
+from __future__ import absolute_import
+import time
+import zlib
+import bisect
+import socket
+import asyncio
+import logging
+import multiprocessing
+from .client import TMClient, TCPMsgType, socket_family
+from .pipeline import decode_record
+from .synthetic import PayloadGenerator, v1_frame, v2_frame
+from .udp import read_udp_drops
+
+logger = logging.getLogger()
+
+MSG_TYPES = {'json': TCPMsgType.JSON,
+             'compact': TCPMsgType.GPB_COMPACT,
+             'kv': TCPMsgType.GPB_KEY_VALUE}
+MAX_UDP_PAYLOAD = 65507
+
+def parse_mix(mix):
+    """
+    Parse a traffic mix like "json=1,compact=2,kv=1" into a dict mapping
+    message types to weights.
+    """
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in MSG_TYPES:
+            raise ValueError("unknown message type in mix: {}".format(name))
+        weights[MSG_TYPES[name]] = float(weight or 1)
+    return weights
+
+def build_cycle(payloads, version, compress=True, reset_interval=100):
+    """
+    Returns the frames of one reset interval of a session, as a list of
+    (frame, number of messages). The cycle starts with a reset of the
+    compressor, so a session can send it over and over again.
+
+    @type payloads: list((int, bytes))
+    @param payloads: The (msg_type, payload) of each message of the
+        cycle. v1 sessions can only carry JSON.
+    @type version: int
+    @param version: 1 or 2.
+    @type compress: bool
+    @param compress: Whether v2 payloads are compressed; v1 payloads
+        always are.
+    """
+    if version == 1:
+        for msg_type, payload in payloads:
+            if msg_type != TCPMsgType.JSON:
+                raise ValueError("v1 sessions can only send JSON")
+    cycle = []
+    for i, (msg_type, payload) in enumerate(payloads):
+        reset = i % reset_interval == 0
+        if reset:
+            compressor = zlib.compressobj()
+        if version == 1:
+            cycle.append((v1_frame([payload], compressor, reset), 1))
+            continue
+        if reset:
+            cycle.append((v2_frame(TCPMsgType.RESET_COMPRESSOR, b''), 0))
+        cycle.append((v2_frame(msg_type, payload,
+                               compressor if compress else None), 1))
+    return cycle
+
+class Collector(object):
+    """
+    Runs a TMClient on localhost in a separate process, counting every
+    message it has decoded, so that a LoadGenerator can measure how far
+    the collector falls behind.
+    """
+
+    def __init__(self, protos=(), proto_output_dir='~/.telemetric/proto',
+                 proto_include_dir=(), use_asyncio=True, decode_processes=0,
+                 port=None):
+        """
+        @type use_asyncio: bool
+        @param use_asyncio: Serve TCP with TMClient.run_async() rather
+            than TMClient.run().
+        @type decode_processes: int
+        @param decode_processes: See TMClient.
+        @type port: int
+        @param port: The port for TCP and UDP; a free one by default.
+        """
+        self.protos = list(protos)
+        self.proto_output_dir = proto_output_dir
+        self.proto_include_dir = proto_include_dir
+        self.use_asyncio = use_asyncio
+        self.decode_processes = decode_processes
+        self.port = port
+        self.counter = multiprocessing.Value('L', 0)
+        self.process = None
+
+    @property
+    def address(self):
+        return '127.0.0.1', self.port
+
+    @property
+    def decoded(self):
+        """
+        The number of messages decoded so far.
+        """
+        return self.counter.value
+
+    def start(self, timeout=60):
+        """
+        Start the collector process and wait until it accepts connections.
+        """
+        if self.port is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+            sock.close()
+        self.process = multiprocessing.Process(target=_run_collector,
+                                               args=(self.port,
+                                                     self.protos,
+                                                     self.proto_output_dir,
+                                                     self.proto_include_dir,
+                                                     self.use_asyncio,
+                                                     self.decode_processes,
+                                                     self.counter))
+        self.process.daemon = True
+        self.process.start()
+
+        deadline = time.time() + timeout
+        while True:
+            try:
+                socket.create_connection(self.address, 1).close()
+                return
+            except socket.error:
+                if not self.process.is_alive():
+                    raise ValueError("the collector failed to start")
+                if time.time() > deadline:
+                    self.stop()
+                    raise ValueError("the collector did not start in time")
+                time.sleep(0.05)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+def _run_collector(port, protos, proto_output_dir, proto_include_dir,
+                   use_asyncio, decode_processes, counter):
+    # Per-message logging would dominate the measurement.
+    logger.setLevel(logging.WARNING)
+    client = None
+    def count(msg_type, payload, peer):
+        # Without decode processes, the callback gets raw payloads.
+        if not decode_processes:
+            decode_record(client.gpbdecoder, msg_type, payload)
+        with counter.get_lock():
+            counter.value += 1
+
+    client = TMClient('127.0.0.1', port, protos,
+                      proto_output_dir=proto_output_dir,
+                      proto_include_dir=proto_include_dir,
+                      callback=count,
+                      decode_processes=decode_processes)
+    if use_asyncio:
+        client.run_async()
+    else:
+        client.run()
+
+async def _gather(coroutines):
+    await asyncio.gather(*coroutines)
+
+class _Counters(object):
+    def __init__(self):
+        self.sent = 0
+        self.bytes = 0
+        self.errors = 0
+
+class LoadGenerator(object):
+    """
+    Emulates a fleet of routers streaming to a collector: TCP dial-out
+    sessions sending v1 or v2 frames, and UDP senders sending compact
+    messages, each at a fixed rate. Every reset_interval messages, a
+    session resets its compressor like a router does.
+
+    If the collector is a Collector, the age of the oldest message it has
+    not decoded yet is sampled while sending; this is the decode lag.
+    """
+
+    def __init__(self, decoder, collector, tcp_sessions=10, udp_senders=0,
+                 v1_sessions=0, rate=10.0, mix='json=1,compact=1,kv=1',
+                 compress=True, reset_interval=100, rows=10, entries=10,
+                 pool_size=16, seed=0):
+        """
+        @type decoder: GPBDecoder
+        @param decoder: Provides the schemas of the generated messages.
+        @type collector: Collector|tuple
+        @param collector: A Collector, or the (host, port) of a collector
+            that is already running. The decode lag is only known for
+            a Collector.
+        @type tcp_sessions: int
+        @param tcp_sessions: The number of v2 TCP sessions.
+        @type udp_senders: int
+        @param udp_senders: The number of UDP senders.
+        @type v1_sessions: int
+        @param v1_sessions: The number of v1 TCP sessions, which only send
+            compressed JSON.
+        @type rate: float
+        @param rate: Messages per second sent by every session or sender.
+        @type mix: str
+        @param mix: The weights of the message types sent over v2, see
+            parse_mix().
+        @type compress: bool
+        @param compress: Whether v2 sessions compress their messages.
+        @type reset_interval: int
+        @param reset_interval: Messages between RESET_COMPRESSOR frames.
+        @type rows: int
+        @param rows: The number of rows of compact messages.
+        @type entries: int
+        @param entries: The number of entries of KV and JSON messages.
+        @type pool_size: int
+        @param pool_size: The number of distinct messages of each type.
+        """
+        self.collector = collector
+        if isinstance(collector, Collector):
+            self.address = collector.address
+        else:
+            self.address = tuple(collector)
+        self.tcp_sessions = tcp_sessions
+        self.udp_senders = udp_senders
+        self.v1_sessions = v1_sessions
+        self.rate = float(rate)
+
+        generator = PayloadGenerator(decoder, seed)
+        weights = parse_mix(mix)
+        if (TCPMsgType.GPB_COMPACT in weights or udp_senders) \
+                and not any(decoder.schemas.index):
+            raise ValueError("compact messages require at least one schema")
+        pool = {}
+        for msg_type in set(weights) | set([TCPMsgType.JSON]):
+            if msg_type == TCPMsgType.GPB_COMPACT:
+                make = lambda: generator.compact(rows=rows)
+            elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+                make = lambda: generator.kv(entries=entries)
+            else:
+                make = lambda: generator.json(entries=entries)
+            pool[msg_type] = [make() for i in range(pool_size)]
+
+        types = sorted(weights)
+        v2_payloads = []
+        for i in range(reset_interval):
+            msg_type = generator.random.choices(
+                types, [weights[t] for t in types])[0]
+            v2_payloads.append((msg_type, pool[msg_type][i % pool_size]))
+        v1_payloads = [(TCPMsgType.JSON, pool[TCPMsgType.JSON][i % pool_size])
+                       for i in range(reset_interval)]
+        self.v2_cycle = build_cycle(v2_payloads, 2, compress, reset_interval)
+        self.v1_cycle = build_cycle(v1_payloads, 1, True, reset_interval)
+
+        self.udp_payloads = [generator.compact(rows=rows)
+                             for i in range(pool_size)]
+        if udp_senders and max(len(p) for p in self.udp_payloads) > MAX_UDP_PAYLOAD:
+            raise ValueError("compact messages with {} rows do not fit "
+                             "into a datagram".format(rows))
+
+    def _decoded(self):
+        if isinstance(self.collector, Collector):
+            return self.collector.decoded
+        return None
+
+    async def _pace(self, loop, rate, deadline, send):
+        # Calls send() rate times per second until the deadline. A sender
+        # that falls more than a second behind skips the missed messages
+        # instead of bursting them.
+        interval = 1.0 / rate
+        next_time = loop.time()
+        burst = 0
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                return
+            if now < next_time:
+                burst = 0
+                await asyncio.sleep(min(next_time, deadline) - now)
+                continue
+            if next_time < now - 1:
+                next_time = now
+            next_time += interval * await send()
+            burst += 1
+            if burst % 16 == 0:
+                await asyncio.sleep(0)
+
+    async def _tcp_session(self, loop, cycle, rate, deadline, counters):
+        try:
+            reader, writer = await asyncio.open_connection(*self.address)
+        except (OSError, socket.error) as e:
+            logger.error("failed to open TCP session: {}".format(e))
+            counters.errors += 1
+            return
+        position = [0]
+        async def send():
+            frame, count = cycle[position[0]]
+            position[0] = (position[0] + 1) % len(cycle)
+            writer.write(frame)
+            counters.sent += count
+            counters.bytes += len(frame)
+            if writer.transport.get_write_buffer_size() > 1024*1024:
+                await writer.drain()
+            return count
+        try:
+            await self._pace(loop, rate, deadline, send)
+            await writer.drain()
+        except (OSError, socket.error) as e:
+            logger.error("TCP session failed: {}".format(e))
+            counters.errors += 1
+        finally:
+            writer.close()
+
+    async def _udp_sender(self, loop, rate, deadline, counters):
+        sock = socket.socket(socket_family(self.address[0]), socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        position = [0]
+        async def send():
+            payload = self.udp_payloads[position[0]]
+            position[0] = (position[0] + 1) % len(self.udp_payloads)
+            try:
+                sock.sendto(payload, self.address)
+            except (OSError, socket.error):
+                counters.errors += 1
+                return 1
+            counters.sent += 1
+            counters.bytes += len(payload)
+            return 1
+        try:
+            await self._pace(loop, rate, deadline, send)
+        finally:
+            sock.close()
+
+    async def _sample(self, loop, deadline, counters, decoded_before, lags):
+        # Samples the decode lag: the time since the oldest message that
+        # was not decoded yet was sent.
+        times = []
+        sent = []
+        while loop.time() < deadline:
+            now = time.time()
+            times.append(now)
+            sent.append(counters.sent)
+            decoded = self._decoded() - decoded_before
+            if decoded >= counters.sent:
+                lags.append(0.0)
+            else:
+                lags.append(now - times[bisect.bisect_right(sent, decoded)])
+            await asyncio.sleep(0.05)
+
+    def run(self, duration=10.0, scale=1.0, drain_timeout=10.0):
+        """
+        Send traffic for the given number of seconds, then wait up to
+        drain_timeout seconds for the collector to decode what was sent.
+        scale multiplies the number of sessions and senders.
+
+        Returns a dict with the achieved rates. If the collector is a
+        Collector, it also contains the decode rate, the decode lag in
+        seconds, and the number of messages that were sent but never
+        decoded.
+        """
+        tcp_sessions = int(round(self.tcp_sessions * scale))
+        v1_sessions = int(round(self.v1_sessions * scale))
+        udp_senders = int(round(self.udp_senders * scale))
+        counters = _Counters()
+        lags = []
+        decoded_before = self._decoded()
+        drops_before = read_udp_drops(self.address[1])
+
+        loop = asyncio.new_event_loop()
+        try:
+            start = loop.time()
+            started = time.time()
+            deadline = start + duration
+            tasks = [self._tcp_session(loop, self.v2_cycle, self.rate,
+                                       deadline, counters)
+                     for i in range(tcp_sessions)]
+            tasks += [self._tcp_session(loop, self.v1_cycle, self.rate,
+                                        deadline, counters)
+                      for i in range(v1_sessions)]
+            tasks += [self._udp_sender(loop, self.rate, deadline, counters)
+                      for i in range(udp_senders)]
+            if decoded_before is not None:
+                tasks.append(self._sample(loop, deadline, counters,
+                                          decoded_before, lags))
+            loop.run_until_complete(_gather(tasks))
+            elapsed = time.time() - started
+        finally:
+            loop.close()
+
+        streams = tcp_sessions + v1_sessions + udp_senders
+        result = {'sessions': streams,
+                  'offered_rate': streams * self.rate,
+                  'sent': counters.sent,
+                  'send_rate': counters.sent / elapsed,
+                  'send_bytes_rate': counters.bytes / elapsed,
+                  'send_errors': counters.errors}
+        if decoded_before is None:
+            return result
+
+        decoded = self._decoded() - decoded_before
+        result['decode_rate'] = decoded / elapsed
+        drain_start = time.time()
+        while self._decoded() - decoded_before < counters.sent \
+                and time.time() - drain_start < drain_timeout:
+            time.sleep(0.01)
+        result['drain_time'] = time.time() - drain_start
+        result['lost'] = max(0, counters.sent - (self._decoded() - decoded_before))
+        result['lag_max'] = max(lags) if lags else 0.0
+        result['lag_mean'] = sum(lags) / len(lags) if lags else 0.0
+        drops_after = read_udp_drops(self.address[1])
+        if drops_before is not None and drops_after is not None:
+            result['udp_drops'] = drops_after - drops_before
+        return result
+
+    def find_saturation(self, duration=5.0, factor=2.0, max_steps=10,
+                        refine=3, max_lag=1.0, tolerance=0.05):
+        """
+        Find the largest number of sessions the collector keeps up with.
+        The sessions and senders are scaled by factor after every step of
+        the given duration, until a step saturates, then the scale is
+        bisected refine times. A step is saturated if the collector decodes
+        less than (1 - tolerance) of what was sent, its decode lag exceeds
+        max_lag seconds, or it loses messages. If the generator itself
+        cannot reach the offered rate, the step is marked limited by the
+        generator, which means the collector was not saturated yet.
+
+        Returns a dict with the last step the collector kept up with (or
+        None), and all steps.
+        """
+        if not isinstance(self.collector, Collector):
+            raise ValueError("finding the saturation point requires a Collector")
+        steps = []
+        good = bad = None
+        def step(scale):
+            result = self.run(duration, scale, drain_timeout=max(max_lag * 4, 2))
+            result['scale'] = scale
+            saturated = result['decode_rate'] < result['send_rate'] * (1 - tolerance) \
+                     or result['lag_max'] > max_lag \
+                     or result['lost'] > 0
+            result['saturated'] = saturated
+            result['generator_limited'] = \
+                result['send_rate'] < result['offered_rate'] * (1 - tolerance)
+            steps.append(result)
+            logger.info("{} sessions: sent {:.0f}/s, decoded {:.0f}/s, "
+                        "lag {:.3f}s".format(result['sessions'],
+                                             result['send_rate'],
+                                             result['decode_rate'],
+                                             result['lag_max']))
+            return result
+
+        scale = 1.0
+        for i in range(max_steps):
+            result = step(scale)
+            if result['saturated']:
+                bad = result
+                break
+            good = result
+            if result['generator_limited']:
+                break
+            scale *= factor
+
+        if good is not None and bad is not None:
+            for i in range(refine):
+                scale = (good['scale'] + bad['scale']) / 2
+                if int(round(self.tcp_sessions * scale)) \
+                 + int(round(self.v1_sessions * scale)) \
+                 + int(round(self.udp_senders * scale)) \
+                 in (good['sessions'], bad['sessions']):
+                    break
+                result = step(scale)
+                if result['saturated']:
+                    bad = result
+                else:
+                    good = result
+        return {'saturation': good, 'steps': steps}
@@ -0,0 +1,369 @@
+from __future__ import absolute_import
+import time
+import bisect
+import logging
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger()
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Seconds, from 10us to 10s.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+RATIO_BUCKETS = (1, 1.5, 2, 3, 4, 6, 8, 12, 16, 32, 64)
+STAGES = ('recv', 'framing', 'decompress', 'decode', 'convert', 'sink')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+                     .replace('"', r'\"')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(extra[0], extra[1]))
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+class Counter(object):
+    """
+    A value that only goes up.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, names, values):
+        yield name, _format_labels(names, values), self.value
+
+class Gauge(object):
+    """
+    A value that is either set, or read from a function when the metrics
+    are rendered.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+    def samples(self, name, names, values):
+        yield name, _format_labels(names, values), self.get()
+
+class Histogram(object):
+    """
+    Counts observations in buckets, like a Prometheus histogram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self, name, names, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(names, values, ('le', _format_value(bound)))
+            yield name + '_bucket', labels, cumulative
+        labels = _format_labels(names, values)
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, cumulative
+
+class Metric(object):
+    """
+    A family of metrics with the same name, one per combination of label
+    values.
+    """
+
+    def __init__(self, name, help, kind, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        Returns the metric with the given label values, creating it if
+        needed. Keep the result around on hot paths to skip the lookup.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError("{} expects the labels {}".format(self.name,
+                                                              self.labelnames))
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def remove(self, *values):
+        """
+        Forget the metric with the given label values.
+        """
+        with self.lock:
+            self.children.pop(values, None)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            children = sorted(self.children.items())
+        for values, child in children:
+            for name, labels, value in child.samples(self.name,
+                                                     self.labelnames,
+                                                     values):
+                lines.append('{}{} {}'.format(name, labels,
+                                              _format_value(value)))
+        return '\n'.join(lines)
+
+class MetricsRegistry(object):
+    """
+    Holds metrics and renders them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        if any(m.name == metric.name for m in self.metrics):
+            raise ValueError("duplicate metric {}".format(metric.name))
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Metric(name, help, 'counter', labelnames, Counter))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Metric(name, help, 'gauge', labelnames, Gauge))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Metric(name, help, 'histogram', labelnames,
+                                lambda: Histogram(buckets)))
+
+    def render(self):
+        return ''.join(m.render() + '\n' for m in self.metrics)
+
+class PeerMetrics(object):
+    """
+    The metrics of one peer, resolved once so that the receive path does
+    not look up labels for every message.
+    """
+
+    def __init__(self, metrics, peer):
+        self.families = (metrics.peer_bytes,
+                         metrics.peer_messages,
+                         metrics.compressed_bytes,
+                         metrics.decompressed_bytes,
+                         metrics.decompress_errors)
+        self.peer = peer
+        self.bytes = metrics.peer_bytes.labels(peer)
+        self.messages = metrics.peer_messages.labels(peer)
+        self.compressed = metrics.compressed_bytes.labels(peer)
+        self.decompressed = metrics.decompressed_bytes.labels(peer)
+        self.decompress_errors = metrics.decompress_errors.labels(peer)
+
+    def remove(self):
+        """
+        Remove the metrics of the peer from their families.
+        """
+        for family in self.families:
+            family.remove(self.peer)
+
+class CollectorMetrics(object):
+    """
+    The metrics of a collector. Every stage of the receive path has a
+    latency histogram:
+
+      - recv: waiting for and receiving data (threaded TCP and UDP only;
+        the asyncio server receives inside the event loop).
+      - framing: splitting the TCP stream into messages.
+      - decompress: zlib decompression.
+      - decode: parsing the protobuf message (for compact messages only
+        the header; rows are parsed lazily during convert).
+      - convert: converting the message into a dict.
+      - sink: passing the result on, i.e. the callback or printing.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry or MetricsRegistry()
+        r = self.registry
+        self.stage_seconds = r.histogram('telemetric_stage_seconds',
+                                         'Time spent per message in each stage',
+                                         ('stage',))
+        for stage in STAGES:
+            setattr(self, stage, self.stage_seconds.labels(stage))
+        self.peer_bytes = r.counter('telemetric_peer_bytes_total',
+                                    'Payload bytes received per peer',
+                                    ('peer',))
+        self.peer_messages = r.counter('telemetric_peer_messages_total',
+                                       'Messages received per peer',
+                                       ('peer',))
+        self.compressed_bytes = r.counter('telemetric_compressed_bytes_total',
+                                          'Bytes passed to the decompressor',
+                                          ('peer',))
+        self.decompressed_bytes = r.counter('telemetric_decompressed_bytes_total',
+                                            'Bytes returned by the decompressor',
+                                            ('peer',))
+        self.compression_ratio = r.histogram('telemetric_compression_ratio',
+                                             'Decompressed to compressed size per message',
+                                             buckets=RATIO_BUCKETS).labels()
+        self.decompress_errors = r.counter('telemetric_decompress_errors_total',
+                                           'Messages that failed to decompress',
+                                           ('peer',))
+        self.decode_errors = r.counter('telemetric_decode_errors_total',
+                                       'Messages that failed to decode, by schema path',
+                                       ('schema_path',))
+        self.queue_depth = r.gauge('telemetric_queue_depth',
+                                   'Items waiting in each queue',
+                                   ('queue',))
+        self.queue_lag = r.gauge('telemetric_queue_lag_seconds',
+                                 'Age of the oldest item in each queue',
+                                 ('queue',))
+        self.queue_dropped = r.counter('telemetric_queue_dropped_total',
+                                       'Items dropped by each queue, by peer and schema path',
+                                       ('queue', 'peer', 'schema_path'))
+        self.queue_wait = r.counter('telemetric_queue_wait_seconds_total',
+                                    'Time items spent queued, by peer and schema path',
+                                    ('queue', 'peer', 'schema_path'))
+        self.peers = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def peer(self, peer):
+        """
+        Returns the PeerMetrics of the given peer, a socket address or a
+        "host:port" string. Peers are labelled by host only, as the port
+        changes every time a router reconnects.
+        """
+        from .capture import peer_host
+        host = peer_host(peer)
+        metrics = self.peers.get(host)
+        if metrics is None:
+            with self.lock:
+                metrics = self.peers.get(host)
+                if metrics is None:
+                    metrics = self.peers[host] = PeerMetrics(self, host)
+        return metrics
+
+    def session_opened(self, peer):
+        """
+        Count a TCP session of the given peer; see session_closed().
+        """
+        from .capture import peer_host
+        host = peer_host(peer)
+        with self.lock:
+            self.sessions[host] = self.sessions.get(host, 0) + 1
+
+    def session_closed(self, peer):
+        """
+        Forget the metrics of the host of the given peer once its last
+        TCP session is closed, so that routers that went away do not
+        stay in the metrics forever.
+        """
+        from .capture import peer_host
+        host = peer_host(peer)
+        with self.lock:
+            count = self.sessions.get(host, 0) - 1
+            if count > 0:
+                self.sessions[host] = count
+                return
+            self.sessions.pop(host, None)
+            metrics = self.peers.pop(host, None)
+        if metrics is not None:
+            metrics.remove()
+
+    def decode_error(self, schema_path):
+        self.decode_errors.labels(schema_path or '').inc()
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+class MetricsServer(object):
+    """
+    Serves the metrics of a registry over HTTP, at /metrics, from a
+    background thread.
+    """
+
+    def __init__(self, registry, address='127.0.0.1', port=9273):
+        """
+        @type registry: MetricsRegistry
+        @param registry: The metrics to serve.
+        @type port: int
+        @param port: The port to listen on; 0 picks a free one.
+        """
+        self.registry = registry
+        self.address = address
+        self.port = port
+        self.httpd = None
+
+    def start(self):
+        self.httpd = HTTPServer((self.address, self.port), _MetricsHandler)
+        self.httpd.registry = self.registry
+        self.port = self.httpd.server_address[1]
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
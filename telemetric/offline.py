@@ -0,0 +1,218 @@
+from __future__ import absolute_import
+import os
+import json
+import struct
+import logging
+import multiprocessing
+from .gpb import GPBDecoder
+from .client import TCPMsgType, TCP_FLAG_ZLIB_COMPRESSION, \
+                    JSONv1Handler, JSONv2Handler
+from .capture import CaptureReader, TRANSPORT_UDP
+from .pipeline import decode_record
+
+logger = logging.getLogger()
+
+FORMATS = ('ndjson', 'npz')
+_RESET_TLV = struct.pack('>I', 1)
+
+# The decoder of the current worker process.
+_decoder = None
+
+def _init_worker(protos, output_dir, include_dir):
+    global _decoder
+    _decoder = GPBDecoder(protos, output_dir, include_dir)
+
+def plan_chunks(reader, chunk_size=64*1024*1024):
+    """
+    Split a capture into chunks of about chunk_size payload bytes that can
+    be decoded independently of each other.
+
+    The frames of a TCP session may depend on the zlib state left by the
+    frames before them. A session is therefore only split where its
+    compressor is reset, or while it has not sent compressed data since the
+    last reset. UDP frames can always be split.
+
+    Returns a list of chunks. Each chunk is a list of segments, and each
+    segment is a list of frame offsets of one session, in order.
+    """
+    segments = {}
+    dirty = {}
+    done = []
+    for offset, frame in reader.scan():
+        key = frame.transport, frame.peer
+        if frame.transport == TRANSPORT_UDP:
+            reset = compressed = False
+        elif frame.version == 1:
+            reset = frame.payload[:4] == _RESET_TLV
+            compressed = True
+        else:
+            reset = frame.msg_type == TCPMsgType.RESET_COMPRESSOR
+            compressed = frame.flags & TCP_FLAG_ZLIB_COMPRESSION != 0
+        can_split = reset or not dirty.get(key)
+        if reset:
+            dirty[key] = False
+        if compressed:
+            dirty[key] = True
+
+        segment = segments.get(key)
+        if segment is not None and can_split and segment[1] >= chunk_size:
+            done.append(segment)
+            segment = None
+        if segment is None:
+            segment = segments[key] = [[], 0]
+        segment[0].append(offset)
+        segment[1] += len(frame.payload)
+    done.extend(segments.values())
+
+    # Pack the segments into chunks.
+    chunks = []
+    chunk = []
+    size = 0
+    for offsets, segment_size in done:
+        chunk.append(offsets)
+        size += segment_size
+        if size >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def _iter_messages(reader, segment):
+    # Yields (frame, msg_type, payload) for each decompressed message of a
+    # segment, using fresh handlers like a new session would.
+    messages = []
+    def collect(msg_type, payload, peer):
+        messages.append((msg_type, payload))
+    v1handler = JSONv1Handler(None, collect)
+    v2handler = JSONv2Handler(None, collect)
+    for offset in segment:
+        frame = reader.read(offset)
+        if frame.transport == TRANSPORT_UDP:
+            yield frame, TCPMsgType.GPB_COMPACT, frame.payload
+            continue
+        if frame.version == 1:
+            v1handler.handle_payload(frame.payload)
+        else:
+            v2handler.handle_payload(frame.msg_type, frame.flags, frame.payload)
+        for msg_type, payload in messages:
+            yield frame, msg_type, payload
+        del messages[:]
+
+def _write_ndjson(reader, chunk, filename, stats):
+    with open(filename, 'w') as f:
+        for segment in chunk:
+            for frame, msg_type, payload in _iter_messages(reader, segment):
+                try:
+                    record = decode_record(_decoder, msg_type, payload)
+                except Exception as e:
+                    logger.error("failed to decode message from {}: {}".format(
+                                 frame.peer, e))
+                    stats['errors'] += 1
+                    continue
+                f.write(json.dumps({'timestamp': frame.timestamp,
+                                    'peer': frame.peer,
+                                    'msg_type': msg_type,
+                                    'record': record}))
+                f.write('\n')
+                stats['records'] += 1
+
+def _write_npz(reader, chunk, filename, stats):
+    import numpy
+    from .columnar import ColumnarBatcher
+    batches = []
+    batcher = ColumnarBatcher(batches.append, max_rows=65536,
+                              max_delay=float('inf'))
+    for segment in chunk:
+        for frame, msg_type, payload in _iter_messages(reader, segment):
+            try:
+                if msg_type == TCPMsgType.GPB_COMPACT:
+                    batcher.add_compact(_decoder.decode_compact_lazy(payload))
+                elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+                    batcher.add_kv(_decoder.parse_kv(payload), frame.peer)
+                else:
+                    continue
+            except Exception as e:
+                logger.error("failed to decode message from {}: {}".format(
+                             frame.peer, e))
+                stats['errors'] += 1
+                continue
+            stats['records'] += 1
+    batcher.flush()
+
+    arrays = {}
+    counts = {}
+    for batch in batches:
+        n = counts.get(batch.path, 0)
+        counts[batch.path] = n + 1
+        for column, values in batch.columns.items():
+            arrays['{}/{}/{}'.format(batch.path, n, column)] = values
+    with open(filename, 'wb') as f:
+        numpy.savez(f, **arrays)
+
+def _decode_chunk(filename, index, chunk, output_dir, output_format):
+    stats = {'chunk': index, 'frames': 0, 'records': 0, 'errors': 0}
+    output = os.path.join(output_dir, 'chunk-{:06d}.{}'.format(index,
+                                                               output_format))
+    stats['output'] = output
+    with CaptureReader(filename) as reader:
+        if output_format == 'npz':
+            _write_npz(reader, chunk, output, stats)
+        else:
+            _write_ndjson(reader, chunk, output, stats)
+    stats['frames'] = sum(len(segment) for segment in chunk)
+    return stats
+
+def _decode_chunk_args(args):
+    return _decode_chunk(*args)
+
+def decode_capture(filename, output_dir, protos=(),
+                   proto_output_dir='~/.telemetric/proto',
+                   proto_include_dir=(),
+                   processes=None,
+                   chunk_size=64*1024*1024,
+                   output_format='ndjson'):
+    """
+    Decode a capture file (see CaptureWriter) on a pool of worker
+    processes. The capture is split into chunks with plan_chunks(), and
+    each chunk is decoded into its own output file, named
+    chunk-<number>.<format>. Smaller chunks than chunk_size are used if
+    needed to give every process at least four chunks:
+
+      - ndjson: one JSON object per message, with the capture timestamp,
+        the peer, the message type and the decoded record.
+      - npz: NumPy arrays from a ColumnarBatcher, named
+        <schema path>/<batch number>/<column>. Requires numpy.
+
+    Every worker maps the capture file itself, so frames are never copied
+    between processes.
+    Returns a list with a dict of statistics for each chunk.
+    """
+    if output_format not in FORMATS:
+        raise ValueError("unknown output format {}".format(output_format))
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    # Make sure that there are enough chunks to keep all workers busy.
+    processes = processes or multiprocessing.cpu_count()
+    with CaptureReader(filename) as reader:
+        chunk_size = max(1, min(chunk_size, reader.end // (processes * 4)))
+        chunks = plan_chunks(reader, chunk_size)
+    logger.info("decoding {} in {} chunks".format(filename, len(chunks)))
+
+    # Compile the protos before forking, so that the workers do not
+    # race each other compiling the same files.
+    GPBDecoder(list(protos), proto_output_dir, proto_include_dir)
+    pool = multiprocessing.Pool(processes,
+                                _init_worker,
+                                (list(protos),
+                                 proto_output_dir,
+                                 proto_include_dir))
+    try:
+        args = [(filename, index, chunk, output_dir, output_format)
+                for index, chunk in enumerate(chunks)]
+        results = list(pool.imap_unordered(_decode_chunk_args, args))
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(results, key=lambda stats: stats['chunk'])
@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+import json
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from .gpb import GPBDecoder
+from .client import TCPMsgType
+
+logger = logging.getLogger()
+
+# The decoder of the current worker process.
+_decoder = None
+
+def _init_worker(protos, output_dir, include_dir):
+    global _decoder
+    _decoder = GPBDecoder(protos, output_dir, include_dir)
+
+def decode_record(decoder, msg_type, payload):
+    """
+    Decode a decompressed message into a dict.
+    """
+    if msg_type == TCPMsgType.GPB_COMPACT:
+        return decoder.compact_to_dict(payload)
+    elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+        return decoder.kv_to_dict(payload)
+    elif msg_type == TCPMsgType.JSON:
+        return json.loads(payload.decode('utf-8'))
+    raise ValueError("can not decode message type {}".format(msg_type))
+
+def _decode(msg_type, payload):
+    # Returns the record and None, or None and the error. Errors are not
+    # raised, as the pool of Python 2 has no error_callback.
+    try:
+        return decode_record(_decoder, msg_type, payload), None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+class DecodePool(object):
+    """
+    Decodes messages on a pool of worker processes, so that protobuf
+    parsing is not limited to the core that receives the data. Each worker
+    builds its own GPBDecoder once at startup.
+
+    Records are passed to the callback in the order in which the messages
+    of the same key (usually a connection) were submitted. Messages with
+    different keys do not wait for each other.
+    """
+
+    def __init__(self, callback, protos=(),
+                 proto_output_dir='~/.telemetric/proto',
+                 proto_include_dir=(),
+                 processes=None,
+                 max_pending=1024):
+        """
+        @type callback: callable
+        @param callback: Called as callback(key, msg_type, record) for each
+            decoded message. Called from a single thread.
+        @type protos: list(str)
+        @param protos: A list of protobuf filenames to load schemas from.
+        @type processes: int
+        @param processes: The number of workers. Defaults to the number of
+            CPUs.
+        @type max_pending: int
+        @param max_pending: submit() blocks while this many messages are
+            being decoded.
+        """
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = 0
+
+        # Compile the protos before forking, so that the workers do not
+        # race each other compiling the same files.
+        GPBDecoder(list(protos), proto_output_dir, proto_include_dir)
+        self.pool = multiprocessing.Pool(processes,
+                                         _init_worker,
+                                         (list(protos),
+                                          proto_output_dir,
+                                          proto_include_dir))
+
+    def submit(self, key, msg_type, payload):
+        """
+        Queue a raw, decompressed message for decoding.
+        """
+        self.slots.acquire()
+        entry = [False, msg_type, None]
+        with self.lock:
+            self.pending.setdefault(key, deque()).append(entry)
+
+        def done(result):
+            record, err = result
+            if err is not None:
+                logger.error("failed to decode message from {}: {}".format(
+                             key, err))
+                self.errors += 1
+            entry[2] = record
+            entry[0] = True
+            self._deliver(key)
+
+        self.pool.apply_async(_decode, (msg_type, bytes(payload)),
+                              callback=done)
+
+    def queued(self):
+        """
+        Returns the number of messages submitted but not yet delivered.
+        """
+        with self.lock:
+            return sum(len(queue) for queue in self.pending.values())
+
+    def _deliver(self, key):
+        # Pass on all records at the head of the queue that are complete.
+        ready = []
+        with self.lock:
+            queue = self.pending[key]
+            while queue and queue[0][0]:
+                ready.append(queue.popleft())
+            if not queue:
+                del self.pending[key]
+        for finished, msg_type, record in ready:
+            self.slots.release()
+            if record is not None:
+                self.callback(key, msg_type, record)
+
+    def close(self):
+        """
+        Wait until all submitted messages are decoded, then stop the
+        workers.
+        """
+        self.pool.close()
+        self.pool.join()
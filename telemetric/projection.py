@@ -0,0 +1,432 @@
+from __future__ import absolute_import
+import sys
+import struct
+from google.protobuf.descriptor import FieldDescriptor
+from .protoutil import is_repeated
+from .util import bytes_to_string
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH_DELIMITED = 2
+WIRE_START_GROUP = 3
+WIRE_END_GROUP = 4
+WIRE_FIXED32 = 5
+
+_float = struct.Struct("<f")
+_double = struct.Struct("<d")
+_int32 = struct.Struct("<i")
+_uint32 = struct.Struct("<I")
+_int64 = struct.Struct("<q")
+_uint64 = struct.Struct("<Q")
+
+def as_buffer(message):
+    """
+    Returns an object that can be indexed to get byte values as integers.
+    """
+    if sys.version_info[0] < 3:
+        return bytearray(message)
+    return memoryview(message)
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def skip_field(buf, pos, wire_type):
+    """
+    Returns the position after the value of a field with the given wire
+    type.
+    """
+    if wire_type == WIRE_VARINT:
+        while buf[pos] & 0x80:
+            pos += 1
+        return pos + 1
+    elif wire_type == WIRE_FIXED64:
+        return pos + 8
+    elif wire_type == WIRE_LENGTH_DELIMITED:
+        length, pos = read_varint(buf, pos)
+        return pos + length
+    elif wire_type == WIRE_FIXED32:
+        return pos + 4
+    elif wire_type == WIRE_START_GROUP:
+        while True:
+            key, pos = read_varint(buf, pos)
+            if key & 7 == WIRE_END_GROUP:
+                return pos
+            pos = skip_field(buf, pos, key & 7)
+    raise ValueError("invalid wire type {}".format(wire_type))
+
+###############################################################################
+# Value readers. Each returns (value, position after the value), converting
+# the value the same way as protoutil.proto_to_dict().
+###############################################################################
+def _read_uint(buf, pos):
+    return read_varint(buf, pos)
+
+def _read_int(buf, pos):
+    value, pos = read_varint(buf, pos)
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value, pos
+
+def _read_sint(buf, pos):
+    value, pos = read_varint(buf, pos)
+    return (value >> 1) ^ -(value & 1), pos
+
+def _read_bool(buf, pos):
+    value, pos = read_varint(buf, pos)
+    return value != 0, pos
+
+def _fixed_reader(fmt):
+    size = fmt.size
+    def read(buf, pos):
+        return fmt.unpack_from(buf, pos)[0], pos + size
+    return read
+
+def _read_string(buf, pos):
+    length, pos = read_varint(buf, pos)
+    end = pos + length
+    return bytes(buf[pos:end]).decode('utf-8'), end
+
+def _read_bytes(buf, pos):
+    length, pos = read_varint(buf, pos)
+    end = pos + length
+    return bytes_to_string(bytes(buf[pos:end])), end
+
+_READERS = {
+    FieldDescriptor.TYPE_DOUBLE: (_fixed_reader(_double), WIRE_FIXED64),
+    FieldDescriptor.TYPE_FLOAT: (_fixed_reader(_float), WIRE_FIXED32),
+    FieldDescriptor.TYPE_INT32: (_read_int, WIRE_VARINT),
+    FieldDescriptor.TYPE_INT64: (_read_int, WIRE_VARINT),
+    FieldDescriptor.TYPE_UINT32: (_read_uint, WIRE_VARINT),
+    FieldDescriptor.TYPE_UINT64: (_read_uint, WIRE_VARINT),
+    FieldDescriptor.TYPE_SINT32: (_read_sint, WIRE_VARINT),
+    FieldDescriptor.TYPE_SINT64: (_read_sint, WIRE_VARINT),
+    FieldDescriptor.TYPE_FIXED32: (_fixed_reader(_uint32), WIRE_FIXED32),
+    FieldDescriptor.TYPE_FIXED64: (_fixed_reader(_uint64), WIRE_FIXED64),
+    FieldDescriptor.TYPE_SFIXED32: (_fixed_reader(_int32), WIRE_FIXED32),
+    FieldDescriptor.TYPE_SFIXED64: (_fixed_reader(_int64), WIRE_FIXED64),
+    FieldDescriptor.TYPE_BOOL: (_read_bool, WIRE_VARINT),
+    FieldDescriptor.TYPE_ENUM: (_read_int, WIRE_VARINT),
+    FieldDescriptor.TYPE_STRING: (_read_string, WIRE_LENGTH_DELIMITED),
+    FieldDescriptor.TYPE_BYTES: (_read_bytes, WIRE_LENGTH_DELIMITED),
+}
+
+###############################################################################
+# Message scanners
+###############################################################################
+def _path_tree(field_paths, separator):
+    """
+    Turns ["a.b", "a.c", "d"] into {"a": {"b": {}, "c": {}}, "d": {}}.
+    An empty dict selects everything below the node.
+    """
+    tree = {}
+    for path in field_paths:
+        node = tree
+        for name in path.split(separator):
+            node = node.setdefault(name, {})
+    return tree
+
+def _make_scanner(fields):
+    def scan(buf, pos, end):
+        result = {}
+        while pos < end:
+            key, pos = read_varint(buf, pos)
+            wire_type = key & 7
+            field = fields.get(key >> 3)
+            if field is None:
+                pos = skip_field(buf, pos, wire_type)
+                continue
+            name, repeated, read, field_wire_type = field
+            if wire_type != field_wire_type:
+                if not repeated or wire_type != WIRE_LENGTH_DELIMITED:
+                    # Not the type of the field; skip it like protobuf
+                    # does with unknown fields.
+                    pos = skip_field(buf, pos, wire_type)
+                    continue
+                # A packed repeated scalar.
+                length, pos = read_varint(buf, pos)
+                packed_end = pos + length
+                values = result.setdefault(name, [])
+                while pos < packed_end:
+                    value, pos = read(buf, pos)
+                    values.append(value)
+                continue
+            value, pos = read(buf, pos)
+            if repeated:
+                result.setdefault(name, []).append(value)
+            else:
+                result[name] = value
+        return result
+    return scan
+
+def _message_reader(scan):
+    def read(buf, pos):
+        length, pos = read_varint(buf, pos)
+        end = pos + length
+        return scan(buf, pos, end), end
+    return read
+
+# Scanners that decode all fields of a message, by descriptor. Scanners are
+# only added once complete, so other threads never see one being built.
+_full_scanners = {}
+
+def _compile(descriptor, tree, building):
+    if not tree:
+        scan = building.get(descriptor) or _full_scanners.get(descriptor)
+        if scan is not None:
+            return scan
+
+    # Register the scanner before compiling its children, so that
+    # recursive message types refer to themselves. Until it is complete,
+    # only this call sees it, through building.
+    fields = {}
+    scan = _make_scanner(fields)
+    if not tree:
+        building[descriptor] = scan
+        selected = [(field, None) for field in descriptor.fields]
+    else:
+        selected = []
+        for name, subtree in tree.items():
+            field = descriptor.fields_by_name.get(name)
+            if field is None:
+                raise ValueError("{} has no field {}".format(
+                                 descriptor.full_name, name))
+            selected.append((field, subtree))
+
+    for field, subtree in selected:
+        if field.type == FieldDescriptor.TYPE_MESSAGE:
+            read = _message_reader(_compile(field.message_type, subtree,
+                                            building))
+            wire_type = WIRE_LENGTH_DELIMITED
+        elif subtree:
+            raise ValueError("{}.{} has no fields".format(descriptor.full_name,
+                                                          field.name))
+        else:
+            read, wire_type = _READERS[field.type]
+        fields[field.number] = (field.name, is_repeated(field), read, wire_type)
+    return scan
+
+def compile_scanner(descriptor, field_paths=None):
+    """
+    Compile a function that decodes the given fields of a message straight
+    from the protobuf wire format. Fields that were not selected are skipped
+    by their tag and length, without creating protobuf objects.
+
+    @type descriptor: Descriptor
+    @param descriptor: The descriptor of the message type.
+    @type field_paths: list(str)
+    @param field_paths: Dotted field names, such as "bytes_received" or
+        "queues.packets". A path to a message field selects all of its
+        fields. If None, all fields are selected.
+    @rtype: callable
+    @return: A function scan(buf, start, end) that returns a dict like
+        proto_to_dict(), restricted to the given fields. buf must be
+        indexable by byte, see as_buffer().
+    """
+    building = {}
+    scan = _compile(descriptor, _path_tree(field_paths or [], '.'), building)
+    _full_scanners.update(building)
+    return scan
+
+def forget_scanners(descriptors):
+    """
+    Drop the cached full scanners of the given message types, e.g. when
+    their schema is unloaded.
+    """
+    for descriptor in descriptors:
+        _full_scanners.pop(descriptor, None)
+
+def iter_compact_rows(buf, scanners):
+    """
+    Scans a TelemetryHeader message and yields (policy_path, row) for the
+    rows of every table whose policy path has a scanner. Rows of other
+    tables are never looked at.
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        if key != (7 << 3 | WIRE_LENGTH_DELIMITED): # tables
+            pos = skip_field(buf, pos, key & 7)
+            continue
+        length, pos = read_varint(buf, pos)
+        table_end = pos + length
+        policy_path = None
+        rows = []
+        while pos < table_end:
+            key, pos = read_varint(buf, pos)
+            if key == (1 << 3 | WIRE_LENGTH_DELIMITED):
+                policy_path, pos = _read_string(buf, pos)
+            elif key == (2 << 3 | WIRE_LENGTH_DELIMITED):
+                length, pos = read_varint(buf, pos)
+                rows.append((pos, pos + length))
+                pos += length
+            else:
+                pos = skip_field(buf, pos, key & 7)
+        scan = scanners.get(policy_path)
+        if scan is not None:
+            for row_start, row_end in rows:
+                yield policy_path, scan(buf, row_start, row_end)
+
+###############################################################################
+# Key-value (TelemetryField) scanning
+###############################################################################
+_KV_VALUE_READERS = {
+    4: _READERS[FieldDescriptor.TYPE_BYTES][0],
+    5: _read_string,
+    6: _read_bool,
+    7: _read_uint,
+    8: _read_uint,
+    9: _read_sint,
+    10: _read_sint,
+    11: _READERS[FieldDescriptor.TYPE_DOUBLE][0],
+    12: _READERS[FieldDescriptor.TYPE_FLOAT][0],
+}
+
+def _read_kv_field(buf, pos, end):
+    """
+    Decodes one level of a TelemetryField. Returns (name, value_number,
+    value_pos, children), where name is not yet decoded from UTF-8, the
+    value is only located, and children is a list of (start, end) spans.
+    """
+    name = None
+    value_number = None
+    value_pos = None
+    children = []
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        number = key >> 3
+        if number == 2:
+            length, pos = read_varint(buf, pos)
+            name = bytes(buf[pos:pos+length])
+            pos += length
+            continue
+        elif number == 15:
+            length, pos = read_varint(buf, pos)
+            children.append((pos, pos + length))
+            pos += length
+            continue
+        elif number in _KV_VALUE_READERS:
+            value_number = number
+            value_pos = pos
+        pos = skip_field(buf, pos, key & 7)
+    return name, value_number, value_pos, children
+
+def _walk_kv(buf, children, tree, prefix, result):
+    for start, end in children:
+        name, value_number, value_pos, grandchildren = _read_kv_field(buf,
+                                                                      start,
+                                                                      end)
+        if tree:
+            subtree = tree.get(name)
+            if subtree is None:
+                continue
+        else:
+            subtree = tree
+        path = prefix + (name or b'').decode('utf-8')
+        if grandchildren:
+            _walk_kv(buf, grandchildren, subtree, path + '/', result)
+        elif subtree:
+            continue
+        elif value_number is None:
+            result[path] = None
+        else:
+            result[path] = _KV_VALUE_READERS[value_number](buf, value_pos)[0]
+
+def iter_kv_entries(buf, trees):
+    """
+    Scans a Telemetry (key-value) message. For each top-level field of a
+    message whose base path has a key tree, yields (base_path, timestamp,
+    values), where values maps the selected key paths to their values.
+    """
+    pos = 0
+    end = len(buf)
+    base_path = None
+    entries = []
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        if key == (2 << 3 | WIRE_LENGTH_DELIMITED):
+            base_path, pos = _read_string(buf, pos)
+        elif key == (14 << 3 | WIRE_LENGTH_DELIMITED):
+            length, pos = read_varint(buf, pos)
+            entries.append((pos, pos + length))
+            pos += length
+        else:
+            pos = skip_field(buf, pos, key & 7)
+
+    tree = trees.get(base_path)
+    if tree is None:
+        return
+    for start, entry_end in entries:
+        timestamp = 0
+        children = []
+        pos = start
+        while pos < entry_end:
+            key, pos = read_varint(buf, pos)
+            if key == (1 << 3 | WIRE_VARINT):
+                timestamp, pos = read_varint(buf, pos)
+            elif key == (15 << 3 | WIRE_LENGTH_DELIMITED):
+                length, pos = read_varint(buf, pos)
+                children.append((pos, pos + length))
+                pos += length
+            else:
+                pos = skip_field(buf, pos, key & 7)
+        values = {}
+        _walk_kv(buf, children, tree, '', values)
+        yield base_path, timestamp, values
+
+def compile_kv_paths(key_paths):
+    """
+    Compile the given key paths, such as "content/bytes-received", for
+    iter_kv_entries(). A path to an inner node selects all leaves below it.
+    """
+    paths = [p.encode('utf-8') for p in key_paths]
+    return _path_tree(paths, b'/')
+
+###############################################################################
+# Schema paths
+###############################################################################
+def peek_policy_path(buf):
+    """
+    Returns the policy path of the first table of a TelemetryHeader
+    message, or None, without parsing the rest of the message.
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        if key != (7 << 3 | WIRE_LENGTH_DELIMITED): # tables
+            pos = skip_field(buf, pos, key & 7)
+            continue
+        length, pos = read_varint(buf, pos)
+        table_end = pos + length
+        while pos < table_end:
+            key, pos = read_varint(buf, pos)
+            if key == (1 << 3 | WIRE_LENGTH_DELIMITED):
+                return _read_string(buf, pos)[0]
+            pos = skip_field(buf, pos, key & 7)
+    return None
+
+def peek_string(buf, number):
+    """
+    Returns the value of the top-level string field with the given number
+    of a message, or None, without parsing the rest of the message. E.g.
+    the base path (2) of a key-value Telemetry message, or the identifier
+    (4) of a TelemetryHeader.
+    """
+    wanted = number << 3 | WIRE_LENGTH_DELIMITED
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        if key == wanted:
+            return _read_string(buf, pos)[0]
+        pos = skip_field(buf, pos, key & 7)
+    return None
@@ -1,59 +1,254 @@
 from __future__ import absolute_import
 import os
+import re
 import sys
-from subprocess import check_call, CalledProcessError
+import json
+import hashlib
+from subprocess import Popen, CalledProcessError
 from google.protobuf.descriptor import FieldDescriptor
+from .util import bytes_to_string
 
 if sys.version_info[0] >= 3:
     long = int
     unicode = str
 
-def compile_proto_file(input_files, output_path, include_path):
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+def parse_schema_from_proto(input_file):
     """
-    Compile a .proto file using protoc.
-    The compiled files are stored in the given output path.
-    Returns the list of compiled filenames.
+    Find the schema path and corresponding message definition in a .proto file
     """
-    # Init the output dir.
-    output_path = os.path.expanduser(output_path)
-    if not os.path.isdir(output_path):
-        os.makedirs(output_path)
+    message_re = re.compile(r'^message (\S+)')
+    schema_path_re = re.compile(r'.*schema_path = "(\S+)"')
+    message_name = None
+    schema_path = None
+
+    with open(os.path.expanduser(input_file)) as f:
+        for line in f.readlines():
+            # Look for the first instance of the string "message <message_name>"
+            if message_name is None:
+                match = message_re.match(line)
+                if match:
+                    message_name = match.group(1)
+                continue
+
+            # Look for "...schema_path = <schema_path>"
+            match = schema_path_re.search(line)
+            if match:
+                schema_path = match.group(1)
+                break
 
-    # Assemble the include path.
-    include_path = ':'.join(os.path.expanduser(p) for p in include_path)
+    return schema_path, message_name
 
-    compiled_names = []
+_import_re = re.compile(r'^\s*import\s+(?:public\s+|weak\s+)?"([^"]+)"\s*;',
+                        re.MULTILINE)
+
+def _find_imports(filename, include_path, found):
+    """
+    Add the files imported by the given .proto file, directly or
+    indirectly, to the list found. Imports that cannot be found in the
+    include path are ignored; protoc reports them.
+    """
+    with open(filename) as f:
+        imports = _import_re.findall(f.read())
+    for name in imports:
+        for dirname in include_path:
+            path = os.path.join(dirname, name)
+            if os.path.isfile(path):
+                if path not in found:
+                    found.append(path)
+                    _find_imports(path, include_path, found)
+                break
+
+def _hash_files(filenames, hashes):
+    """
+    Returns a hash over the contents of the given files. The hashes of
+    single files are memoized in the given dict.
+    """
+    digest = hashlib.sha1()
+    for filename in filenames:
+        file_hash = hashes.get(filename)
+        if file_hash is None:
+            try:
+                with open(filename, 'rb') as f:
+                    file_hash = hashlib.sha1(f.read()).hexdigest()
+            except (IOError, OSError):
+                file_hash = ''
+            hashes[filename] = file_hash
+        digest.update(file_hash.encode('ascii'))
+    return digest.hexdigest()
+
+def _load_manifest(output_path):
+    try:
+        with open(os.path.join(output_path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('protos', {})
+
+def _save_manifest(output_path, protos):
+    # Write to a temporary file first, so that concurrent readers never
+    # see a partial manifest.
+    filename = os.path.join(output_path, MANIFEST_NAME)
+    tmp_filename = '{}.{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'protos': protos}, f,
+                  indent=1, sort_keys=True)
+    os.rename(tmp_filename, filename)
+
+def _run_protoc(filenames, output_path, include_path):
+    """
+    Compile the given files with one protoc invocation per directory. The
+    invocations run in parallel.
+    """
+    by_dir = {}
+    for filename in filenames:
+        by_dir.setdefault(os.path.dirname(filename), []).append(filename)
+
+    processes = []
+    for dirname, group in sorted(by_dir.items()):
+        include = ':'.join([dirname] + include_path)
+        command = ["protoc", "--python_out", output_path, "-I", include]
+        try:
+            processes.append((command + group, Popen(command + group)))
+        except OSError:
+            sys.stderr.write("The program 'protoc' is required but not installed")
+            raise
+    failed = None
+    for command, process in processes:
+        if process.wait() != 0:
+            failed = CalledProcessError(process.returncode, command)
+    if failed is not None:
+        raise failed
+
+def _update_manifest(manifest, input_files, output_path, include_path):
+    """
+    Returns the manifest entries of the given files, and whether any entry
+    changed. Entries of files whose content hash changed are recreated,
+    which scans them for the schema path and imports.
+    """
+    hashes = {}
+    entries = []
+    changed = False
     for filename in input_files:
-        filename = os.path.expanduser(filename)
+        filename = os.path.abspath(os.path.expanduser(filename))
 
         # Check if the file exists.
         if not os.path.isfile(filename):
             raise ValueError("file {} does not exist".format(filename))
 
-        # Assemble compiled filename to return to caller.
+        # Check if the file is unchanged, with the same imports.
+        entry = manifest.get(filename)
+        if entry is not None \
+           and entry['include_path'] == include_path \
+           and entry['hash'] == _hash_files([filename] + entry['imports'],
+                                            hashes):
+            entries.append((filename, entry))
+            continue
+
+        imports = []
+        _find_imports(filename,
+                      [os.path.dirname(filename)] + include_path,
+                      imports)
         basename = os.path.basename(filename)
         name, ext = os.path.splitext(basename)
-        compiled_name = os.path.join(output_path, name + "_pb2.py")
-        compiled_names.append(compiled_name)
+        schema_path, message_name = parse_schema_from_proto(filename)
+        entry = {'include_path': include_path,
+                 'imports': imports,
+                 'hash': _hash_files([filename] + imports, hashes),
+                 'compiled': os.path.join(output_path, name + "_pb2.py"),
+                 'compiled_hash': None,
+                 'schema_path': schema_path,
+                 'message_name': message_name}
+        manifest[filename] = entry
+        entries.append((filename, entry))
+        changed = True
+    return entries, changed
 
-        # Check if the file was already compiled.
-        if os.path.isfile(compiled_name):
-            if os.path.getmtime(compiled_name) >= os.path.getmtime(filename):
-                continue
+def _prepare_paths(output_path, include_path):
+    output_path = os.path.expanduser(output_path)
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    include_path = [os.path.abspath(os.path.expanduser(p))
+                    for p in include_path]
+    return output_path, include_path
 
-        # Compile.
-        dirname = os.path.dirname(filename)
-        include = dirname + ':' + include_path
-        command = ["protoc", "--python_out", output_path, "-I", include]
-        try:
-            check_call(command + [filename])
-        except OSError:
-            sys.stderr.write("The program 'protoc' is required but not installed")
-            raise
-        except CalledProcessError:
-            raise
+def index_protos(input_files, output_path, include_path):
+    """
+    Find the schema path and message name of each of the given .proto
+    files without compiling them. The results are kept in the same
+    manifest as compile_protos() uses, so unchanged files are not scanned
+    again.
+    Returns a list of (filename, schema_path, message_name), one per input
+    file.
+    """
+    output_path, include_path = _prepare_paths(output_path, include_path)
+    manifest = _load_manifest(output_path)
+    entries, changed = _update_manifest(manifest, input_files, output_path,
+                                        include_path)
+    if changed:
+        _save_manifest(output_path, manifest)
+    return [(filename, e['schema_path'], e['message_name'])
+            for filename, e in entries]
+
+def compile_protos(input_files, output_path, include_path):
+    """
+    Compile .proto files using protoc, and find the schema path and message
+    name of each.
+    The compiled files are stored in the given output path, along with a
+    manifest that maps the content hash of each .proto file and the files
+    it imports to the compiled file and schema. Only files whose hash
+    changed are compiled, all in one batch, along with any files they
+    import that are not compiled yet.
+    Returns a list of (compiled_name, schema_path, message_name), one per
+    input file.
+    """
+    output_path, include_path = _prepare_paths(output_path, include_path)
+    manifest = _load_manifest(output_path)
+    entries, changed = _update_manifest(manifest, input_files, output_path,
+                                        include_path)
+    results = [e for filename, e in entries]
+
+    # The generated modules import the modules of the files their protos
+    # import, so those are compiled as well.
+    input_names = set(filename for filename, e in entries)
+    imports = []
+    for filename, entry in entries:
+        for name in entry['imports']:
+            if name not in input_names:
+                input_names.add(name)
+                imports.append(name)
+    if imports:
+        import_entries, import_changed = _update_manifest(manifest, imports,
+                                                          output_path,
+                                                          include_path)
+        entries += import_entries
+        changed = changed or import_changed
+
+    stale = [filename for filename, entry in entries
+             if entry.get('compiled_hash') != entry['hash']
+             or not os.path.isfile(entry['compiled'])]
+    if stale:
+        _run_protoc(stale, output_path, include_path)
+        for filename, entry in entries:
+            entry['compiled_hash'] = entry['hash']
+    if stale or changed:
+        _save_manifest(output_path, manifest)
 
-    return compiled_names
+    return [(e['compiled'], e['schema_path'], e['message_name'])
+            for e in results]
+
+def compile_proto_file(input_files, output_path, include_path):
+    """
+    Compile a .proto file using protoc.
+    The compiled files are stored in the given output path.
+    Returns the list of compiled filenames.
+    """
+    return [compiled for compiled, schema_path, message_name
+            in compile_protos(input_files, output_path, include_path)]
 
 ###############################################################################
 # Protobuf to dict conversion
@@ -78,6 +273,16 @@ DECODE_FN_MAP = {
 }
 
 
+def is_repeated(field):
+    """
+    Return whether the given FieldDescriptor is repeated. Newer protobuf
+    releases no longer have FieldDescriptor.label.
+    """
+    try:
+        return field.is_repeated
+    except AttributeError:
+        return field.label == FieldDescriptor.LABEL_REPEATED
+
 def field_type_to_fn(msg, field):
     if field.type == FieldDescriptor.TYPE_MESSAGE:
         # For embedded messages recursively call this function. If it is
@@ -90,18 +295,107 @@ def field_type_to_fn(msg, field):
                          msg.__class__.__name__, field.name, field.type))
     return result
 
-def proto_to_dict(msg):
-    result_dict = {}
-    extensions = {}
-    for field, value in msg.ListFields():
-        conversion_fn = field_type_to_fn(msg, field)
-        
-        # Skip extensions
-        if not field.is_extension:
-            # Repeated fields result in an array, otherwise just call the 
-            # conversion function to store the value
-            if field.label == FieldDescriptor.LABEL_REPEATED:
-                result_dict[field.name] = [conversion_fn(v) for v in value]
+def _scalar_converter(field):
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return bytes_to_string
+    if field.type not in DECODE_FN_MAP:
+        raise TypeError("Field %s.%s has unrecognised type id %d" % (
+                         field.containing_type.name, field.name, field.type))
+    # The protobuf runtime already returns numbers, bools and text as the
+    # Python types listed in DECODE_FN_MAP.
+    return None
+
+def _compile_field(field, building):
+    if field.type == FieldDescriptor.TYPE_MESSAGE:
+        conversion_fn = _compile_converter(field.message_type, (), building)
+    else:
+        conversion_fn = _scalar_converter(field)
+    name = field.name
+    if is_repeated(field):
+        if conversion_fn is None:
+            return name, list
+        return name, lambda value: [conversion_fn(v) for v in value]
+    if conversion_fn is None:
+        return name, None
+    return name, conversion_fn
+
+# Converters by (descriptor, skip). Converters are only added once
+# complete, so other threads never see one being built.
+_converters = {}
+
+def _compile_converter(descriptor, skip, building):
+    key = descriptor, skip
+    converter = building.get(key) or _converters.get(key)
+    if converter is not None:
+        return converter
+
+    # Maps each FieldDescriptor to (name, conversion function). Extensions
+    # are not in the map and therefore skipped. The converter is added to
+    # building before the map is filled, so that recursive message types
+    # terminate.
+    fields = {}
+    def converter(msg):
+        result_dict = {}
+        for field, value in msg.ListFields():
+            entry = fields.get(field)
+            if entry is None:
+                continue
+            name, conversion_fn = entry
+            if conversion_fn is None:
+                result_dict[name] = value
             else:
-                result_dict[field.name] = conversion_fn(value)
-    return result_dict
+                result_dict[name] = conversion_fn(value)
+        return result_dict
+    building[key] = converter
+
+    for field in descriptor.fields:
+        if field.name not in skip:
+            fields[field] = _compile_field(field, building)
+    return converter
+
+def compile_converter(descriptor, skip=()):
+    """
+    Returns a function that converts messages of the given type to a dict
+    like proto_to_dict() does. The conversion of each field is resolved
+    once per message type, and the functions are cached.
+
+    @type descriptor: Descriptor
+    @param descriptor: The message type.
+    @type skip: tuple(str)
+    @param skip: Names of top-level fields to leave out of the dict.
+    """
+    converter = _converters.get((descriptor, skip))
+    if converter is not None:
+        return converter
+    building = {}
+    converter = _compile_converter(descriptor, skip, building)
+    _converters.update(building)
+    return converter
+
+def iter_message_types(descriptor):
+    """
+    Yields the given message type and every message type reachable
+    through its fields, once each.
+    """
+    seen = set([descriptor])
+    stack = [descriptor]
+    while stack:
+        descriptor = stack.pop()
+        yield descriptor
+        for field in descriptor.fields:
+            message_type = field.message_type
+            if message_type is not None and message_type not in seen:
+                seen.add(message_type)
+                stack.append(message_type)
+
+def forget_converters(descriptors):
+    """
+    Drop the cached converters of the given message types, e.g. when
+    their schema is unloaded. They are compiled again if needed.
+    """
+    for key in list(_converters):
+        if key[0] in descriptors:
+            _converters.pop(key, None)
+
+def proto_to_dict(msg):
+    return compile_converter(msg.DESCRIPTOR)(msg)
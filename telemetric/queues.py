@@ -0,0 +1,284 @@
+from __future__ import absolute_import
+import time
+import logging
+import threading
+from collections import deque
+from .client import TCPMsgType
+from .capture import peer_host
+from .jsonscan import scan_json_keys
+from .projection import as_buffer, peek_policy_path, peek_string
+
+logger = logging.getLogger()
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+SAMPLE = 'sample'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, SAMPLE)
+
+def schema_path(msg_type, payload, json_key='encoding_path'):
+    """
+    Returns the schema path of a decompressed message (the policy path of
+    compact messages, the base path of key-value ones, the json_key member
+    of JSON), or '' if it has none. Only reads as far as needed.
+
+    @type json_key: str
+    @param json_key: The top-level key that holds the path of a JSON
+        message: 'encoding_path' for version 2 of the protocol, 'Policy'
+        for version 1.
+    """
+    try:
+        if msg_type == TCPMsgType.GPB_COMPACT:
+            path = peek_policy_path(as_buffer(payload))
+        elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+            path = peek_string(as_buffer(payload), 2)
+        elif msg_type == TCPMsgType.JSON:
+            path = scan_json_keys(payload, (json_key,)).get(json_key)
+        else:
+            path = None
+    except Exception:
+        path = None
+    return path or ''
+
+class BoundedQueue(object):
+    """
+    A queue between two stages of the collector that holds at most
+    maxsize items. When it is full, the policy decides what gives way:
+
+      - block: put() waits for room, which pushes back on the producer
+        (for TCP, the router's send window). An event loop must not
+        wait; it puts with wait=False and stops reading until
+        when_room() calls back.
+      - drop-oldest: the oldest item is dropped to make room, so the
+        consumer catches up to live data.
+      - drop-newest: the new item is dropped.
+      - sample: once the queue is half full, only every sample_every-th
+        item of each schema path is accepted, so that every schema keeps
+        reporting at a lower rate; new items are dropped when it is full.
+
+    Dropped items are counted in dropped and, if metrics are given, by
+    peer and schema path, as is the time items spend queued.
+    """
+
+    def __init__(self, name, maxsize, policy=BLOCK, schema=None,
+                 sample_every=10, metrics=None):
+        """
+        @type name: str
+        @param name: Identifies the queue in the metrics.
+        @type maxsize: int
+        @param maxsize: The maximum number of queued items.
+        @type policy: str
+        @param policy: One of POLICIES.
+        @type schema: callable
+        @param schema: Returns the schema path of an item. Only called
+            when needed, i.e. for sampling, drops and metrics, and at
+            most once per item.
+        @type sample_every: int
+        @param sample_every: With the sample policy, the share of items
+            per schema path that are accepted under load.
+        @type metrics: CollectorMetrics
+        @param metrics: If given, the depth, lag, drops and waiting time
+            are recorded.
+        """
+        if policy not in POLICIES:
+            raise ValueError("unknown queue policy: {}".format(policy))
+        if maxsize < 1:
+            raise ValueError("maxsize must be positive")
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.schema = schema or (lambda item: '')
+        self.sample_every = sample_every
+        self.metrics = metrics
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+        self.unfinished = 0
+        self.sampled = {}
+        self.room_waiters = []
+        self.dropped = 0
+        self.closed = False
+        if metrics is not None:
+            metrics.queue_depth.labels(name).set_function(self.__len__)
+            metrics.queue_lag.labels(name).set_function(self.lag)
+
+    def __len__(self):
+        return len(self.items)
+
+    def lag(self):
+        """
+        Returns the number of seconds the oldest item has been waiting.
+        """
+        try:
+            return time.time() - self.items[0][0]
+        except IndexError:
+            return 0
+
+    def _schema(self, entry):
+        # Returns the schema path of an entry, computed on first use.
+        if entry[3] is None:
+            entry[3] = self.schema(entry[2])
+        return entry[3]
+
+    def _drop(self, entry):
+        self.dropped += 1
+        if self.metrics is not None:
+            self.metrics.queue_dropped.labels(self.name, peer_host(entry[1]),
+                                              self._schema(entry)).inc()
+
+    def full(self):
+        """
+        Returns whether the queue holds maxsize items or more.
+        """
+        return len(self.items) >= self.maxsize
+
+    def _admit(self, entry, wait):
+        # Returns whether the entry may be queued, dropping entries as the
+        # policy says. Called with the lock held.
+        size = len(self.items)
+        if self.policy == SAMPLE and size >= self.maxsize // 2:
+            path = self._schema(entry)
+            count = self.sampled.get(path, 0)
+            self.sampled[path] = count + 1
+            if count % self.sample_every or size >= self.maxsize:
+                self._drop(entry)
+                return False
+            return True
+        if size < self.maxsize:
+            return True
+        if self.policy == DROP_OLDEST:
+            self._drop(self.items.popleft())
+            self._done()
+            return True
+        if self.policy == BLOCK:
+            while wait and len(self.items) >= self.maxsize and not self.closed:
+                self.not_full.wait()
+            return True
+        self._drop(entry)
+        return False
+
+    def put(self, item, peer=None, wait=True):
+        """
+        Queue an item received from the given peer. Returns False if the
+        item was dropped.
+
+        @type wait: bool
+        @param wait: With the block policy, whether to wait for room. If
+            False, the item is queued even if the queue is full, and the
+            caller must stop producing until when_room() calls back.
+        """
+        # The time queued, the peer, the item and its schema path.
+        entry = [time.time(), peer, item, None]
+        with self.lock:
+            if not self._admit(entry, wait):
+                return False
+            self.items.append(entry)
+            self.unfinished += 1
+            self.not_empty.notify()
+        return True
+
+    def get(self, timeout=None):
+        """
+        Returns the oldest item and its peer, waiting up to timeout
+        seconds (forever if None) for one. Returns None on timeout or
+        once the queue is closed and empty.
+        """
+        with self.lock:
+            if not self.items and not self.closed:
+                self.not_empty.wait(timeout)
+            if not self.items:
+                return None
+            entry = self.items.popleft()
+            queued, peer, item = entry[:3]
+            if self.policy == SAMPLE and not self.items:
+                self.sampled.clear()
+            self.not_full.notify()
+            waiters = None
+            if self.room_waiters and len(self.items) <= self.maxsize // 2:
+                waiters = self.room_waiters
+                self.room_waiters = []
+        if waiters:
+            self._wake(waiters)
+        if self.metrics is not None:
+            self.metrics.queue_wait.labels(self.name, peer_host(peer),
+                                           self._schema(entry)) \
+                                   .inc(time.time() - queued)
+        return item, peer
+
+    def when_room(self, callback):
+        """
+        Call callback() once the queue is at most half full: right away if
+        it is, otherwise on the thread whose get() makes room, or on
+        close().
+        """
+        with self.lock:
+            if len(self.items) > self.maxsize // 2 and not self.closed:
+                self.room_waiters.append(callback)
+                return
+        callback()
+
+    def _wake(self, waiters):
+        for callback in waiters:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("{} queue: failed to resume a producer: {}".format(
+                             self.name, e))
+
+    def _done(self):
+        self.unfinished -= 1
+        if not self.unfinished:
+            self.all_done.notify_all()
+
+    def task_done(self):
+        """
+        Mark an item returned by get() as handled; see join().
+        """
+        with self.lock:
+            self._done()
+
+    def join(self):
+        """
+        Wait until every queued item was dropped or handled.
+        """
+        with self.lock:
+            while self.unfinished:
+                self.all_done.wait()
+
+    def close(self):
+        """
+        Wake up all waiting threads; get() returns None once the queue is
+        drained.
+        """
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+            waiters = self.room_waiters
+            self.room_waiters = []
+        self._wake(waiters)
+
+    def serve(self, handler, threads=1):
+        """
+        Start threads that pass every item to handler(item, peer) until
+        the queue is closed. With one thread, items are handled in order.
+        """
+        def run():
+            while True:
+                entry = self.get()
+                if entry is None:
+                    if self.closed:
+                        return
+                    continue
+                try:
+                    handler(*entry)
+                except Exception as e:
+                    logger.error("{} queue: failed to handle item: {}".format(
+                                 self.name, e))
+                self.task_done()
+        for i in range(threads):
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
@@ -0,0 +1,234 @@
+from __future__ import absolute_import
+import os
+import sys
+import logging
+import threading
+from collections import OrderedDict, deque
+try:
+    from importlib.util import spec_from_file_location, module_from_spec
+except ImportError: # Python 2
+    from imp import load_source
+    spec_from_file_location = None
+from .protoutil import compile_protos, index_protos, iter_message_types, \
+                       forget_converters
+from .projection import forget_scanners
+
+logger = logging.getLogger()
+
+def load_module(module_name, filename):
+    """
+    Import a generated module from the given file. Modules that were
+    already loaded from the same file are reused. The importlib loader
+    also caches the compiled bytecode between runs.
+    """
+    dirname = os.path.dirname(filename)
+    if dirname not in sys.path:
+        sys.path.append(dirname)
+    module = sys.modules.get(module_name)
+    if module is not None and getattr(module, '__file__', None) == filename:
+        return module
+    if spec_from_file_location is None:
+        return load_source(module_name, filename)
+    spec = spec_from_file_location(module_name, filename)
+    module = module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except:
+        del sys.modules[module_name]
+        raise
+    return module
+
+def load_modules(filenames):
+    modules = {}
+    for filename in filenames:
+        basename = os.path.basename(filename)
+        module_name, ext = os.path.splitext(basename)
+        modules[module_name] = load_module(module_name, filename)
+    return modules
+
+class SchemaRegistry(object):
+    """
+    Maps schema paths to the protobuf classes of their rows. The given
+    .proto files are indexed by schema path up front, but only compiled and
+    imported when a schema path is first requested, either all at once
+    with load_all(), or one by one on a background thread.
+
+    If max_schemas is given, the least recently used schemas are unloaded
+    when more are loaded, along with the converters and scanners compiled
+    for them, and loaded again when they are requested. Caches of row
+    classes elsewhere should be weak (see iter_compact_samples()).
+    """
+
+    def __init__(self, protos, output_dir, include_dir, max_schemas=None):
+        """
+        @type protos: list(str)
+        @param protos: A list of protobuf filenames to load schemas from.
+        @type max_schemas: int
+        @param max_schemas: The maximum number of loaded schemas.
+        """
+        self.output_dir = output_dir
+        self.include_dir = include_dir
+        self.max_schemas = max_schemas
+        self.index = {}
+        for filename, schema_path, message_name in index_protos(protos,
+                                                                output_dir,
+                                                                include_dir):
+            self.index[schema_path] = filename, message_name
+
+        # The loaded row classes and their module names, in the order of
+        # their last use.
+        self.row_classes = OrderedDict()
+        self.module_names = {}
+        self.failed = set()
+
+        # Schema paths waiting to be loaded, and the number of deferred
+        # callbacks waiting for each of them.
+        self.loading = set()
+        self.pending = {}
+        self.lock = threading.Condition()
+        self.requests = deque()
+        self.loader = None
+
+    def _store(self, schema_path, module, message_name):
+        with self.lock:
+            self.row_classes[schema_path] = getattr(module, message_name)
+            self.module_names[schema_path] = module.__name__
+            self._evict()
+
+    def _evict(self):
+        if self.max_schemas is None:
+            return
+        while len(self.row_classes) > self.max_schemas:
+            schema_path, row_class = self.row_classes.popitem(last=False)
+            module_name = self.module_names.pop(schema_path)
+            if module_name not in self.module_names.values():
+                sys.modules.pop(module_name, None)
+            # The converters and scanners of the schema refer to its
+            # descriptors, so they would keep it loaded.
+            descriptors = set(iter_message_types(row_class.DESCRIPTOR))
+            forget_converters(descriptors)
+            forget_scanners(descriptors)
+            logger.debug("unloaded schema {}".format(schema_path))
+
+    def load_all(self):
+        """
+        Compile and import the modules of all indexed schemas at once.
+        """
+        paths = list(self.index)
+        filenames = [self.index[p][0] for p in paths]
+        compiled = compile_protos(filenames, self.output_dir, self.include_dir)
+        for schema_path, (compiled_name, schema, message_name) in zip(paths,
+                                                                      compiled):
+            module_name = os.path.splitext(os.path.basename(compiled_name))[0]
+            self._store(schema_path,
+                        load_module(module_name, compiled_name),
+                        message_name)
+
+    def _load(self, schema_path):
+        filename, message_name = self.index[schema_path]
+        try:
+            (compiled, schema, message_name), = compile_protos(
+                [filename], self.output_dir, self.include_dir)
+            module_name = os.path.splitext(os.path.basename(compiled))[0]
+            self._store(schema_path,
+                        load_module(module_name, compiled),
+                        message_name)
+            logger.info("loaded schema {}".format(schema_path))
+        except Exception as e:
+            logger.error("failed to load schema {}: {}".format(schema_path, e))
+            with self.lock:
+                self.failed.add(schema_path)
+
+    def _run_loader(self):
+        while True:
+            with self.lock:
+                while not self.requests:
+                    self.lock.wait()
+                request = self.requests.popleft()
+            schema_path, callback, paths = request
+            if callback is None:
+                if schema_path not in self.row_classes:
+                    self._load(schema_path)
+                with self.lock:
+                    self.loading.discard(schema_path)
+                    self.lock.notify_all()
+                continue
+            try:
+                callback()
+            except Exception as e:
+                logger.exception("deferred decoding failed: {}".format(e))
+            finally:
+                with self.lock:
+                    for path in paths:
+                        self.pending[path] -= 1
+                        if not self.pending[path]:
+                            del self.pending[path]
+
+    def _request(self, schema_path):
+        # Must be called with the lock held.
+        if schema_path in self.loading:
+            return
+        self.loading.add(schema_path)
+        self.requests.append((schema_path, None, None))
+        if self.loader is None:
+            self.loader = threading.Thread(target=self._run_loader)
+            self.loader.daemon = True
+            self.loader.start()
+        self.lock.notify_all()
+
+    def _is_missing(self, schema_path):
+        return schema_path not in self.row_classes \
+               and schema_path in self.index \
+               and schema_path not in self.failed
+
+    def get(self, schema_path):
+        """
+        Returns the row class of the given schema path, or None if it is
+        unknown. Waits for the schema to be loaded if necessary.
+        """
+        row_class = self.row_classes.get(schema_path)
+        if row_class is not None:
+            if self.max_schemas is not None:
+                with self.lock:
+                    if schema_path in self.row_classes:
+                        self.row_classes[schema_path] = \
+                            self.row_classes.pop(schema_path)
+            return row_class
+        if not self._is_missing(schema_path):
+            return None
+        if threading.current_thread() is self.loader:
+            # A deferred callback; the loader cannot wait for itself.
+            self._load(schema_path)
+            return self.row_classes.get(schema_path)
+        with self.lock:
+            if self._is_missing(schema_path):
+                self._request(schema_path)
+            while schema_path in self.loading:
+                self.lock.wait()
+            return self.row_classes.get(schema_path)
+
+    def defer(self, schema_paths, callback):
+        """
+        If any of the given schema paths still needs to be loaded, or has
+        deferred callbacks waiting for it, load them in the background and
+        call callback() on the loader thread once they are loaded, after
+        the callbacks deferred before. Returns True if the callback was
+        deferred, False if the schemas are ready and the caller may go
+        ahead.
+        """
+        if not self.pending \
+           and not any(self._is_missing(p) for p in schema_paths):
+            return False
+        with self.lock:
+            paths = [p for p in set(schema_paths)
+                     if self._is_missing(p) or p in self.pending]
+            if not paths:
+                return False
+            for path in paths:
+                if self._is_missing(path):
+                    self._request(path)
+                self.pending[path] = self.pending.get(path, 0) + 1
+            self.requests.append((None, callback, paths))
+            self.lock.notify_all()
+        return True
@@ -0,0 +1,170 @@
+from __future__ import absolute_import
+from collections import namedtuple
+from google.protobuf.descriptor import FieldDescriptor
+from .protoutil import is_repeated
+from .gpb import iter_kv_leaves
+from .client import TCPMsgType
+from .capture import peer_host
+
+# Field types of counters, with the value at which they wrap, and of
+# gauges. Other scalar fields are state (e.g. a status or a description).
+COUNTER_TYPES = {
+    FieldDescriptor.TYPE_UINT32: 2**32,
+    FieldDescriptor.TYPE_FIXED32: 2**32,
+    FieldDescriptor.TYPE_UINT64: 2**64,
+    FieldDescriptor.TYPE_FIXED64: 2**64,
+}
+GAUGE_TYPES = frozenset((FieldDescriptor.TYPE_DOUBLE,
+                         FieldDescriptor.TYPE_FLOAT,
+                         FieldDescriptor.TYPE_INT32,
+                         FieldDescriptor.TYPE_INT64,
+                         FieldDescriptor.TYPE_SINT32,
+                         FieldDescriptor.TYPE_SINT64,
+                         FieldDescriptor.TYPE_SFIXED32,
+                         FieldDescriptor.TYPE_SFIXED64))
+KEY_TYPES = frozenset((FieldDescriptor.TYPE_STRING,
+                       FieldDescriptor.TYPE_BYTES))
+
+# The same for key-value leaves, by oneof member.
+KV_COUNTER_TYPES = {'uint32_value': 2**32, 'uint64_value': 2**64}
+KV_GAUGE_TYPES = frozenset(('sint32_value', 'sint64_value',
+                            'double_value', 'float_value'))
+
+Sample = namedtuple('Sample', ['node', 'path', 'timestamp', 'value'])
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+STATE = 'state'
+KEY = 'key'
+
+def row_fields(descriptor, prefix='', attrs=()):
+    """
+    Yields (kind, name, attrs, wrap) for the scalar fields of a compact
+    row, descending into non-repeated sub-messages. kind is KEY for the
+    top-level string fields, which identify the row, or COUNTER, GAUGE or
+    STATE. wrap is the value at which a counter wraps, otherwise None.
+    """
+    for field in descriptor.fields:
+        if is_repeated(field):
+            continue
+        name = prefix + field.name
+        field_attrs = attrs + (field.name,)
+        if field.type == FieldDescriptor.TYPE_MESSAGE:
+            for item in row_fields(field.message_type, name + '.',
+                                   field_attrs):
+                yield item
+        elif field.type in COUNTER_TYPES:
+            yield COUNTER, name, field_attrs, COUNTER_TYPES[field.type]
+        elif field.type in GAUGE_TYPES:
+            yield GAUGE, name, field_attrs, None
+        elif field.type in KEY_TYPES and not prefix:
+            yield KEY, name, field_attrs, None
+        else:
+            yield STATE, name, field_attrs, None
+
+def _get(row, attrs):
+    for attr in attrs:
+        row = getattr(row, attr)
+    return row
+
+def iter_compact_samples(message, cache, states=False):
+    """
+    Yields (path, value, timestamp, wrap) for the fields of every row of a
+    CompactMessage. The path is the schema path, the key fields of the row
+    in brackets, and the field name, e.g.
+    "RootOper.Interface[interface_name=Gi0/0/0/0]/bytes_received". wrap
+    is None except for counters. State fields are only included if states
+    is True. Tables without a known schema are skipped.
+
+    @type cache: weakref.WeakKeyDictionary
+    @param cache: Caches the result of row_fields() by row class. Use a
+        weak dict, so that schemas unloaded by the SchemaRegistry are not
+        kept alive.
+    """
+    timestamp = message.end_time or message.start_time
+    for table in message.tables:
+        row_class = table.row_class
+        if row_class is None:
+            continue
+        fields = cache.get(row_class)
+        if fields is None:
+            fields = cache[row_class] = list(row_fields(row_class.DESCRIPTOR))
+        for row in table:
+            keys = ','.join('{}={}'.format(name, _get(row, attrs))
+                            for kind, name, attrs, wrap in fields
+                            if kind == KEY)
+            prefix = '{}[{}]/'.format(table.policy_path, keys) \
+                     if keys else table.policy_path + '/'
+            for kind, name, attrs, wrap in fields:
+                if kind == KEY or (kind == STATE and not states):
+                    continue
+                yield prefix + name, _get(row, attrs), timestamp, wrap
+
+def iter_kv_samples(header, states=False):
+    """
+    Like iter_compact_samples(), but for the entries of a key-value
+    Telemetry message. The leaves below "keys" identify an entry and the
+    leaves below "content" (or of the whole entry if there is no "keys"
+    field) are its values, e.g.
+    "Cisco-IOS-XR-infra-statsd-oper[interface-name=Gi0/0/0/0]/bytes-sent".
+    """
+    base_path = header.base_path
+    for entry in header.fields:
+        timestamp = entry.timestamp or header.msg_timestamp
+        keys = content = None
+        for child in entry.fields:
+            if child.name == 'keys':
+                keys = child
+            elif child.name == 'content':
+                content = child
+        if keys is None:
+            prefix = base_path + '/'
+            content = entry
+        else:
+            prefix = '{}[{}]/'.format(base_path, ','.join(
+                '{}={}'.format(path, value)
+                for path, value_name, value, ts in iter_kv_leaves(keys)))
+        if content is None:
+            continue
+        for path, value_name, value, ts in iter_kv_leaves(content):
+            wrap = KV_COUNTER_TYPES.get(value_name)
+            if wrap is not None or states or value_name in KV_GAUGE_TYPES:
+                yield prefix + path, value, timestamp, wrap
+
+def kv_node(subscription, peer=None):
+    """
+    Returns the node that the series of a key-value Telemetry message are
+    filed under: the given subscription identifier of the message,
+    qualified with the host of the peer it came from as in
+    "sub1@10.0.0.1". Unlike the identifier of
+    compact messages, subscription names are usually the same on every
+    router, so they do not tell the routers apart on their own.
+
+    @type peer: tuple|str
+    @param peer: The socket address of the router, as passed to the
+        callback of a TMClient, or a "host:port" string as in captures.
+        The port is left out, as it changes with every connection.
+    """
+    if peer is None:
+        return subscription
+    return '{}@{}'.format(subscription, peer_host(peer))
+
+def iter_samples(decoder, msg_type, payload, cache, node=None, peer=None):
+    """
+    Decode a compact or key-value message with the given GPBDecoder and
+    yield a Sample for each of its values, including state fields. node
+    defaults to the identifier of compact messages and to kv_node() of
+    key-value ones from the given peer. Other messages yield nothing.
+    """
+    if msg_type == TCPMsgType.GPB_COMPACT:
+        message = decoder.decode_compact_lazy(payload)
+        node = node or message.identifier
+        samples = iter_compact_samples(message, cache, states=True)
+    elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+        header = decoder.parse_kv(payload)
+        node = node or kv_node(header.subscription_identifier, peer)
+        samples = iter_kv_samples(header, states=True)
+    else:
+        return
+    for path, value, timestamp, wrap in samples:
+        yield Sample(node, path, timestamp, value)
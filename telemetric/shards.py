@@ -0,0 +1,313 @@
+from __future__ import absolute_import
+import zlib
+import time
+import logging
+import threading
+import multiprocessing
+from array import array
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+from .gpb import GPBDecoder
+from .client import TCPMsgType
+from .pipeline import decode_record
+from .aggregation import Aggregator
+from .series import kv_node
+from .projection import as_buffer, peek_string
+
+logger = logging.getLogger()
+
+# The kinds of the messages that workers send to the parent.
+_RESULT = 0
+_ERROR = 1
+_AGGREGATES = 2
+_CLOSED = 3
+
+def device_key(msg_type, payload, peer=None):
+    """
+    Returns the identity of the device a decompressed message is from:
+    the identifier of compact messages or the subscription identifier of
+    key-value ones qualified with the peer (see kv_node()), i.e. the node
+    that Aggregator files their series under. Returns peer if the
+    message has none (e.g. JSON).
+    """
+    try:
+        if msg_type == TCPMsgType.GPB_COMPACT:
+            key = peek_string(as_buffer(payload), 4)
+        elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+            key = peek_string(as_buffer(payload), 3)
+            if key:
+                key = kv_node(key, peer)
+        else:
+            key = None
+    except Exception:
+        key = None
+    return key or peer
+
+def _shard_worker(index, inbox, outbox, protos, output_dir, include_dir,
+                  aggregate_interval):
+    decoder = GPBDecoder(protos, output_dir, include_dir)
+    aggregator = None
+    if aggregate_interval:
+        aggregator = Aggregator(lambda a: outbox.put((_AGGREGATES, index,
+                                                      None, None, None, a)),
+                                interval=aggregate_interval)
+    while True:
+        try:
+            item = inbox.get(timeout=1 if aggregator else None)
+        except Empty:
+            aggregator.flush_expired()
+            continue
+        if item is None:
+            break
+        slot, key, msg_type, payload = item
+        try:
+            if aggregator is None:
+                record = decode_record(decoder, msg_type, payload)
+            else:
+                aggregator.add_message(decoder, msg_type, payload,
+                                       peer=key)
+                record = None
+        except Exception as e:
+            outbox.put((_ERROR, index, slot, key, msg_type, str(e)))
+            continue
+        outbox.put((_RESULT, index, slot, key, msg_type, record))
+    if aggregator is not None:
+        aggregator.flush()
+    outbox.put((_CLOSED, index, None, None, None, None))
+
+class ShardedPipeline(object):
+    """
+    Decodes messages on worker processes like DecodePool, but routes every
+    message by the device it is from (see device_key()), so that all
+    messages of a device are handled by the same worker, in order. Each
+    worker has its own decoder and, if aggregate_interval is given, its
+    own Aggregator, which sees every sample of the series it holds.
+
+    Devices are hashed onto a fixed number of slots, and slots are
+    assigned to workers. When the messages waiting for one worker exceed
+    rebalance_ratio times those of the least busy one, a slot of the busy
+    worker is moved to it. Only slots without messages in flight are
+    moved, so the order of every device is kept. With aggregate_interval,
+    slots are never moved: the windows and counter state of a device live
+    in the Aggregator of its worker, and a new worker would start its
+    series over, losing the rates across the move.
+    """
+
+    def __init__(self, callback, protos=(),
+                 proto_output_dir='~/.telemetric/proto',
+                 proto_include_dir=(),
+                 processes=None,
+                 max_pending=1024,
+                 aggregate_interval=None,
+                 slots=256,
+                 rebalance_ratio=2.0,
+                 rebalance_backlog=32,
+                 rebalance_every=256):
+        """
+        @type callback: callable
+        @param callback: Called as callback(key, msg_type, record) for each
+            decoded message, where key is the one passed to submit(). With
+            aggregate_interval, called as callback(aggregates) with the
+            Aggregate tuples of every window of every worker instead.
+            Called from a single thread.
+        @type processes: int
+        @param processes: The number of workers. Defaults to the number of
+            CPUs.
+        @type max_pending: int
+        @param max_pending: submit() blocks while this many messages are
+            being decoded.
+        @type aggregate_interval: float
+        @param aggregate_interval: If given, the workers aggregate the
+            messages over windows of this many seconds, and slots stay
+            on their worker.
+        @type slots: int
+        @param slots: The number of slots that devices are hashed onto.
+        @type rebalance_ratio: float
+        @param rebalance_ratio: How much busier than the least busy
+            worker a worker must be before a slot is moved.
+        @type rebalance_backlog: int
+        @param rebalance_backlog: Workers with fewer messages in flight are
+            never considered overloaded.
+        @type rebalance_every: int
+        @param rebalance_every: Check the balance after this many
+            submitted messages.
+        """
+        processes = processes or multiprocessing.cpu_count()
+        self.callback = callback
+        self.aggregate_interval = aggregate_interval
+        self.rebalance_ratio = rebalance_ratio
+        self.rebalance_backlog = rebalance_backlog
+        self.rebalance_every = rebalance_every
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.submitted = 0
+        self.moves = 0
+        self.errors = 0
+        self.started = time.time()
+
+        # Per slot state.
+        self.assignment = array('L', (i % processes for i in range(slots)))
+        self.slot_pending = array('L', [0] * slots)
+        self.slot_messages = array('L', [0] * slots)
+
+        # Per worker state.
+        self.pending = array('L', [0] * processes)
+        self.messages = array('L', [0] * processes)
+        # Doubles, as 'L' may be 32 bit and Python 2 has no 'Q'.
+        self.bytes = array('d', [0] * processes)
+
+        # Compile the protos before starting the workers, so that they do
+        # not race each other compiling the same files.
+        GPBDecoder(list(protos), proto_output_dir, proto_include_dir)
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = []
+        self.workers = []
+        for index in range(processes):
+            inbox = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_shard_worker,
+                                             args=(index, inbox, self.outbox,
+                                                   list(protos),
+                                                   proto_output_dir,
+                                                   proto_include_dir,
+                                                   aggregate_interval))
+            worker.daemon = True
+            worker.start()
+            self.inboxes.append(inbox)
+            self.workers.append(worker)
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def slot_of(self, device):
+        """
+        Returns the slot of the given device identity.
+        """
+        return zlib.crc32(str(device).encode('utf-8')) % len(self.assignment)
+
+    def submit(self, key, msg_type, payload):
+        """
+        Queue a raw, decompressed message for decoding. key (usually the
+        connection) identifies the device if the message does not.
+        """
+        slot = self.slot_of(device_key(msg_type, payload, key))
+        self.slots.acquire()
+        with self.lock:
+            shard = self.assignment[slot]
+            self.slot_pending[slot] += 1
+            self.slot_messages[slot] += 1
+            self.pending[shard] += 1
+            self.bytes[shard] += len(payload)
+            self.submitted += 1
+            check = self.submitted % self.rebalance_every == 0
+        self.inboxes[shard].put((slot, key, msg_type, bytes(payload)))
+        if check:
+            self.rebalance()
+
+    def queued(self):
+        """
+        Returns the number of messages submitted but not yet decoded.
+        """
+        return sum(self.pending)
+
+    def rebalance(self):
+        """
+        Move a slot from the busiest to the least busy worker if the
+        former is overloaded. Returns True if a slot was moved; never
+        moves one while aggregating.
+        """
+        if self.aggregate_interval:
+            return False
+        with self.lock:
+            pending = self.pending
+            busiest = max(range(len(pending)), key=pending.__getitem__)
+            idlest = min(range(len(pending)), key=pending.__getitem__)
+            if pending[busiest] < self.rebalance_backlog \
+              or pending[busiest] < self.rebalance_ratio * (pending[idlest] + 1):
+                return False
+            candidates = [slot for slot, shard in enumerate(self.assignment)
+                          if shard == busiest
+                          and not self.slot_pending[slot]
+                          and self.slot_messages[slot]]
+            if not candidates:
+                return False
+            slot = max(candidates, key=self.slot_messages.__getitem__)
+            self.assignment[slot] = idlest
+            self.moves += 1
+            # Decay the counts, so that they follow the current traffic.
+            for index, count in enumerate(self.slot_messages):
+                self.slot_messages[index] = count // 2
+        logger.info("moved shard slot {} from worker {} to {}".format(
+                    slot, busiest, idlest))
+        return True
+
+    def _collect(self):
+        # Deliver the results of the workers, in the order of each worker.
+        closed = 0
+        while closed < len(self.workers):
+            kind, shard, slot, key, msg_type, result = self.outbox.get()
+            if kind == _CLOSED:
+                closed += 1
+                continue
+            if kind == _AGGREGATES:
+                self.callback(result)
+                continue
+            with self.lock:
+                self.slot_pending[slot] -= 1
+                self.pending[shard] -= 1
+                self.messages[shard] += 1
+                if kind == _ERROR:
+                    self.errors += 1
+            self.slots.release()
+            if kind == _ERROR:
+                logger.error("failed to decode message from {}: {}".format(
+                             key, result))
+            elif result is not None:
+                self.callback(key, msg_type, result)
+
+    def stats(self):
+        """
+        Returns a list with the throughput of each worker: the number of
+        messages it handled, its messages and bytes per second since the
+        start, the messages in flight, and the number of slots it has.
+        """
+        elapsed = max(time.time() - self.started, 1e-9)
+        with self.lock:
+            return [{'shard': index,
+                     'messages': self.messages[index],
+                     'messages_per_sec': self.messages[index] / elapsed,
+                     'bytes_per_sec': self.bytes[index] / elapsed,
+                     'pending': self.pending[index],
+                     'slots': sum(1 for s in self.assignment if s == index)}
+                    for index in range(len(self.workers))]
+
+    def register_metrics(self, registry):
+        """
+        Add the per-worker throughput to a MetricsRegistry.
+        """
+        messages = registry.gauge('telemetric_shard_messages',
+                                  'Messages handled by each shard worker',
+                                  ('shard',))
+        pending = registry.gauge('telemetric_shard_pending',
+                                 'Messages in flight to each shard worker',
+                                 ('shard',))
+        for index in range(len(self.workers)):
+            messages.labels(str(index)).set_function(
+                lambda index=index: self.messages[index])
+            pending.labels(str(index)).set_function(
+                lambda index=index: self.pending[index])
+        registry.gauge('telemetric_shard_moves',
+                       'Slots moved between shard workers') \
+                .labels().set_function(lambda: self.moves)
+
+    def close(self):
+        """
+        Wait until all submitted messages are handled (and, when
+        aggregating, the last windows flushed), then stop the workers.
+        """
+        for inbox in self.inboxes:
+            inbox.put(None)
+        self.collector.join()
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,322 @@
+from __future__ import absolute_import
+import sys
+import heapq
+import fnmatch
+import threading
+import weakref
+from array import array
+from collections import namedtuple
+from bisect import bisect_left
+from .client import TCPMsgType
+from .series import iter_compact_samples, iter_kv_samples, kv_node
+
+if sys.version_info[0] >= 3:
+    long = int
+
+Entry = namedtuple('Entry', ['node', 'path', 'value', 'timestamp'])
+
+# How values are stored: floats and integers that a double holds exactly
+# in the values array, anything else (strings, bools, big counters) in a
+# dict.
+_FLOAT = 0
+_INT = 1
+_OBJECT = 2
+_EXACT = 2**53
+
+_NODE_BITS = 20
+_FIELD_BITS = 16
+
+def split_path(path):
+    """
+    Splits a series path into the row, i.e. the schema path and row keys
+    (plus the parents of nested key-value leaves), and the field name.
+    """
+    row, sep, field = path.rpartition('/')
+    return row, field
+
+class _Names(object):
+    # Interns strings as consecutive integers.
+
+    def __init__(self, limit=None):
+        self.ids = {}
+        self.names = []
+        self.limit = limit
+
+    def get(self, name):
+        return self.ids.get(name)
+
+    def add(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            id = len(self.names)
+            if self.limit is not None and id >= self.limit:
+                raise ValueError("too many distinct names: {}".format(name))
+            self.ids[name] = id
+            self.names.append(name)
+        return id
+
+class LastValueStore(object):
+    """
+    Keeps the latest value of every series, identified by node and path,
+    for lookups by dashboards and the like. Paths are the ones built by
+    iter_compact_samples() and iter_kv_samples(), e.g.
+    "RootOper.Interface[interface_name=Gi0/0/0/0]/bytes_received", and
+    are split into the row ("RootOper.Interface[interface_name=Gi0/0/0/0]")
+    and the field ("bytes_received").
+
+    Nodes, rows and fields are interned, and the state of every series
+    lives in flat arrays indexed by series number, so a series costs
+    well under 200 bytes (mostly its hash table entry), whatever the
+    length of its path: ten million series fit in about 2 GB. Rows are
+    kept in a sorted index for prefix queries.
+
+    Ingest and queries may run on different threads. Writers hold the
+    lock for one message; prefix queries only take it for short batches,
+    so a large query does not stall the ingest.
+    """
+
+    def __init__(self, batch_size=1024):
+        """
+        @type batch_size: int
+        @param batch_size: The number of series a query reads per
+            acquisition of the lock.
+        """
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.index_lock = threading.Lock()
+        self.nodes = _Names(2**_NODE_BITS)
+        self.rows = _Names()
+        self.fields = _Names(2**_FIELD_BITS)
+        self.row_fields = weakref.WeakKeyDictionary()
+        self.series = {}
+
+        # The rows in sorted order, and the rows added since it was built.
+        self.sorted_rows = []
+        self.new_rows = []
+
+        # Per row, the series in it.
+        self.row_series = []
+
+        # Per series state.
+        self.series_node = array('L')
+        self.series_row = array('L')
+        self.series_field = array('H')
+        self.values = array('d')
+        # Milliseconds, which a double holds exactly; Python 2 has no 'Q'.
+        self.timestamps = array('d')
+        self.kinds = bytearray()
+        self.objects = {}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _key(self, node, row, field):
+        return (row << (_NODE_BITS + _FIELD_BITS)) | (field << _NODE_BITS) | node
+
+    def _update(self, node, path, value, timestamp):
+        row_name, field_name = split_path(path)
+        node = self.nodes.add(node)
+        row = self.rows.get(row_name)
+        if row is None:
+            row = self.rows.add(row_name)
+            self.new_rows.append(row_name)
+            self.row_series.append(array('L'))
+        field = self.fields.add(field_name)
+        key = self._key(node, row, field)
+        index = self.series.get(key)
+        if index is None:
+            index = len(self.timestamps)
+            self.series_node.append(node)
+            self.series_row.append(row)
+            self.series_field.append(field)
+            self.values.append(0)
+            self.timestamps.append(timestamp)
+            self.kinds.append(_OBJECT)
+            self.row_series[row].append(index)
+            self.series[key] = index
+        elif timestamp < self.timestamps[index]:
+            # Out of order; keep the newer value.
+            return
+
+        self.timestamps[index] = timestamp
+        if isinstance(value, float):
+            kind = _FLOAT
+        elif isinstance(value, (int, long)) and not isinstance(value, bool) \
+          and -_EXACT <= value <= _EXACT:
+            kind = _INT
+        else:
+            kind = _OBJECT
+        if kind == _OBJECT:
+            self.objects[index] = value
+        else:
+            self.values[index] = value
+            if self.kinds[index] == _OBJECT:
+                self.objects.pop(index, None)
+        self.kinds[index] = kind
+
+    def update(self, node, path, value, timestamp):
+        """
+        Store a sample, unless a newer one of the same series is stored.
+
+        @type timestamp: int
+        @param timestamp: The time of the sample, in milliseconds.
+        """
+        with self.lock:
+            self._update(node, path, value, timestamp)
+
+    def add_compact(self, message, node=None):
+        """
+        Store the fields of the rows of a CompactMessage (see
+        GPBDecoder.decode_compact_lazy()). node defaults to the identifier
+        of the message.
+        """
+        node = node or message.identifier
+        samples = list(iter_compact_samples(message, self.row_fields,
+                                            states=True))
+        with self.lock:
+            for path, value, timestamp, wrap in samples:
+                self._update(node, path, value, timestamp)
+
+    def add_kv(self, header, node=None, peer=None):
+        """
+        Store the leaves of a key-value Telemetry message (see
+        GPBDecoder.parse_kv()) from the given peer. node defaults to
+        the subscription identifier qualified with the peer (see
+        kv_node()).
+        """
+        node = node or kv_node(header.subscription_identifier, peer)
+        samples = list(iter_kv_samples(header, states=True))
+        with self.lock:
+            for path, value, timestamp, wrap in samples:
+                self._update(node, path, value, timestamp)
+
+    def add_message(self, decoder, msg_type, payload, node=None,
+                    peer=None):
+        """
+        Decode a compact or key-value message with the given GPBDecoder
+        and store it, e.g. from the callback of a TMClient. Other messages
+        are ignored. peer is the one passed to the callback.
+        """
+        if msg_type == TCPMsgType.GPB_COMPACT:
+            self.add_compact(decoder.decode_compact_lazy(payload), node)
+        elif msg_type == TCPMsgType.GPB_KEY_VALUE:
+            self.add_kv(decoder.parse_kv(payload), node, peer)
+
+    def _value(self, index):
+        kind = self.kinds[index]
+        if kind == _FLOAT:
+            return self.values[index]
+        if kind == _INT:
+            return int(self.values[index])
+        return self.objects[index]
+
+    def _entry(self, index):
+        return Entry(self.nodes.names[self.series_node[index]],
+                     self.rows.names[self.series_row[index]] + '/' +
+                     self.fields.names[self.series_field[index]],
+                     self._value(index),
+                     int(self.timestamps[index]))
+
+    def get(self, node, path):
+        """
+        Returns the latest Entry of the given series, or None.
+        """
+        row, field = split_path(path)
+        with self.lock:
+            node = self.nodes.get(node)
+            row = self.rows.get(row)
+            field = self.fields.get(field)
+            if node is None or row is None or field is None:
+                return None
+            index = self.series.get(self._key(node, row, field))
+            if index is None:
+                return None
+            return self._entry(index)
+
+    def _sorted_rows(self):
+        # Merge the new rows into the sorted index, outside of the lock of
+        # the ingest. The index is replaced, never changed, so queries can
+        # go on reading an old one.
+        with self.index_lock:
+            with self.lock:
+                new_rows = self.new_rows
+                if not new_rows:
+                    return self.sorted_rows
+                self.new_rows = []
+            rows = list(heapq.merge(self.sorted_rows, sorted(new_rows)))
+            self.sorted_rows = rows
+            return rows
+
+    def _node_filter(self, node):
+        # Returns None for all nodes, or the set of matching node ids.
+        if node is None or node == '*':
+            return None
+        with self.lock:
+            if not any(c in node for c in '*?['):
+                id = self.nodes.get(node)
+                return set() if id is None else set([id])
+            names = list(self.nodes.names)
+        return set(i for i, name in enumerate(names)
+                   if fnmatch.fnmatchcase(name, node))
+
+    def _matching_rows(self, prefix):
+        # Yields the ids of the rows whose path starts with prefix, with
+        # None, and of the rows that prefix reaches into (as in
+        # "row/fie"), with the start of their fields.
+        rows = self._sorted_rows()
+        start = bisect_left(rows, prefix)
+        while start < len(rows) and rows[start].startswith(prefix):
+            yield self.rows.get(rows[start]), None
+            start += 1
+        pos = prefix.find('/')
+        while pos != -1:
+            row = self.rows.get(prefix[:pos])
+            if row is not None:
+                yield row, prefix[pos + 1:]
+            pos = prefix.find('/', pos + 1)
+
+    def query(self, prefix='', node=None):
+        """
+        Yields the latest Entry of every series whose path starts with the
+        given prefix, e.g. a schema path, a row, or a full path.
+
+        @type prefix: str
+        @param prefix: The start of the path.
+        @type node: str
+        @param node: Only yield series of this node; '*' or None for all
+            nodes, or a pattern like "edge-*" (see fnmatch).
+        """
+        nodes = self._node_filter(node)
+        if nodes is not None and not nodes:
+            return
+        for row, field_prefix in self._matching_rows(prefix):
+            series = self.row_series[row]
+            for start in range(0, len(series), self.batch_size):
+                entries = []
+                with self.lock:
+                    for index in series[start:start + self.batch_size]:
+                        if nodes is not None \
+                          and self.series_node[index] not in nodes:
+                            continue
+                        if field_prefix is not None and not \
+                          self.fields.names[self.series_field[index]] \
+                              .startswith(field_prefix):
+                            continue
+                        entries.append(self._entry(index))
+                for entry in entries:
+                    yield entry
+
+    def memory_size(self):
+        """
+        Returns the approximate number of bytes used by the store.
+        """
+        size = sys.getsizeof(self.series) + sys.getsizeof(self.objects)
+        for column in (self.series_node, self.series_row, self.series_field,
+                       self.values, self.timestamps, self.kinds,
+                       self.sorted_rows):
+            size += sys.getsizeof(column)
+        size += sum(sys.getsizeof(series) for series in self.row_series)
+        for names in (self.nodes, self.rows, self.fields):
+            size += sys.getsizeof(names.ids) + sys.getsizeof(names.names)
+            size += sum(sys.getsizeof(name) for name in names.names)
+        return size
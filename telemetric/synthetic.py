@@ -0,0 +1,234 @@
+from __future__ import absolute_import
+import json
+import zlib
+import struct
+import random
+from google.protobuf.descriptor import FieldDescriptor
+from .protoutil import is_repeated
+from .client import TCPMsgType, TCP_FLAG_ZLIB_COMPRESSION
+
+COMPACT_ENCODING = 0x87654321
+
+# Random values for the scalar field types, by FieldDescriptor type.
+_INT_RANGES = {
+    FieldDescriptor.TYPE_INT32: (-2**31, 2**31-1),
+    FieldDescriptor.TYPE_INT64: (-2**63, 2**63-1),
+    FieldDescriptor.TYPE_UINT32: (0, 2**32-1),
+    FieldDescriptor.TYPE_UINT64: (0, 2**64-1),
+    FieldDescriptor.TYPE_SINT32: (-2**31, 2**31-1),
+    FieldDescriptor.TYPE_SINT64: (-2**63, 2**63-1),
+    FieldDescriptor.TYPE_FIXED32: (0, 2**32-1),
+    FieldDescriptor.TYPE_FIXED64: (0, 2**64-1),
+    FieldDescriptor.TYPE_SFIXED32: (-2**31, 2**31-1),
+    FieldDescriptor.TYPE_SFIXED64: (-2**63, 2**63-1),
+}
+
+# The oneof members of TelemetryField used for key-value leaves.
+KV_VALUE_TYPES = ('string_value', 'bool_value', 'uint32_value',
+                  'uint64_value', 'sint64_value', 'double_value',
+                  'bytes_value')
+
+def v1_frame(payloads, compressor=None, reset=False):
+    """
+    Returns a JSON v1 message: a length, then a TLV per payload, preceded
+    by a reset TLV if reset is True. The payloads are compressed with the
+    given zlib compressor, which the receiver's decompressor must follow.
+    """
+    tlvs = []
+    if reset:
+        tlvs.append(struct.pack('>II', 1, 0))
+    for payload in payloads:
+        if compressor is not None:
+            payload = compressor.compress(payload) \
+                    + compressor.flush(zlib.Z_SYNC_FLUSH)
+        tlvs.append(struct.pack('>II', 2, len(payload)) + payload)
+    body = b''.join(tlvs)
+    return struct.pack('>I', len(body)) + body
+
+def v2_frame(msg_type, payload, compressor=None):
+    """
+    Returns a JSON v2 message. If a zlib compressor is given, the payload
+    is compressed and TCP_FLAG_ZLIB_COMPRESSION is set.
+    """
+    flags = 0
+    if compressor is not None:
+        payload = compressor.compress(payload) \
+                + compressor.flush(zlib.Z_SYNC_FLUSH)
+        flags = TCP_FLAG_ZLIB_COMPRESSION
+    return struct.pack('>III', msg_type, flags, len(payload)) + payload
+
+class PayloadGenerator(object):
+    """
+    Generates telemetry messages with random content. The same seed always
+    produces the same messages.
+    """
+
+    def __init__(self, decoder, seed=0):
+        """
+        @type decoder: GPBDecoder
+        @param decoder: Provides the telemetry modules, and the row classes
+            used for compact messages.
+        @type seed: int
+        @param seed: The seed of the random generator.
+        """
+        self.decoder = decoder
+        self.random = random.Random(seed)
+
+    def name(self, prefix='', length=8):
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        return prefix + ''.join(self.random.choice(letters)
+                                for i in range(length))
+
+    def _scalar(self, field):
+        rand = self.random
+        if field.type in _INT_RANGES:
+            low, high = _INT_RANGES[field.type]
+            # Mostly small counters, like real telemetry.
+            if rand.random() < 0.8:
+                high = min(high, 2**20)
+                low = max(low, -2**20)
+            return rand.randint(low, high)
+        elif field.type in (FieldDescriptor.TYPE_DOUBLE,
+                            FieldDescriptor.TYPE_FLOAT):
+            return round(rand.uniform(-1000, 1000), 2)
+        elif field.type == FieldDescriptor.TYPE_BOOL:
+            return rand.random() < 0.5
+        elif field.type == FieldDescriptor.TYPE_STRING:
+            return self.name(length=rand.randint(4, 16))
+        elif field.type == FieldDescriptor.TYPE_BYTES:
+            return bytes(bytearray(rand.randint(0, 255)
+                                   for i in range(rand.randint(1, 8))))
+        elif field.type == FieldDescriptor.TYPE_ENUM:
+            return rand.choice(field.enum_type.values).number
+        raise ValueError("unsupported field type {}".format(field.type))
+
+    def fill(self, message, max_repeated=3, depth=0):
+        """
+        Set every field of the given protobuf message to a random value.
+        Repeated fields get up to max_repeated values.
+        """
+        for field in message.DESCRIPTOR.fields:
+            repeated = is_repeated(field)
+            count = self.random.randint(0, max_repeated) if repeated else 1
+            if field.type == FieldDescriptor.TYPE_MESSAGE:
+                if depth >= 3:
+                    continue
+                for i in range(count):
+                    if repeated:
+                        child = getattr(message, field.name).add()
+                    else:
+                        child = getattr(message, field.name)
+                    self.fill(child, max_repeated, depth + 1)
+            elif repeated:
+                getattr(message, field.name).extend(self._scalar(field)
+                                                    for i in range(count))
+            else:
+                setattr(message, field.name, self._scalar(field))
+        return message
+
+    def compact(self, tables=1, rows=100, schema_paths=None,
+                identifier='router1'):
+        """
+        Returns a serialized compact GPB message with the given number of
+        tables and rows per table. The tables use the given schema paths,
+        by default all schemas of the decoder, in turn.
+        """
+        telemetry_pb2 = self.decoder.modules['telemetry_pb2']
+        if schema_paths is None:
+            schema_paths = sorted(p for p in self.decoder.schemas.index if p)
+        header = telemetry_pb2.TelemetryHeader(encoding=COMPACT_ENCODING,
+                                               policy_name='synthetic',
+                                               identifier=identifier,
+                                               start_time=1500000000000,
+                                               end_time=1500000000100)
+        for i in range(tables):
+            policy_path = schema_paths[i % len(schema_paths)]
+            row_class = self.decoder.get_row_class(policy_path)
+            table = header.tables.add(policy_path=policy_path)
+            for j in range(rows):
+                row = self.fill(row_class())
+                table.row.append(row.SerializeToString())
+        return header.SerializeToString()
+
+    def _kv_leaf(self, parent):
+        leaf = parent.fields.add(name=self.name('leaf-'))
+        value_name = self.random.choice(KV_VALUE_TYPES)
+        if value_name == 'string_value':
+            leaf.string_value = self.name(length=12)
+        elif value_name == 'bool_value':
+            leaf.bool_value = self.random.random() < 0.5
+        elif value_name == 'double_value':
+            leaf.double_value = self.random.uniform(0, 100)
+        elif value_name == 'bytes_value':
+            leaf.bytes_value = b'\x00\x01\x02\x03'
+        elif value_name == 'sint64_value':
+            leaf.sint64_value = self.random.randint(-2**40, 2**40)
+        else:
+            setattr(leaf, value_name, self.random.randint(0, 2**31))
+
+    def _kv_fields(self, parent, depth, fanout, leaves):
+        if depth <= 1:
+            for i in range(leaves):
+                self._kv_leaf(parent)
+            return
+        for i in range(fanout):
+            child = parent.fields.add(name=self.name('container-'))
+            self._kv_fields(child, depth - 1, fanout, leaves)
+
+    def kv(self, entries=10, depth=4, fanout=2, leaves=4,
+           base_path='Cisco-IOS-XR-synthetic-oper:synthetic/counters'):
+        """
+        Returns a serialized key-value GPB message with the given number of
+        entries. Each entry has "keys" and "content" trees that are depth
+        levels deep, with fanout children per container and the given
+        number of leaves per innermost container.
+        """
+        telemetry_kv_pb2 = self.decoder.modules['telemetry_kv_pb2']
+        header = telemetry_kv_pb2.Telemetry(collection_id=1,
+                                            base_path=base_path,
+                                            subscription_identifier='synthetic',
+                                            msg_timestamp=1500000000000)
+        for i in range(entries):
+            entry = header.fields.add(timestamp=1500000000000 + i)
+            keys = entry.fields.add(name='keys')
+            keys.fields.add(name='name', string_value=self.name('if-'))
+            content = entry.fields.add(name='content')
+            self._kv_fields(content, depth, fanout, leaves)
+        return header.SerializeToString()
+
+    def json(self, entries=10):
+        """
+        Returns a JSON telemetry message as bytes.
+        """
+        rows = [dict((self.name(), self.random.randint(0, 2**32))
+                     for j in range(8))
+                for i in range(entries)]
+        message = {'Policy': 'synthetic',
+                   'Identifier': 'router1',
+                   'Start Time': 1500000000000,
+                   'End Time': 1500000000100,
+                   'Data': {'synthetic': rows}}
+        return json.dumps(message).encode('utf-8')
+
+    def v1_stream(self, messages=10, entries=10):
+        """
+        Returns a list of v1 messages, each carrying one compressed JSON
+        message. The first one resets the compressor.
+        """
+        compressor = zlib.compressobj()
+        return [v1_frame([self.json(entries)], compressor, reset=(i == 0))
+                for i in range(messages)]
+
+    def v2_stream(self, msg_type, payloads, compress=False):
+        """
+        Returns a list of v2 messages carrying the given payloads. If
+        compress is True, the stream starts with a RESET_COMPRESSOR message
+        and the payloads are compressed.
+        """
+        if not compress:
+            return [v2_frame(msg_type, payload) for payload in payloads]
+        compressor = zlib.compressobj()
+        frames = [v2_frame(TCPMsgType.RESET_COMPRESSOR, b'')]
+        frames.extend(v2_frame(msg_type, payload, compressor)
+                      for payload in payloads)
+        return frames
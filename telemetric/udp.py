@@ -0,0 +1,251 @@
+from __future__ import absolute_import
+import errno
+import socket
+import logging
+import threading
+import multiprocessing
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+from .gpb import GPBDecoder
+from .client import TCPMsgType, open_udp_socket
+
+logger = logging.getLogger()
+MAX_DATAGRAM_SIZE = 2**16
+
+# Offsets of the per-worker counters in UDPIngest.counters.
+_DATAGRAMS = 0
+_BYTES = 1
+_BATCHES = 2
+_ERRORS = 3
+_NUM_COUNTERS = 4
+
+def read_udp_drops(port, filenames=('/proc/net/udp', '/proc/net/udp6')):
+    """
+    Return the number of datagrams the kernel dropped on all UDP sockets
+    bound to the given local port, as reported in /proc/net/udp. Returns
+    None if the counters are unavailable on this platform.
+    """
+    drops = None
+    for filename in filenames:
+        try:
+            with open(filename) as f:
+                lines = f.readlines()[1:]
+        except (IOError, OSError):
+            continue
+        for line in lines:
+            fields = line.split()
+            local_port = int(fields[1].rsplit(':', 1)[1], 16)
+            if local_port == port:
+                drops = (drops or 0) + int(fields[-1])
+    return drops
+
+def receive_batch(sock, views, sizes, addresses):
+    """
+    Receive up to len(views) datagrams into the given preallocated
+    buffers. Blocks until the first datagram arrives, then takes whatever
+    else is already queued without blocking. The size and sender of each
+    datagram are stored in sizes and addresses.
+    Returns the number of datagrams received.
+    """
+    count = 0
+    flags = 0
+    for view in views:
+        try:
+            nbytes, address = sock.recvfrom_into(view, 0, flags)
+        except socket.error as e:
+            # BlockingIOError or InterruptedError on Python 3.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+            break
+        sizes[count] = nbytes
+        addresses[count] = address
+        count += 1
+        flags = socket.MSG_DONTWAIT
+    return count
+
+def _udp_worker(index, counters, ipaddress, port, rcvbuf, batch_size,
+                protos, proto_output_dir, proto_include_dir,
+                json_dump, print_all, callback, queue):
+    sock = open_udp_socket(ipaddress, port, reuseport=True, rcvbuf=rcvbuf)
+    decoder = GPBDecoder(protos, proto_output_dir, proto_include_dir)
+    buffers = [bytearray(MAX_DATAGRAM_SIZE) for i in range(batch_size)]
+    views = [memoryview(b) for b in buffers]
+    sizes = [0] * batch_size
+    addresses = [None] * batch_size
+    offset = index * _NUM_COUNTERS
+
+    while True:
+        count = receive_batch(sock, views, sizes, addresses)
+        nbytes = 0
+        errors = 0
+        if queue is not None:
+            batch = []
+            for i in range(count):
+                batch.append((addresses[i], views[i][:sizes[i]].tobytes()))
+                nbytes += sizes[i]
+            queue.put(batch)
+            counters[offset+_DATAGRAMS] += count
+            counters[offset+_BYTES] += nbytes
+            counters[offset+_BATCHES] += 1
+            continue
+        # All UDP packets contain compact GPB messages
+        for i in range(count):
+            message = views[i][:sizes[i]]
+            nbytes += sizes[i]
+            try:
+                if callback is not None:
+                    callback(TCPMsgType.GPB_COMPACT, message.tobytes(),
+                             addresses[i])
+                else:
+                    decoder.decode_compact(message,
+                                           json_dump=json_dump,
+                                           print_all=print_all)
+            except Exception as e:
+                logger.error("failed to decode UDP message from {}: {}".format(
+                             addresses[i], e))
+                errors += 1
+        counters[offset+_DATAGRAMS] += count
+        counters[offset+_BYTES] += nbytes
+        counters[offset+_BATCHES] += 1
+        counters[offset+_ERRORS] += errors
+
+class UDPIngest(object):
+    """
+    Receives UDP telemetry on several worker processes. Every worker binds
+    its own SO_REUSEPORT socket to the same port, so the kernel spreads the
+    routers across them, and receives datagrams in batches into
+    preallocated buffers. The workers either decode the datagrams
+    themselves or forward them to the parent process.
+    """
+
+    def __init__(self, ipaddress, port, protos=(),
+                 proto_output_dir='~/.telemetric/proto',
+                 proto_include_dir=(),
+                 processes=None,
+                 rcvbuf=32*1024*1024,
+                 batch_size=64,
+                 json_dump=False,
+                 print_all=False,
+                 callback=None,
+                 deliver=None):
+        """
+        @type ipaddress: str
+        @param ipaddress: An IPv4 or IPv6 address.
+        @type port: int
+        @param port: The port number
+        @type protos: list(str)
+        @param protos: A list of protobuf filenames to load schemas from.
+        @type processes: int
+        @param processes: The number of sockets and worker processes.
+            Defaults to the number of CPUs.
+        @type rcvbuf: int
+        @param rcvbuf: The kernel receive buffer size of each socket.
+        @type batch_size: int
+        @param batch_size: The maximum number of datagrams decoded at once.
+        @type callback: callable
+        @param callback: If given, called as callback(msg_type, payload,
+            address) in the worker process instead of decoding the message. Must be
+            picklable.
+        @type deliver: callable
+        @param deliver: If given, the workers forward every batch of
+            datagrams to this process, where a thread calls
+            deliver(address, message) for each. Use this when the
+            messages must reach state kept in this process, such as the
+            callback of a TMClient.
+        """
+        self.ipaddress = ipaddress
+        self.port = port
+        self.processes = processes or multiprocessing.cpu_count()
+        self.args = (ipaddress, port, rcvbuf, batch_size,
+                     list(protos), proto_output_dir, proto_include_dir,
+                     json_dump, print_all, callback)
+        self.deliver = deliver
+        self.queue = None
+        self.forwarder = None
+        self.stopped = threading.Event()
+        self.errors = 0
+        # 'L', as Python 2 has no shared 'Q' arrays.
+        self.counters = multiprocessing.Array('L',
+                                              self.processes * _NUM_COUNTERS,
+                                              lock=False)
+        self.workers = []
+        self.last_drops = None
+
+        # Compile the protos before forking, so that the workers do not
+        # race each other compiling the same files.
+        GPBDecoder(list(protos), proto_output_dir, proto_include_dir)
+
+    def start(self):
+        if self.deliver is not None:
+            self.queue = multiprocessing.Queue()
+            self.stopped.clear()
+            self.forwarder = threading.Thread(target=self._forward)
+            self.forwarder.daemon = True
+            self.forwarder.start()
+        for index in range(self.processes):
+            worker = multiprocessing.Process(target=_udp_worker,
+                                             args=(index, self.counters)
+                                                  + self.args
+                                                  + (self.queue,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _forward(self):
+        # Pass the datagrams forwarded by the workers to deliver().
+        while not self.stopped.is_set():
+            try:
+                batch = self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+            for address, message in batch:
+                try:
+                    self.deliver(address, message)
+                except Exception as e:
+                    logger.error("failed to decode UDP message from {}: {}".format(
+                                 address, e))
+                    self.errors += 1
+
+    def stop(self):
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.forwarder is not None:
+            # Not a sentinel on the queue: a terminated worker may hold
+            # its lock.
+            self.stopped.set()
+            self.forwarder.join()
+            self.forwarder = None
+
+    def stats(self):
+        """
+        Returns a dict with the number of datagrams, bytes, batches and
+        decode errors summed over all workers, and the number of datagrams
+        dropped by the kernel (None if unknown).
+        """
+        totals = [sum(self.counters[i::_NUM_COUNTERS])
+                  for i in range(_NUM_COUNTERS)]
+        return {'datagrams': totals[_DATAGRAMS],
+                'bytes': totals[_BYTES],
+                'batches': totals[_BATCHES],
+                'errors': totals[_ERRORS] + self.errors,
+                'kernel_drops': read_udp_drops(self.port)}
+
+    def report(self):
+        """
+        Log the statistics, with a warning if the kernel dropped datagrams
+        since the last report.
+        """
+        stats = self.stats()
+        drops = stats['kernel_drops']
+        if drops and drops > (self.last_drops or 0):
+            logger.warning("UDP: the kernel dropped {} datagrams ({} total)".format(
+                           drops - (self.last_drops or 0), drops))
+        self.last_drops = drops
+        logger.info("UDP: {datagrams} datagrams, {bytes} bytes,"
+                    " {batches} batches, {errors} errors".format(**stats))
+        return stats
@@ -26,7 +26,7 @@ def bytes_to_string(thebytes):
     """
     Convert a byte array into a string aa:bb:cc
     """
-    return ":".join(["{:02x}".format(int(ord(c))) for c in thebytes])
+    return ":".join(["{:02x}".format(c) for c in bytearray(thebytes)])
 
 def timestamp_to_string(timestamp):
     """
@@ -0,0 +1,108 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType
+from telemetric.aggregation import Aggregator, counter_delta
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+class AggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.windows = []
+        self.aggregator = Aggregator(self.windows.append, interval=3600,
+                                     max_idle=2)
+
+    def result(self, window=-1):
+        return dict((a.path, a) for a in self.windows[window])
+
+    def testCounterDelta(self):
+        self.assertEqual(counter_delta(10, 15, 2**32), 5)
+        self.assertEqual(counter_delta(2**32 - 5, 10, 2**32), 15)
+        self.assertEqual(counter_delta(1000, 10, 2**32), 10)
+
+    def testWindow(self):
+        add = self.aggregator.add_sample
+        add('r1', 'a/bytes', 100, 1000, wrap=2**32)
+        add('r1', 'a/bytes', 300, 2000, wrap=2**32)
+        add('r1', 'a/bytes', 600, 3000, wrap=2**32)
+        add('r1', 'a/load', 0.5, 1000)
+        add('r1', 'a/load', 1.5, 2000)
+        self.aggregator.flush()
+        result = self.result()
+        bytes_ = result['a/bytes']
+        self.assertEqual((bytes_.count, bytes_.min, bytes_.max, bytes_.last),
+                         (3, 100, 600, 600))
+        self.assertEqual(bytes_.timestamp, 3000)
+        self.assertEqual(bytes_.rate, 250.0)
+        self.assertEqual(result['a/load'].mean, 1.0)
+        self.assertEqual(result['a/load'].rate, None)
+
+        # The rate continues from the last value of the previous window,
+        # across a wrap.
+        add('r1', 'a/bytes', 2**32 - 400, 4000, wrap=2**32)
+        add('r1', 'a/bytes', 600, 5000, wrap=2**32)
+        self.aggregator.flush()
+        result = self.result()
+        self.assertEqual(list(result), ['a/bytes'])
+        self.assertEqual(result['a/bytes'].rate, (2**32 - 1000 + 1000) / 2.0)
+
+    def testLargeCounter(self):
+        # Beyond 2**53, a double would round the values and the delta.
+        add = self.aggregator.add_sample
+        add('r1', 'a/bytes', 2**64 - 1001, 1000, wrap=2**64)
+        add('r1', 'a/bytes', 2**64 - 1, 2000, wrap=2**64)
+        self.aggregator.flush()
+        bytes_ = self.result()['a/bytes']
+        self.assertEqual((bytes_.min, bytes_.max, bytes_.last),
+                         (2**64 - 1001, 2**64 - 1, 2**64 - 1))
+        self.assertEqual(bytes_.rate, 1000.0)
+
+    def testIdleSeries(self):
+        self.aggregator.add_sample('r1', 'a', 1, 1000)
+        for i in range(3):
+            self.aggregator.flush()
+        self.assertEqual(len(self.windows), 1)
+        self.assertEqual(self.aggregator.series, {})
+        self.aggregator.add_sample('r1', 'b', 1, 1000)
+        self.assertEqual(self.aggregator.series, {('r1', 'b'): 0})
+
+    def testCompact(self):
+        message = make_compact(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        self.aggregator.add_compact(self.decoder.decode_compact_lazy(message))
+        self.aggregator.flush()
+        result = self.result()
+        path = SCHEMA_PATH + '[interface_name=Gi0/0/0/1]/bytes_sent'
+        self.assertEqual(result[path].node, 'router1')
+        self.assertEqual(result[path].last, 2000)
+        self.assertEqual(result[path].timestamp, 1500000000100)
+        self.assertFalse(any('queues' in p for p in result))
+
+    def testKV(self):
+        message = make_kv(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        self.aggregator.add_kv(self.decoder.parse_kv(message), node='r2')
+        self.aggregator.flush()
+        result = self.result()
+        path = 'Cisco-IOS-XR-infra-statsd-oper[interface-name=Gi0/0/0/1]/'
+        self.assertEqual(result[path + 'bytes-sent'].last, 2000)
+        self.assertEqual(result[path + 'bytes-sent'].node, 'r2')
+        self.assertEqual(result[path + 'load'].mean, 0.5)
+        self.assertEqual(len(result), 6)
+
+    def testKVPeers(self):
+        # Routers configured alike share the subscription name.
+        message = make_kv(self.decoder, ['Gi0/0/0/1'])
+        for peer in (('10.0.0.1', 5000), ('10.0.0.2', 5000)):
+            self.aggregator.add_message(self.decoder, TCPMsgType.GPB_KEY_VALUE,
+                                        message, peer=peer)
+        self.aggregator.flush()
+        nodes = set(a.node for a in self.windows[-1])
+        self.assertEqual(nodes, set(['sub1@10.0.0.1', 'sub1@10.0.0.2']))
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(AggregatorTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,154 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import zlib
+import socket
+import struct
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric import TMClient
+from telemetric.client import TCPMsgType, TCP_FLAG_ZLIB_COMPRESSION
+from telemetric.queues import BoundedQueue
+try:
+    from telemetric.aio import AsyncTCPServer
+except ImportError: # Python 2 has no asyncio
+    AsyncTCPServer = None
+
+def v1_frame(payload):
+    tlv = struct.pack(">II", 2, len(payload)) + payload
+    return struct.pack(">I", len(tlv)) + tlv
+
+def v2_frame(msg_type, payload, flags=0):
+    return struct.pack(">III", msg_type, flags, len(payload)) + payload
+
+@unittest.skipIf(AsyncTCPServer is None, "asyncio is not available")
+class AsyncTCPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.lock = threading.Lock()
+        self.client = TMClient('127.0.0.1', 0, callback=self.callback)
+        self.server = AsyncTCPServer(self.client)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.address = sock.getsockname()
+        self.server.start(sock)
+        self.thread = threading.Thread(target=self.server.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.loop.call_soon_threadsafe(self.server.loop.stop)
+        self.thread.join()
+        self.server.stop()
+        self.server.loop.close()
+
+    def callback(self, msg_type, payload, peer):
+        with self.lock:
+            self.received.append((msg_type, payload))
+
+    def wait_for(self, count):
+        for i in range(500):
+            with self.lock:
+                if len(self.received) >= count:
+                    return
+            threading.Event().wait(0.01)
+        self.fail("received only {} messages".format(len(self.received)))
+
+    def testConcurrentSessions(self):
+        # Each session has its own zlib stream; interleaving them byte by
+        # byte must not mix up the compressor state.
+        streams = []
+        for i in range(3):
+            comp = zlib.compressobj()
+            data = b""
+            for n in range(2):
+                body = '{{"session": {}, "n": {}}}'.format(i, n).encode('ascii')
+                body = comp.compress(body) + comp.flush(zlib.Z_SYNC_FLUSH)
+                data += v2_frame(TCPMsgType.JSON, body,
+                                 TCP_FLAG_ZLIB_COMPRESSION)
+            conn = socket.create_connection(self.address)
+            streams.append((conn, data))
+
+        for offset in range(max(len(d) for c, d in streams)):
+            for conn, data in streams:
+                if offset < len(data):
+                    conn.sendall(data[offset:offset+1])
+        self.wait_for(6)
+        for conn, data in streams:
+            conn.close()
+
+        payloads = sorted(p for t, p in self.received)
+        expected = sorted('{{"session": {}, "n": {}}}'.format(i, n).encode('ascii')
+                          for i in range(3) for n in range(2))
+        self.assertEqual(payloads, expected)
+        self.assertEqual(self.server.sessions, 3)
+
+    def testInflatePool(self):
+        # Compressed messages are inflated on threads, but every session
+        # still sees its messages in order, across compressor resets.
+        self.client.inflate_threads = 2
+        self.client.inflate_min_size = 0
+        self.client.start_inflate_pool()
+        expected = []
+        conns = []
+        for i in range(2):
+            data = b""
+            for n in range(6):
+                if n % 3 == 0:
+                    comp = zlib.compressobj()
+                    data += v2_frame(TCPMsgType.RESET_COMPRESSOR, b"")
+                body = '{{"session": {}, "n": {}}}'.format(i, n).encode('ascii')
+                expected.append(body)
+                flags = TCP_FLAG_ZLIB_COMPRESSION if n % 2 else 0
+                if flags:
+                    body = comp.compress(body) + comp.flush(zlib.Z_SYNC_FLUSH)
+                data += v2_frame(TCPMsgType.JSON, body, flags)
+            conn = socket.create_connection(self.address)
+            conn.sendall(data)
+            conns.append(conn)
+        self.wait_for(12)
+        for conn in conns:
+            conn.close()
+        self.client.inflate_pool.shutdown()
+
+        for i in range(2):
+            prefix = '{{"session": {}'.format(i).encode('ascii')
+            self.assertEqual([p for t, p in self.received if p.startswith(prefix)],
+                             [e for e in expected if e.startswith(prefix)])
+
+    def testBlockingQueue(self):
+        # A full queue with the block policy pauses the session rather
+        # than the event loop, which goes on serving other sessions.
+        self.client.decode_queue = BoundedQueue('decode', 2)
+        first = socket.create_connection(self.address)
+        first.sendall(b"".join(v2_frame(TCPMsgType.JSON, b'{"n": 1}')
+                               for i in range(4)))
+        for i in range(500):
+            if len(self.client.decode_queue) >= 4:
+                break
+            threading.Event().wait(0.01)
+        second = socket.create_connection(self.address)
+        for i in range(500):
+            if self.server.sessions == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(self.server.sessions, 2)
+        self.client.start_decode_queue()
+        self.wait_for(4)
+        first.close()
+        second.close()
+
+    def testV1Stream(self):
+        comp = zlib.compressobj()
+        body = comp.compress(b'{"a": 1}') + comp.flush(zlib.Z_SYNC_FLUSH)
+        conn = socket.create_connection(self.address)
+        conn.sendall(v1_frame(body))
+        self.wait_for(1)
+        conn.close()
+        self.assertEqual(self.received, [(TCPMsgType.JSON, b'{"a": 1}')])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(AsyncTCPServerTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,112 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import time
+import zlib
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric import TMClient
+from telemetric.client import TCPMsgType, TCP_FLAG_ZLIB_COMPRESSION
+from telemetric.capture import CaptureWriter, CaptureReader, replay, \
+                               TRANSPORT_TCP, TRANSPORT_UDP
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.cap')
+        self.received = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def callback(self, msg_type, payload, peer):
+        self.received.append((msg_type, payload))
+
+    def write_frames(self):
+        writer = CaptureWriter(self.filename)
+        writer.write(TRANSPORT_TCP, ('10.0.0.1', 5000), 2,
+                     TCPMsgType.JSON, 0, b'{"a": 1}', timestamp=100.0)
+        writer.write(TRANSPORT_UDP, ('10.0.0.2', 5001), 0, 0, 0,
+                     b'\x01\x02', timestamp=100.25)
+        writer.write(TRANSPORT_TCP, ('10.0.0.1', 5000), 1, None, None,
+                     b'v1', timestamp=100.5)
+        writer.close()
+
+    def check_frames(self, reader):
+        self.assertEqual(len(reader), 3)
+        first, second, third = list(reader)
+        self.assertEqual(first.timestamp, 100.0)
+        self.assertEqual(first.transport, TRANSPORT_TCP)
+        self.assertEqual(first.peer, '10.0.0.1:5000')
+        self.assertEqual((first.version, first.msg_type, first.flags),
+                         (2, TCPMsgType.JSON, 0))
+        self.assertEqual(first.payload.tobytes(), b'{"a": 1}')
+        self.assertEqual(second.transport, TRANSPORT_UDP)
+        self.assertEqual(second.payload.tobytes(), b'\x01\x02')
+        self.assertEqual((third.version, third.msg_type), (1, 0))
+        self.assertEqual(reader[2].payload.tobytes(), b'v1')
+        self.assertEqual(reader[-3].timestamp, 100.0)
+        self.assertRaises(IndexError, reader.__getitem__, 3)
+
+    def testWriteRead(self):
+        self.write_frames()
+        with CaptureReader(self.filename) as reader:
+            self.assertNotEqual(reader.index_offset, None)
+            self.check_frames(reader)
+
+    def testTruncated(self):
+        self.write_frames()
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        # Without the index, and with a partial last record.
+        data = data[:data.index(b'v1') + 2]
+        with open(self.filename, 'wb') as f:
+            f.write(data + b'\x00\x00\x00')
+        with CaptureReader(self.filename) as reader:
+            self.assertEqual(reader.index_offset, None)
+            self.check_frames(reader)
+
+    def testInvalid(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'not a capture')
+        self.assertRaises(ValueError, CaptureReader, self.filename)
+
+    def testCaptureAndReplay(self):
+        compressor = zlib.compressobj()
+        compressed = compressor.compress(b'{"b": 2}') \
+                   + compressor.flush(zlib.Z_SYNC_FLUSH)
+        client = TMClient('127.0.0.1', 0, callback=self.callback,
+                          capture_file=self.filename)
+        client.handle_frame(client.v1handler, client.v2handler,
+                            ('10.0.0.1', 5000), 2, TCPMsgType.JSON,
+                            TCP_FLAG_ZLIB_COMPRESSION, compressed)
+        client.close_capture()
+        self.assertEqual(self.received, [(TCPMsgType.JSON, b'{"b": 2}')])
+
+        # Replaying decompresses the same frame again, with new handlers.
+        del self.received[:]
+        client = TMClient('127.0.0.1', 0, callback=self.callback)
+        self.assertEqual(client.replay(self.filename, speed=None), 1)
+        self.assertEqual(self.received, [(TCPMsgType.JSON, b'{"b": 2}')])
+
+    def testReplaySpeed(self):
+        self.write_frames()
+        client = TMClient('127.0.0.1', 0, callback=self.callback)
+        udp = []
+        client.handle_udp_message = lambda peer, message: udp.append(peer)
+        with CaptureReader(self.filename) as reader:
+            frames = list(reader)[:2]
+            start = time.time()
+            self.assertEqual(replay(frames, client, speed=2), 2)
+            self.assertTrue(time.time() - start >= 0.12)
+            del frames
+        self.assertEqual(self.received, [(TCPMsgType.JSON, b'{"a": 1}')])
+        self.assertEqual(udp, ['10.0.0.2:5001'])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(CaptureTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
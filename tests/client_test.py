@@ -21,8 +21,14 @@ from __future__ import unicode_literals, print_function
 import sys
 import unittest
 import os
+import zlib
+import socket
+import struct
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from telemetric import TMClient
+from telemetric.client import TCPMsgType, TCP_FLAG_ZLIB_COMPRESSION, \
+                              open_sockets
+from telemetric.framing import FrameReader
 
 dirname = os.path.dirname(__file__)
 
@@ -36,6 +42,96 @@ class ClientTest(unittest.TestCase):
         client = TMClient('192.168.0.1', 8777)
         #TODO
 
+    def testListenBacklog(self):
+        # A burst of routers connects before any session is accepted.
+        tcp_sock, udp_sock = open_sockets('127.0.0.1', 0, udp=False)
+        clients = []
+        try:
+            for i in range(16):
+                client = socket.create_connection(tcp_sock.getsockname(),
+                                                  timeout=1)
+                clients.append(client)
+        finally:
+            for client in clients:
+                client.close()
+            tcp_sock.close()
+        self.assertEqual(len(clients), 16)
+
+    def testGetMessage(self):
+        received = []
+        client = TMClient('127.0.0.1', 0,
+                          callback=lambda t, p, peer: received.append((t, p)))
+        comp = zlib.compressobj()
+        body = comp.compress(b'{"a": 1}') + comp.flush(zlib.Z_SYNC_FLUSH)
+        tlvs = struct.pack(">II", 1, 0)
+        tlvs += struct.pack(">II", 2, len(body)) + body
+        data = struct.pack(">I", len(tlvs)) + tlvs
+        comp = zlib.compressobj()
+        body = comp.compress(b'{"b": 2}') + comp.flush(zlib.Z_SYNC_FLUSH)
+        data += struct.pack(">III", TCPMsgType.JSON,
+                            TCP_FLAG_ZLIB_COMPRESSION, len(body)) + body
+        data += struct.pack(">III", TCPMsgType.GPB_COMPACT, 0, 3) + b"gpb"
+
+        sender, receiver = socket.socketpair()
+        sender.sendall(data)
+        reader = FrameReader(receiver)
+        for i in range(3):
+            client.get_message(reader)
+        sender.close()
+        receiver.close()
+        self.assertEqual(received, [(TCPMsgType.JSON, b'{"a": 1}'),
+                                    (TCPMsgType.JSON, b'{"b": 2}'),
+                                    (TCPMsgType.GPB_COMPACT, b'gpb')])
+
+    def testSessionHandlers(self):
+        # A new connection starts with a fresh decompressor.
+        received = []
+        client = TMClient('127.0.0.1', 0,
+                          callback=lambda t, p, peer: received.append((t, p, peer)))
+        for payload in (b'{"a": 1}', b'{"b": 2}'):
+            comp = zlib.compressobj()
+            body = comp.compress(payload) + comp.flush(zlib.Z_SYNC_FLUSH)
+            sender, receiver = socket.socketpair()
+            sender.sendall(struct.pack(">III", TCPMsgType.JSON,
+                                       TCP_FLAG_ZLIB_COMPRESSION,
+                                       len(body)) + body)
+            sender.close()
+            client._tcp_session(receiver, ('10.0.0.1', 5000))
+        peer = ('10.0.0.1', 5000)
+        self.assertEqual(received, [(TCPMsgType.JSON, b'{"a": 1}', peer),
+                                    (TCPMsgType.JSON, b'{"b": 2}', peer)])
+
+    def testForwardJSON(self):
+        received = []
+        forwarded = []
+        client = TMClient('127.0.0.1', 0,
+                          callback=lambda t, p, peer: received.append((t, p)),
+                          forward_json=lambda p: forwarded.append(bytes(p)))
+        comp = zlib.compressobj()
+        body = comp.compress(b'{"a": 1}') + comp.flush(zlib.Z_SYNC_FLUSH)
+        tlvs = struct.pack(">II", 2, len(body)) + body
+        data = struct.pack(">I", len(tlvs)) + tlvs
+        data += struct.pack(">III", TCPMsgType.JSON, 0, 8) + b'{"b": 2}'
+        data += struct.pack(">III", TCPMsgType.GPB_COMPACT, 0, 3) + b"gpb"
+
+        sender, receiver = socket.socketpair()
+        sender.sendall(data)
+        reader = FrameReader(receiver)
+        for i in range(3):
+            client.get_message(reader)
+        sender.close()
+        receiver.close()
+        self.assertEqual(forwarded, [b'{"a": 1}', b'{"b": 2}'])
+        self.assertEqual(received, [(TCPMsgType.GPB_COMPACT, b'gpb')])
+
+    def testUDPCallback(self):
+        received = []
+        client = TMClient('127.0.0.1', 0,
+                          callback=lambda t, p, peer: received.append((t, p, peer)))
+        client.handle_udp_message(('10.0.0.1', 5000), bytearray(b'gpb'))
+        self.assertEqual(received, [(TCPMsgType.GPB_COMPACT, b'gpb',
+                                     ('10.0.0.1', 5000))])
+
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(ClientTest)
 if __name__ == '__main__':
@@ -0,0 +1,79 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.columnar import ColumnarBatcher, numpy
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class ColumnarBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.batches = []
+        self.batcher = ColumnarBatcher(self.batches.append, max_rows=3)
+
+    def tearDown(self):
+        self.batcher.close()
+
+    def testCompact(self):
+        names = ['Gi0/0/0/{}'.format(i) for i in range(4)]
+        message = make_compact(self.decoder, names)
+        self.batcher.add_compact(self.decoder.decode_compact_lazy(message))
+
+        # The first three rows fill a batch, the fourth waits for a flush.
+        self.assertEqual(len(self.batches), 1)
+        batch = self.batches[0]
+        self.assertEqual(batch.path, SCHEMA_PATH)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch['interface_name']), names[:3])
+        self.assertEqual(batch['bytes_sent'].dtype, numpy.uint64)
+        self.assertEqual(list(batch['bytes_sent']), [0, 2000, 4000])
+        self.assertEqual(list(batch['state']), [1, 1, 1])
+        self.assertEqual(list(batch['node']), ['router1'] * 3)
+        self.assertEqual(list(batch['timestamp']), [1500000000100] * 3)
+        self.assertTrue('queues' not in batch.columns)
+
+        self.batcher.flush()
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(list(self.batches[1]['interface_name']), names[3:])
+
+    def testKV(self):
+        message = make_kv(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        self.batcher.add_kv(self.decoder.parse_kv(message))
+        self.assertEqual(self.batches, [])
+        self.batcher.flush()
+        batch, = self.batches
+        self.assertEqual(batch.path, 'Cisco-IOS-XR-infra-statsd-oper')
+        self.assertEqual(list(batch['keys/interface-name']),
+                         ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        self.assertEqual(list(batch['content/bytes-received']), [0, 1000])
+        self.assertEqual(batch['content/load'].dtype, numpy.float64)
+        self.assertEqual(list(batch['timestamp']),
+                         [1500000000000, 1500000000001])
+        self.assertEqual(list(batch['node']), ['sub1', 'sub1'])
+
+    def testMaxDelay(self):
+        batcher = ColumnarBatcher(self.batches.append, max_delay=50)
+        message = make_kv(self.decoder, ['Gi0/0/0/0'])
+        batcher.add_kv(self.decoder.parse_kv(message))
+        batcher.flush_expired()
+        self.assertEqual(self.batches, [])
+
+        # The rows of an idle stream are flushed by the timer.
+        deadline = time.time() + 5
+        while not self.batches and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.batches), 1)
+        batcher.add_kv(self.decoder.parse_kv(message))
+        batcher.close()
+        self.assertEqual(len(self.batches), 2)
+        self.assertFalse(batcher.thread.is_alive())
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ColumnarBatcherTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,100 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType
+from telemetric.dedup import ChangeFilter
+from telemetric.metrics import MetricsRegistry
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+class ChangeFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.forwarded = []
+        self.filter = ChangeFilter(self.forwarded.extend, max_entries=100,
+                                   heartbeat=3)
+
+    def testFilter(self):
+        check = self.filter.filter
+        self.assertEqual([check('r1', 'a', v) for v in (1, 1, 2, 2, 2, 2, 2)],
+                         [True, False, True, False, False, True, False])
+        self.assertTrue(check('r2', 'a', 2))
+        self.assertTrue(check('r1', 'b', 'up'))
+        self.assertFalse(check('r1', 'b', 'up'))
+        stats = self.filter.stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual((stats['hits'], stats['misses']), (7, 3))
+        self.assertEqual((stats['changes'], stats['heartbeats'],
+                          stats['suppressed']), (1, 1, 5))
+        self.assertTrue(stats['memory_bytes'] > 0)
+
+    def testValues(self):
+        # Values are compared exactly, types included.
+        check = self.filter.filter
+        self.assertEqual([check('r1', 'a', v) for v in (-1, -2, 1, 1.0, True,
+                                                         True, 2**64, 2**64 - 1,
+                                                         'up', 'up')],
+                         [True, True, True, True, True,
+                          False, True, True, True, False])
+        long_value = 'x' * 1000
+        self.assertTrue(check('r1', 'b', long_value))
+        self.assertFalse(check('r1', 'b', 'x' * 1000))
+        self.assertTrue(check('r1', 'b', 'x' * 999 + 'y'))
+        self.assertTrue(check('r1', 'b', b'x' * 1000))
+
+    def testEviction(self):
+        changes = ChangeFilter(None, max_entries=2)
+        check = changes.filter
+        self.assertTrue(check('r1', 'a', 1))
+        self.assertTrue(check('r1', 'b', 1))
+        # Every slot is referenced, so the hand clears both and evicts a.
+        self.assertTrue(check('r1', 'c', 1))
+        self.assertFalse(check('r1', 'b', 1))
+        self.assertTrue(check('r1', 'a', 1))
+        self.assertEqual(changes.evictions, 2)
+        self.assertEqual(len(changes.slots), 2)
+        self.assertFalse(check('r1', 'a', 1))
+
+    def testCompact(self):
+        message = make_compact(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        for i in range(2):
+            self.filter.add_message(self.decoder, TCPMsgType.GPB_COMPACT,
+                                    message)
+        paths = [sample.path for sample in self.forwarded]
+        self.assertEqual(len(paths), len(set(paths)))
+        path = SCHEMA_PATH + '[interface_name=Gi0/0/0/1]/'
+        self.assertTrue(path + 'bytes_sent' in paths)
+        self.assertTrue(path + 'state' in paths)
+        sample = self.forwarded[paths.index(path + 'bytes_sent')]
+        self.assertEqual((sample.node, sample.value, sample.timestamp),
+                         ('router1', 2000, 1500000000100))
+
+    def testKV(self):
+        self.filter.add_kv(self.decoder.parse_kv(make_kv(self.decoder,
+                                                         ['Gi0/0/0/0'])))
+        self.filter.add_kv(self.decoder.parse_kv(make_kv(self.decoder,
+                                                         ['Gi0/0/0/0',
+                                                          'Gi0/0/0/1'])))
+        path = 'Cisco-IOS-XR-infra-statsd-oper[interface-name=Gi0/0/0/1]/'
+        self.assertEqual([s.path for s in self.forwarded[3:]],
+                         [path + 'bytes-received', path + 'bytes-sent',
+                          path + 'load'])
+
+    def testMetrics(self):
+        registry = MetricsRegistry()
+        self.filter.register_metrics(registry)
+        self.filter.filter('r1', 'a', 1)
+        self.filter.filter('r1', 'a', 1)
+        lines = registry.render().splitlines()
+        self.assertTrue('telemetric_dedup_entries 1' in lines)
+        self.assertTrue('telemetric_dedup_hit_ratio 0.5' in lines)
+        self.assertTrue('telemetric_dedup_samples{result="suppressed"} 1'
+                        in lines)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ChangeFilterTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,135 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import io
+import gzip
+import zlib
+import json
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.export import FileExporter, NDJSONFormat, CSVFormat, \
+                              LineProtocolFormat
+from telemetric.series import Sample
+from telemetric.aggregation import Aggregate
+
+class FormatTest(unittest.TestCase):
+
+    def testNDJSON(self):
+        line = NDJSONFormat().encode(Sample('r1', 'a/b', 1000, b'\x01'))
+        self.assertEqual(json.loads(line.decode('utf-8')),
+                         {'node': 'r1', 'path': 'a/b', 'timestamp': 1000,
+                          'value': str(b'\x01')})
+
+    def testCSV(self):
+        format = CSVFormat()
+        self.assertEqual(format.header(), b'')
+        self.assertEqual(format.encode({'a': 'x,y', 'b': None}), b'"x,y",\n')
+        self.assertEqual(format.header(), b'a,b\n')
+        self.assertEqual(format.encode({'b': [1], 'c': 2}), b',[1]\n')
+
+    def testLineProtocol(self):
+        format = LineProtocolFormat()
+        sample = Sample('r 1', 'a[k=v,w=x]/b', 1500000000000, 7)
+        self.assertEqual(format.encode(sample),
+                         b'telemetric,node=r\\ 1,path=a[k\\=v\\,w\\=x]/b'
+                         b' value=7i 1500000000000000000\n')
+        aggregate = Aggregate('r1', 'a', 1000, 2, 0.5, 1.5, 1.0, 1.5, None)
+        self.assertEqual(format.encode(aggregate),
+                         b'telemetric,node=r1,path=a count=2i,min=0.5,'
+                         b'max=1.5,mean=1.0,last=1.5 1000000000\n')
+        self.assertEqual(format.encode(Sample('r1', 'a', 0, 'say "hi"')),
+                         b'telemetric,node=r1,path=a value="say \\"hi\\""\n')
+        self.assertEqual(format.encode(Sample('r1', 'a', 0, True)),
+                         b'telemetric,node=r1,path=a value=true\n')
+        self.assertEqual(format.encode(Sample('r1', 'a', 0, 2**63 - 1)),
+                         b'telemetric,node=r1,path=a value=9223372036854775807i\n')
+        self.assertEqual(format.encode(Sample('r1', 'a', 0, 2**64 - 1)),
+                         b'telemetric,node=r1,path=a value=18446744073709551615u\n')
+        self.assertEqual(format.encode(Sample('r1', 'a', 0, 2**64)),
+                         b'telemetric,node=r1,path=a value=1.8446744073709552e+19\n')
+
+class FileExporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testWrite(self):
+        exporter = FileExporter(os.path.join(self.dir, 'out.ndjson'),
+                                flush_interval=60)
+        exporter.write({'a': 1})
+        exporter.write_all([{'a': 2}, {'a': 3}])
+        exporter.write_raw(memoryview(b'{"a": 4}'))
+        self.assertEqual(exporter.files, [])
+        exporter.close()
+        with open(exporter.files[0]) as fp:
+            self.assertEqual([json.loads(l)['a'] for l in fp], [1, 2, 3, 4])
+
+    def testRotate(self):
+        filename = os.path.join(self.dir, 'out-{index}.csv')
+        exporter = FileExporter(filename, CSVFormat(), max_bytes=10,
+                                flush_interval=60)
+        for i in range(3):
+            exporter.write({'a': i, 'b': 'xxxxxxxxxx'})
+            exporter.flush()
+        exporter.close()
+        self.assertEqual(len(exporter.files), 3)
+        with open(exporter.files[2]) as fp:
+            self.assertEqual(fp.read(), 'a,b\n2,xxxxxxxxxx\n')
+        self.assertRaises(ValueError, FileExporter,
+                          os.path.join(self.dir, 'out.csv'), max_bytes=10)
+
+    def testCompression(self):
+        for compression in 'gzip', 'zlib':
+            exporter = FileExporter(os.path.join(self.dir, 'out.lp'),
+                                    LineProtocolFormat(),
+                                    compression=compression,
+                                    buffer_size=100)
+            for i in range(100):
+                exporter.write(Sample('r1', 'a', 1000, i))
+            exporter.close()
+            with open(exporter.files[0], 'rb') as fp:
+                data = fp.read()
+            if compression == 'gzip':
+                self.assertTrue(exporter.files[0].endswith('.lp.gz'))
+                data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+            else:
+                data = zlib.decompress(data)
+            lines = data.splitlines()
+            self.assertEqual(len(lines), 100)
+            self.assertEqual(lines[-1],
+                             b'telemetric,node=r1,path=a value=99i 1000000000')
+
+    def testDrop(self):
+        exporter = FileExporter(os.path.join(self.dir, 'out.ndjson'),
+                                buffer_size=10**6, flush_interval=60,
+                                max_buffered=20)
+        exporter.write_all([{'a': 1}, {'a': 2}, {'a': 3}])
+        exporter.write({'a': 4})
+        self.assertEqual(exporter.dropped, 1)
+        exporter.close()
+        with open(exporter.files[0]) as fp:
+            self.assertEqual(len(fp.readlines()), 3)
+
+        exporter = FileExporter(os.path.join(self.dir, 'oldest.ndjson'),
+                                buffer_size=10**6, flush_interval=60,
+                                max_buffered=20, policy='drop-oldest')
+        exporter.write_all([{'a': 1}, {'a': 2}, {'a': 3}])
+        exporter.write({'a': 4})
+        self.assertEqual(exporter.dropped, 2)
+        exporter.close()
+        with open(exporter.files[0]) as fp:
+            self.assertEqual([json.loads(l)['a'] for l in fp], [3, 4])
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(FormatTest),
+        loader.loadTestsFromTestCase(FileExporterTest),
+    ])
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
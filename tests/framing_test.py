@@ -0,0 +1,58 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import struct
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.framing import FrameReader, parse_header
+
+class ChunkedConnection(object):
+    """
+    Returns the given data in chunks of at most chunk_size bytes.
+    """
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def recv_into(self, buf):
+        chunk = self.data[self.pos:self.pos+min(len(buf), self.chunk_size)]
+        buf[:len(chunk)] = chunk
+        self.pos += len(chunk)
+        return len(chunk)
+
+def v2_frame(msg_type, flags, payload):
+    return struct.pack(">III", msg_type, flags, len(payload)) + payload
+
+class FramingTest(unittest.TestCase):
+
+    def testParseHeader(self):
+        data = v2_frame(3, 1, b"abc")
+        self.assertEqual(parse_header(data, 0, 11), None)
+        self.assertEqual(parse_header(data, 0, len(data)), (2, 3, 1, 12, 15))
+        data = struct.pack(">I", 10) + b"x" * 10
+        self.assertEqual(parse_header(data, 0, 3), None)
+        self.assertEqual(parse_header(data, 0, len(data)),
+                         (1, None, None, 4, 14))
+        self.assertRaises(ValueError, parse_header, data, 0, 4, 9)
+
+    def testShortReads(self):
+        payloads = [b"a" * 5, b"", b"b" * 100000, b"c"]
+        data = b"".join(v2_frame(3, 0, p) for p in payloads)
+        data += struct.pack(">I", 6) + b"v1data"
+        for chunk_size in (1, 7, 4096, len(data)):
+            reader = FrameReader(ChunkedConnection(data, chunk_size), size=16)
+            for payload in payloads:
+                version, msg_type, flags, view = reader.read_frame()
+                self.assertEqual((version, msg_type, flags), (2, 3, 0))
+                self.assertEqual(view.tobytes(), payload)
+            version, msg_type, flags, view = reader.read_frame()
+            self.assertEqual((version, msg_type, flags), (1, None, None))
+            self.assertEqual(view.tobytes(), b"v1data")
+            self.assertRaises(EOFError, reader.read_frame)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(FramingTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,136 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder, KeyPathCache, iter_kv_leaves
+
+dirname = os.path.dirname(__file__)
+SCHEMA_PATH = "RootOper.InfraStatistics.Interface.Latest.GenericCounters"
+PROTOS = [os.path.join(dirname, 'data', 'ifstatsbag_generic.proto')]
+
+def make_compact(decoder, interfaces, identifier='router1'):
+    """
+    Returns a serialized compact message with one row per interface name.
+    """
+    telemetry_pb2 = decoder.modules['telemetry_pb2']
+    row_class = decoder.decoders[SCHEMA_PATH]
+    header = telemetry_pb2.TelemetryHeader(encoding=0x87654321,
+                                           policy_name='ifstats',
+                                           identifier=identifier,
+                                           start_time=1500000000000,
+                                           end_time=1500000000100)
+    table = header.tables.add(policy_path=SCHEMA_PATH)
+    for i, name in enumerate(interfaces):
+        row = row_class(interface_name=name,
+                        bytes_received=1000 * i,
+                        bytes_sent=2000 * i,
+                        state=1)
+        row.queues.add(queue_id=i, packets=7, flags=b'\x01\x02')
+        table.row.append(row.SerializeToString())
+    header.tables.add(policy_path='Unknown.Path').row.append(b'\x08\x01')
+    return header.SerializeToString()
+
+def make_kv(decoder, interfaces, base_path='Cisco-IOS-XR-infra-statsd-oper'):
+    """
+    Returns a serialized key-value message with one field tree per
+    interface name.
+    """
+    telemetry_kv_pb2 = decoder.modules['telemetry_kv_pb2']
+    header = telemetry_kv_pb2.Telemetry(collection_id=1,
+                                        base_path=base_path,
+                                        subscription_identifier='sub1',
+                                        msg_timestamp=1500000000000)
+    for i, name in enumerate(interfaces):
+        entry = header.fields.add(timestamp=1500000000000 + i)
+        keys = entry.fields.add(name='keys')
+        keys.fields.add(name='interface-name', string_value=name)
+        content = entry.fields.add(name='content')
+        content.fields.add(name='bytes-received', uint64_value=1000 * i)
+        content.fields.add(name='bytes-sent', uint64_value=2000 * i)
+        content.fields.add(name='load', double_value=0.5)
+    return header.SerializeToString()
+
+class GPBDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+
+    def testCompactToDict(self):
+        message = make_compact(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        result = self.decoder.compact_to_dict(message)
+        self.assertEqual(result['identifier'], 'router1')
+        rows = result['tables'][0]['row']
+        self.assertEqual(rows[1]['interface_name'], 'Gi0/0/0/1')
+        self.assertEqual(rows[1]['bytes_sent'], 2000)
+        self.assertEqual(rows[1]['queues'], [{'queue_id': 1,
+                                              'packets': 7,
+                                              'flags': '01:02'}])
+        self.assertEqual(result['tables'][1]['row'][0],
+                         '<No decoder available>')
+
+    def testDecodeCompactLazy(self):
+        message = make_compact(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        compact = self.decoder.decode_compact_lazy(message)
+        self.assertEqual(compact.identifier, 'router1')
+        self.assertEqual(compact.end_time, 1500000000100)
+
+        table, = compact.find_tables(SCHEMA_PATH)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table._rows, [None, None])
+        row = table[1]
+        self.assertEqual(row.interface_name, 'Gi0/0/0/1')
+        self.assertEqual(table._rows[0], None)
+        self.assertTrue(table[1] is row)
+        self.assertEqual([r.interface_name for r in table[:]],
+                         ['Gi0/0/0/0', 'Gi0/0/0/1'])
+
+        unknown, = compact.find_tables('Unknown.Path')
+        self.assertEqual(unknown.row_class, None)
+        self.assertRaises(ValueError, unknown.__getitem__, 0)
+
+    def testKVToDict(self):
+        message = make_kv(self.decoder, ['Gi0/0/0/0'])
+        result = self.decoder.kv_to_dict(message)
+        self.assertEqual(result['base_path'], 'Cisco-IOS-XR-infra-statsd-oper')
+        content = result['fields'][0]['fields'][1]
+        self.assertEqual(content['fields'][2], {'name': 'load',
+                                                'double_value': 0.5})
+
+    def testIterKVRecords(self):
+        message = make_kv(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        records = list(self.decoder.iter_kv_records(message))
+        base = 'Cisco-IOS-XR-infra-statsd-oper/'
+        self.assertEqual(records[:4], [
+            (base + 'keys/interface-name', 'Gi0/0/0/0', 1500000000000),
+            (base + 'content/bytes-received', 0, 1500000000000),
+            (base + 'content/bytes-sent', 0, 1500000000000),
+            (base + 'content/load', 0.5, 1500000000000)])
+        self.assertEqual(records[5][1:], (1000, 1500000000001))
+        self.assertEqual(len(records), 8)
+
+        # The paths of both entries are the same objects.
+        self.assertTrue(records[1][0] is records[5][0])
+
+    def testKeyPathCache(self):
+        paths = KeyPathCache(maxsize=2)
+        first = paths.join('a', 'b')
+        self.assertEqual(first, 'a/b')
+        self.assertTrue(paths.join('a', 'b') is first)
+        paths.join('a/b', 'c')
+        self.assertEqual(paths.size, 2)
+        self.assertEqual(paths.join('a', 'd'), 'a/d')
+        self.assertEqual(paths.size, 1)
+        self.assertEqual(paths.join('', 'e'), 'e')
+
+        # Cached and uncached paths are the same.
+        header = self.decoder.parse_kv(make_kv(self.decoder, ['Gi0/0/0/0']))
+        leaves = list(iter_kv_leaves(header))
+        self.assertEqual(leaves[0][0], 'keys/interface-name')
+        self.assertEqual(list(iter_kv_leaves(header, paths=KeyPathCache())),
+                         leaves)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(GPBDecoderTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,114 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType
+from telemetric.columnar import numpy
+from telemetric.metrics import MetricsRegistry
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+if numpy is not None:
+    from telemetric.history import HistoryStore
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class HistoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.history = HistoryStore(capacity=5, initial_series=2)
+
+    def testRing(self):
+        history = self.history
+        for i in range(8):
+            history.update('r1', 'a/b', i * 1.5, 1000 * i)
+        history.update('r1', 'a/b', 99, 500)
+        history.update('r1', 'a/b', 'up', 9000)
+        timestamps, values = history.range('r1', 'a/b')
+        self.assertEqual(list(timestamps), [3000, 4000, 5000, 6000, 7000])
+        self.assertEqual(list(values), [4.5, 6.0, 7.5, 9.0, 10.5])
+        timestamps, values = history.range('r1', 'a/b', 4000, 6000)
+        self.assertEqual(list(timestamps), [4000, 5000])
+        self.assertEqual(len(history.range('r1', 'a/c')[0]), 0)
+
+    def testDownsample(self):
+        for i in range(5):
+            self.history.update('r1', 'a/b', i, 1000 * i)
+        self.assertRaises(ValueError, self.history.downsample, 'r1', 'a/b',
+                          2000, how='median')
+        times, values = self.history.downsample('r1', 'a/b', 2000)
+        self.assertEqual(list(times), [0, 2000, 4000])
+        self.assertEqual(list(values), [0.5, 2.5, 4])
+        for how, expected in (('min', [0, 2, 4]), ('max', [1, 3, 4]),
+                              ('last', [1, 3, 4])):
+            times, values = self.history.downsample('r1', 'a/b', 2000,
+                                                    how=how)
+            self.assertEqual(list(values), expected)
+        times, values = self.history.downsample('r1', 'a/b', 3000, start=1000)
+        self.assertEqual(list(times), [1000, 4000])
+        self.assertEqual(list(values), [2, 4])
+
+    def testTopK(self):
+        history = HistoryStore(capacity=10)
+        for i in range(6):
+            history.update('r1', 'if[n=0]/bytes', i * 10, 1000 * i, 2**32)
+            history.update('r1', 'if[n=1]/bytes', i * 100, 1000 * i, 2**32)
+            history.update('r2', 'if[n=0]/bytes', (2**32 - 200 + i * 50)
+                           % 2**32, 1000 * i, 2**32)
+            history.update('r2', 'if[n=1]/bytes', 100 - i, 1000 * i, 2**32)
+        history.update('r2', 'other/x', 1, 0)
+        top = history.top_k(2, 3000)
+        self.assertEqual(top, [(100.0, 'r1', 'if[n=1]/bytes'),
+                               (50.0, 'r2', 'if[n=0]/bytes')])
+        # The counter of r2 that went down was reset, not wrapped.
+        self.assertEqual(len(history.top_k(10, 3000)), 3)
+        top = history.top_k(5, 3000, prefix='if[n=0]', node='r*')
+        self.assertEqual([(rate, node) for rate, node, path in top],
+                         [(50.0, 'r2'), (10.0, 'r1')])
+        # The window ends at now.
+        self.assertEqual(history.top_k(1, 2000, now=2000, node='r1'),
+                         [(100.0, 'r1', 'if[n=1]/bytes')])
+        self.assertEqual(history.top_k(3, 500), [])
+
+    def testEviction(self):
+        history = HistoryStore(capacity=4, max_bytes=4 * (4 * 16 + 32),
+                               initial_series=1, evict_fraction=0.5)
+        self.assertEqual(history.max_series, 4)
+        for i in range(4):
+            history.update('r1', 'p/{}'.format(i), i, 0)
+        history.update('r1', 'p/0', 1, 1)
+        history.update('r1', 'p/4', 1, 1)
+        self.assertEqual(history.evictions, 2)
+        self.assertEqual(sorted(path for node, path in history.slots),
+                         ['p/0', 'p/3', 'p/4'])
+        self.assertEqual(list(history.range('r1', 'p/0')[1]), [0, 1])
+        self.assertEqual(len(history.range('r1', 'p/4')[1]), 1)
+        self.assertEqual(history.memory_size(), 4 * (4 * 16 + 32))
+
+    def testMessages(self):
+        history = self.history
+        history.add_message(self.decoder, TCPMsgType.GPB_COMPACT,
+                            make_compact(self.decoder, ['Gi0', 'Gi1']))
+        history.add_message(self.decoder, TCPMsgType.GPB_KEY_VALUE,
+                            make_kv(self.decoder, ['Gi0']))
+        path = SCHEMA_PATH + '[interface_name=Gi1]/bytes_sent'
+        timestamps, values = history.range('router1', path)
+        self.assertEqual((list(timestamps), list(values)),
+                         ([1500000000100], [2000]))
+        self.assertEqual(len(history.range('router1', SCHEMA_PATH +
+                                           '[interface_name=Gi1]/state')[0]),
+                         0)
+        timestamps, values = history.range('sub1',
+            'Cisco-IOS-XR-infra-statsd-oper[interface-name=Gi0]/load')
+        self.assertEqual(list(values), [0.5])
+
+        registry = MetricsRegistry()
+        history.register_metrics(registry)
+        text = registry.render()
+        self.assertTrue('telemetric_history_series {}'.format(len(history))
+                        in text)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(HistoryStoreTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
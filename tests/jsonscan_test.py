@@ -0,0 +1,65 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.jsonscan import scan_json_keys
+
+class JSONScanTest(unittest.TestCase):
+
+    def testScan(self):
+        message = json.dumps({'node_id_str': 'r"1',
+                              'encoding_path': 'a/b',
+                              'collection_id': 7,
+                              'msg_timestamp': 1.5,
+                              'data_json': [{'keys': {'x': '}'}}],
+                              'a\\b': None}).encode('utf-8')
+        self.assertEqual(scan_json_keys(message, ['encoding_path',
+                                                  'node_id_str']),
+                         {'encoding_path': 'a/b', 'node_id_str': 'r"1'})
+        self.assertEqual(scan_json_keys(memoryview(message),
+                                        ['collection_id', 'msg_timestamp',
+                                         'data_json', 'a\\b', 'missing']),
+                         {'collection_id': 7,
+                          'msg_timestamp': 1.5,
+                          'data_json': [{'keys': {'x': '}'}}],
+                          'a\\b': None})
+
+    def testNested(self):
+        # Only top-level keys match.
+        message = b' { "data": {"node": 1}, "list": [true, {"node": 2}],' \
+                  b' "node" : false }'
+        self.assertEqual(scan_json_keys(message, ['node']), {'node': False})
+        self.assertEqual(scan_json_keys(b'{}', ['node']), {})
+        self.assertRaises(ValueError, scan_json_keys, b'[1]', ['node'])
+
+    def testSkipNested(self):
+        # Nested values are skipped by their brackets and quotes, without
+        # being parsed.
+        message = b'{"data": [{"x": "]}\\"}"}, "\\"["], "bad": {"y": tru},' \
+                  b' "node": "r\xc3\xa9"}'
+        self.assertEqual(scan_json_keys(memoryview(message), ['node']),
+                         {'node': 'r\xe9'})
+        self.assertRaises(ValueError, scan_json_keys, b'{"a": [1, {}', ['b'])
+
+    def testSkipLarge(self):
+        # Values that span many chunks, with brackets, quotes and escapes
+        # in strings on both sides of the chunk boundaries.
+        rows = [{'keys': {'name': 'Gi0/{}'.format(i)},
+                 'content': {'desc': '[' * (i % 7) + '\\' * (i % 3) + '"}',
+                             'list': [[i], {}, []]}}
+                for i in range(5000)]
+        message = json.dumps({'data_json': rows, 'node_id_str': 'r1'})
+        message = message.encode('utf-8')
+        self.assertEqual(scan_json_keys(message, ['node_id_str']),
+                         {'node_id_str': 'r1'})
+        self.assertEqual(scan_json_keys(message, ['data_json'])['data_json'],
+                         rows)
+        self.assertRaises(ValueError, scan_json_keys, message[:-40],
+                          ['missing'])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(JSONScanTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,87 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType, JSONv1Handler, JSONv2Handler
+from telemetric.framing import parse_header
+if sys.version_info >= (3, 5):
+    from telemetric.loadgen import Collector, LoadGenerator, build_cycle, \
+                                   parse_mix
+else:
+    # The load generator uses async/await.
+    LoadGenerator = None
+from tests.gpb_test import PROTOS
+
+@unittest.skipIf(LoadGenerator is None, "the load generator requires Python 3.5")
+class LoadGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.messages = []
+
+    def collect(self, msg_type, payload, peer):
+        self.messages.append((msg_type, payload))
+
+    def handle(self, cycle):
+        v1handler = JSONv1Handler(None, self.collect)
+        v2handler = JSONv2Handler(None, self.collect)
+        for frame, count in cycle:
+            version, msg_type, flags, start, end = parse_header(frame, 0,
+                                                                len(frame))
+            if version == 1:
+                v1handler.handle_payload(frame[start:end])
+            else:
+                v2handler.handle_payload(msg_type, flags, frame[start:end])
+
+    def testParseMix(self):
+        self.assertEqual(parse_mix('json=1,kv=2.5'),
+                         {TCPMsgType.JSON: 1.0, TCPMsgType.GPB_KEY_VALUE: 2.5})
+        self.assertRaises(ValueError, parse_mix, 'xml=1')
+
+    def testBuildCycle(self):
+        payloads = [(TCPMsgType.JSON, b'{"a": 1}'),
+                    (TCPMsgType.GPB_KEY_VALUE, b'\x08\x01')] * 3
+        cycle = build_cycle(payloads, 2, compress=True, reset_interval=4)
+        self.assertEqual([count for frame, count in cycle],
+                         [0, 1, 1, 1, 1, 0, 1, 1])
+        # Sending the cycle twice works because it starts with a reset.
+        self.handle(cycle + cycle)
+        self.assertEqual(self.messages, payloads * 2)
+
+        del self.messages[:]
+        payloads = [(TCPMsgType.JSON, b'{"a": 1}')] * 3
+        cycle = build_cycle(payloads, 1, reset_interval=3)
+        self.handle(cycle + cycle)
+        self.assertEqual(self.messages, payloads * 2)
+        self.assertRaises(ValueError, build_cycle,
+                          [(TCPMsgType.GPB_KEY_VALUE, b'')], 1)
+
+    def testRun(self):
+        collector = Collector(PROTOS)
+        collector.start()
+        try:
+            generator = LoadGenerator(self.decoder, collector,
+                                      tcp_sessions=2,
+                                      udp_senders=1,
+                                      v1_sessions=1,
+                                      rate=20,
+                                      reset_interval=5,
+                                      rows=2,
+                                      entries=2,
+                                      pool_size=2)
+            result = generator.run(0.5)
+        finally:
+            collector.stop()
+        self.assertEqual(result['sessions'], 4)
+        self.assertEqual(result['offered_rate'], 80)
+        self.assertTrue(result['sent'] > 0)
+        self.assertEqual(result['send_errors'], 0)
+        self.assertEqual(result['lost'], 0)
+        self.assertEqual(collector.decoded, result['sent'])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(LoadGeneratorTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
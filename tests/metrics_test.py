@@ -0,0 +1,128 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import zlib
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric import TMClient
+from telemetric.client import TCPMsgType
+from telemetric.metrics import MetricsRegistry, MetricsServer
+from telemetric.synthetic import v2_frame
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def testRender(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'A counter', ('peer',))
+        counter.labels('a"b').inc(3)
+        gauge = registry.gauge('test_depth', 'A gauge')
+        gauge.labels().set_function(lambda: 7)
+        histogram = registry.histogram('test_seconds', 'A histogram',
+                                       buckets=(0.1, 1))
+        histogram.labels().observe(0.05)
+        histogram.labels().observe(0.5)
+        histogram.labels().observe(5)
+        self.assertRaises(ValueError, registry.counter, 'test_total', '')
+        self.assertRaises(ValueError, counter.labels)
+
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:3], ['# HELP test_total A counter',
+                                     '# TYPE test_total counter',
+                                     'test_total{peer="a\\"b"} 3'])
+        self.assertTrue('test_depth 7' in lines)
+        self.assertTrue('test_seconds_bucket{le="0.1"} 1' in lines)
+        self.assertTrue('test_seconds_bucket{le="1"} 2' in lines)
+        self.assertTrue('test_seconds_bucket{le="+Inf"} 3' in lines)
+        self.assertTrue('test_seconds_sum 5.55' in lines)
+        self.assertTrue('test_seconds_count 3' in lines)
+
+    def testServer(self):
+        registry = MetricsRegistry()
+        registry.counter('test_total', 'A counter').labels().inc()
+        server = MetricsServer(registry, port=0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.port)
+            response = urlopen(url)
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            self.assertTrue(b'test_total 1' in response.read())
+        finally:
+            server.stop()
+
+class CollectorMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.client = TMClient('127.0.0.1', 0, PROTOS,
+                               callback=self.callback,
+                               metrics_port=0)
+        self.metrics = self.client.metrics
+
+    def callback(self, msg_type, payload, peer):
+        self.received.append(self.client.gpbdecoder.compact_to_dict(payload))
+
+    def testStages(self):
+        handler = self.client.create_v2handler(('10.0.0.1', 5000))
+        message = make_compact(self.client.gpbdecoder, ['Gi0/0/0/0'])
+        compressor = zlib.compressobj()
+        frame = v2_frame(TCPMsgType.GPB_COMPACT, message, compressor)
+        self.client.handle_frame(None, handler, ('10.0.0.1', 5000), 2,
+                                 TCPMsgType.GPB_COMPACT, 1, frame[12:])
+        self.assertEqual(len(self.received), 1)
+
+        for stage in ('decompress', 'decode', 'convert', 'sink'):
+            self.assertEqual(getattr(self.metrics, stage).count, 1)
+        peer = self.metrics.peer(('10.0.0.1', 5000))
+        self.assertEqual(peer.messages.value, 1)
+        self.assertEqual(peer.bytes.value, len(frame) - 12)
+        self.assertEqual(peer.compressed.value, len(frame) - 12)
+        self.assertEqual(peer.decompressed.value, len(message))
+
+        # A corrupt row is counted as a decode error of its schema path.
+        telemetry_pb2 = self.client.gpbdecoder.modules['telemetry_pb2']
+        header = telemetry_pb2.TelemetryHeader()
+        header.ParseFromString(message)
+        header.tables[0].row[0] = b'\xff\xff'
+        self.client.handle_frame(None, handler, ('10.0.0.1', 5000), 2,
+                                 TCPMsgType.GPB_COMPACT, 0,
+                                 header.SerializeToString())
+        errors = self.metrics.decode_errors.labels(SCHEMA_PATH)
+        self.assertEqual(errors.value, 1)
+
+        text = self.metrics.registry.render()
+        self.assertTrue('telemetric_peer_messages_total{peer="10.0.0.1"} 2'
+                        in text)
+        self.assertTrue('telemetric_queue_depth{queue="schema_loads"} 0' in text)
+
+    def testPeerSessions(self):
+        # Peers are labelled by host, and forgotten with their last
+        # session.
+        self.metrics.session_opened(('10.0.0.1', 5000))
+        self.metrics.session_opened(('10.0.0.1', 5001))
+        self.metrics.peer(('10.0.0.1', 5000)).messages.inc()
+        self.metrics.peer('10.0.0.1:5001').messages.inc()
+        self.assertEqual([p for p in self.metrics.peers if p != 'tcp'],
+                         ['10.0.0.1'])
+        self.metrics.session_closed(('10.0.0.1', 5000))
+        text = self.metrics.registry.render()
+        self.assertTrue('telemetric_peer_messages_total{peer="10.0.0.1"} 2'
+                        in text)
+        self.metrics.session_closed(('10.0.0.1', 5001))
+        self.assertFalse('10.0.0.1' in self.metrics.peers)
+        self.assertEqual(self.metrics.sessions, {})
+        text = self.metrics.registry.render()
+        self.assertFalse('peer="10.0.0.1"' in text)
+
+def suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(MetricsRegistryTest),
+        loader.loadTestsFromTestCase(CollectorMetricsTest),
+    ])
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,119 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import json
+import zlib
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType, TCP_FLAG_ZLIB_COMPRESSION
+from telemetric.capture import CaptureWriter, CaptureReader, \
+                               TRANSPORT_TCP, TRANSPORT_UDP
+from telemetric.columnar import numpy
+from telemetric.offline import plan_chunks, decode_capture
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+class OfflineDecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.cap')
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+
+        # A compressed session with a compressor reset before its third
+        # message, an uncompressed session, and UDP.
+        writer = CaptureWriter(self.filename)
+        compressor = zlib.compressobj()
+        for i in range(4):
+            if i == 2:
+                writer.write_tcp('a', 2, TCPMsgType.RESET_COMPRESSOR, 0, b'')
+                compressor = zlib.compressobj()
+            message = make_kv(self.decoder, ['Gi0/0/0/{}'.format(i)])
+            payload = compressor.compress(message) \
+                    + compressor.flush(zlib.Z_SYNC_FLUSH)
+            writer.write_tcp('a', 2, TCPMsgType.GPB_KEY_VALUE,
+                             TCP_FLAG_ZLIB_COMPRESSION, payload)
+            writer.write_tcp('b', 2, TCPMsgType.GPB_COMPACT, 0,
+                             make_compact(self.decoder, ['Te0/0/0/{}'.format(i)]))
+        writer.write_udp('c', make_compact(self.decoder, ['Hu0/0/0/0']))
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def testPlanChunks(self):
+        with CaptureReader(self.filename) as reader:
+            chunks = plan_chunks(reader, chunk_size=1)
+            sessions = []
+            for chunk in chunks:
+                for segment in chunk:
+                    frames = [reader.read(o) for o in segment]
+                    sessions.append((frames[0].peer, len(frames),
+                                     frames[0].msg_type))
+                    del frames
+
+        # Session a is only split at the compressor reset.
+        self.assertEqual(sorted(sessions),
+                         [('a', 2, TCPMsgType.GPB_KEY_VALUE),
+                          ('a', 3, TCPMsgType.RESET_COMPRESSOR),
+                          ('b', 1, TCPMsgType.GPB_COMPACT),
+                          ('b', 1, TCPMsgType.GPB_COMPACT),
+                          ('b', 1, TCPMsgType.GPB_COMPACT),
+                          ('b', 1, TCPMsgType.GPB_COMPACT),
+                          ('c', 1, 0)])
+
+    def testDecodeNDJSON(self):
+        results = decode_capture(self.filename, self.output_dir,
+                                 protos=PROTOS, processes=2, chunk_size=1)
+        self.assertEqual(sum(r['frames'] for r in results), 10)
+        self.assertEqual(sum(r['records'] for r in results), 9)
+        self.assertEqual(sum(r['errors'] for r in results), 0)
+
+        names = []
+        for stats in results:
+            with open(stats['output']) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record['msg_type'] == TCPMsgType.GPB_KEY_VALUE:
+                        entry = record['record']['fields'][0]
+                        names.append(entry['fields'][0]['fields'][0]['string_value'])
+                    else:
+                        table = record['record']['tables'][0]
+                        names.append(table['row'][0]['interface_name'])
+        self.assertEqual(sorted(names),
+                         ['Gi0/0/0/0', 'Gi0/0/0/1', 'Gi0/0/0/2', 'Gi0/0/0/3',
+                          'Hu0/0/0/0',
+                          'Te0/0/0/0', 'Te0/0/0/1', 'Te0/0/0/2', 'Te0/0/0/3'])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def testDecodeNPZ(self):
+        results = decode_capture(self.filename, self.output_dir,
+                                 protos=PROTOS, processes=1,
+                                 output_format='npz')
+        names = []
+        kv_names = []
+        for stats in results:
+            arrays = numpy.load(stats['output'], allow_pickle=True)
+            for key in arrays.files:
+                if key.startswith(SCHEMA_PATH) \
+                   and key.endswith('/interface_name'):
+                    names.extend(arrays[key])
+                elif key.endswith('/keys/interface-name'):
+                    kv_names.extend(arrays[key])
+            arrays.close()
+        self.assertEqual(sorted(names), ['Hu0/0/0/0', 'Te0/0/0/0', 'Te0/0/0/1',
+                                         'Te0/0/0/2', 'Te0/0/0/3'])
+        self.assertEqual(sorted(kv_names), ['Gi0/0/0/0', 'Gi0/0/0/1',
+                                            'Gi0/0/0/2', 'Gi0/0/0/3'])
+
+    def testUnknownFormat(self):
+        self.assertRaises(ValueError, decode_capture, self.filename,
+                          self.output_dir, output_format='xml')
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(OfflineDecodeTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,51 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.client import TCPMsgType
+from telemetric.pipeline import DecodePool
+from tests.gpb_test import PROTOS, make_compact, make_kv
+
+class DecodePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = {}
+        self.pool = DecodePool(self.callback, PROTOS, processes=2)
+        from telemetric.gpb import GPBDecoder
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+
+    def tearDown(self):
+        self.pool.pool.terminate()
+
+    def callback(self, key, msg_type, record):
+        self.records.setdefault(key, []).append((msg_type, record))
+
+    def testOrderPerKey(self):
+        for i in range(20):
+            compact = make_compact(self.decoder, ['Gi{}'.format(i)] * (20 - i))
+            self.pool.submit('a', TCPMsgType.GPB_COMPACT, compact)
+            kv = make_kv(self.decoder, ['Gi{}'.format(i)])
+            self.pool.submit('b', TCPMsgType.GPB_KEY_VALUE, kv)
+        self.pool.submit('b', TCPMsgType.JSON, b'{"n": 20}')
+        self.pool.close()
+
+        names = [r['tables'][0]['row'][0]['interface_name']
+                 for t, r in self.records['a']]
+        self.assertEqual(names, ['Gi{}'.format(i) for i in range(20)])
+        types = [t for t, r in self.records['b']]
+        self.assertEqual(types, [TCPMsgType.GPB_KEY_VALUE] * 20 + [TCPMsgType.JSON])
+        self.assertEqual(self.records['b'][-1][1], {'n': 20})
+
+    def testDecodeError(self):
+        self.pool.submit('a', TCPMsgType.GPB_COMPACT, b'garbage')
+        self.pool.submit('a', TCPMsgType.JSON, b'{}')
+        self.pool.close()
+        self.assertEqual(self.pool.errors, 1)
+        self.assertEqual(self.records['a'], [(TCPMsgType.JSON, {})])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(DecodePoolTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,103 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.protoutil import proto_to_dict
+from telemetric.projection import as_buffer, compile_scanner
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+def flatten_kv(fields, prefix=''):
+    """
+    Returns a dict mapping the key path of every leaf to its value.
+    """
+    result = {}
+    for field in fields:
+        path = prefix + field.get('name', '')
+        if 'fields' in field:
+            result.update(flatten_kv(field['fields'], path + '/'))
+            continue
+        for key, value in field.items():
+            if key.endswith('_value'):
+                result[path] = value
+    return result
+
+class ProjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+
+    def testFullScanner(self):
+        # FileDescriptorProto has nested, recursive and enum fields.
+        descriptor_pb2 = self.decoder.modules['descriptor_pb2']
+        proto = descriptor_pb2.FileDescriptorProto()
+        proto.ParseFromString(self.decoder.modules['telemetry_pb2'].DESCRIPTOR.serialized_pb)
+        proto.options.java_package = 'x'
+        proto.options.optimize_for = proto.options.CODE_SIZE
+        data = proto.SerializeToString()
+
+        scan = compile_scanner(proto.DESCRIPTOR)
+        self.assertEqual(scan(as_buffer(data), 0, len(data)),
+                         proto_to_dict(proto))
+
+    def testPackedField(self):
+        row = self.decoder.get_row_class(SCHEMA_PATH)(lane_offsets=[1, -2, 300],
+                                                      output_drops=5)
+        data = row.SerializeToString()
+        scan = compile_scanner(row.DESCRIPTOR, ['lane_offsets'])
+        self.assertEqual(scan(as_buffer(data), 0, len(data)),
+                         {'lane_offsets': [1, -2, 300]})
+
+        # Only repeated fields may be packed; a scalar field with the
+        # wrong wire type is skipped.
+        number = row.DESCRIPTOR.fields_by_name['output_drops'].number
+        data = bytes(bytearray([number << 3 | 2, 2, 5, 6])) + data
+        scan = compile_scanner(row.DESCRIPTOR, ['output_drops'])
+        self.assertEqual(scan(as_buffer(data), 0, len(data)),
+                         {'output_drops': 5})
+
+    def testProjectCompact(self):
+        paths = ['interface_name', 'bytes_received', 'state', 'queues.flags']
+        self.decoder.set_compact_projection(SCHEMA_PATH, paths)
+        message = make_compact(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        rows = list(self.decoder.project_compact(message))
+
+        full = self.decoder.compact_to_dict(message)['tables'][0]['row']
+        expected = []
+        for row in full:
+            projected = dict((k, row[k]) for k in paths[:3] if k in row)
+            projected['queues'] = [{'flags': q['flags']} for q in row['queues']]
+            expected.append((SCHEMA_PATH, projected))
+        self.assertEqual(rows, expected)
+
+        self.assertRaises(ValueError, self.decoder.set_compact_projection,
+                          SCHEMA_PATH, ['no_such_field'])
+        self.assertRaises(ValueError, self.decoder.set_compact_projection,
+                          SCHEMA_PATH, ['bytes_sent.value'])
+        self.assertRaises(ValueError, self.decoder.set_compact_projection,
+                          'Unknown.Path', ['a'])
+
+    def testProjectKV(self):
+        base_path = 'Cisco-IOS-XR-infra-statsd-oper'
+        paths = ['keys', 'content/bytes-sent', 'content/load']
+        self.decoder.set_kv_projection(base_path, paths)
+        message = make_kv(self.decoder, ['Gi0/0/0/0', 'Gi0/0/0/1'])
+        entries = list(self.decoder.project_kv(message))
+
+        full = self.decoder.kv_to_dict(message)
+        expected = []
+        for entry in full['fields']:
+            values = flatten_kv(entry['fields'])
+            del values['content/bytes-received']
+            expected.append((base_path, entry['timestamp'], values))
+        self.assertEqual(entries, expected)
+        self.assertEqual(entries[1][2]['keys/interface-name'], 'Gi0/0/0/1')
+
+        other = make_kv(self.decoder, ['Gi0/0/0/0'], base_path='other')
+        self.assertEqual(list(self.decoder.project_kv(other)), [])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ProjectionTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
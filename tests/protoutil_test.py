@@ -0,0 +1,115 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.protoutil import compile_converter, compile_protos, proto_to_dict
+from tests.gpb_test import PROTOS, SCHEMA_PATH
+
+data_dir = os.path.join(os.path.dirname(__file__), '..', 'telemetric', 'data')
+
+class ProtoToDictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.row_class = self.decoder.decoders[SCHEMA_PATH]
+
+    def testProtoToDict(self):
+        row = self.row_class(interface_name='Gi0/0/0/0',
+                             bytes_sent=2**40,
+                             availability_flag=True,
+                             state=1,
+                             lane_offsets=[-1, 2])
+        row.queues.add(queue_id=3, flags=b'\x01\xff')
+        row.queues.add()
+        self.assertEqual(proto_to_dict(row),
+                         {'interface_name': 'Gi0/0/0/0',
+                          'bytes_sent': 2**40,
+                          'availability_flag': True,
+                          'state': 1,
+                          'lane_offsets': [-1, 2],
+                          'queues': [{'queue_id': 3, 'flags': '01:ff'}, {}]})
+        self.assertEqual(proto_to_dict(self.row_class()), {})
+
+    def testCompileConverter(self):
+        descriptor = self.row_class.DESCRIPTOR
+        self.assertTrue(compile_converter(descriptor) is
+                        compile_converter(descriptor))
+        convert = compile_converter(descriptor, ('queues', 'state'))
+        row = self.row_class(interface_name='Gi0/0/0/0', state=1)
+        row.queues.add(queue_id=3)
+        self.assertEqual(convert(row), {'interface_name': 'Gi0/0/0/0'})
+
+    def testRecursiveMessage(self):
+        descriptor_pb2 = self.decoder.modules['descriptor_pb2']
+        proto = descriptor_pb2.DescriptorProto(name='outer')
+        proto.nested_type.add(name='inner').nested_type.add(name='innermost')
+        self.assertEqual(proto_to_dict(proto),
+                         {'name': 'outer',
+                          'nested_type': [{'name': 'inner',
+                                           'nested_type': [{'name': 'innermost'}]}]})
+
+class CompileProtosTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.include_dir = os.path.join(self.tmp_dir, 'include')
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        os.mkdir(self.include_dir)
+        for name in ('cisco.proto', 'descriptor.proto'):
+            shutil.copy(os.path.join(data_dir, name), self.include_dir)
+        self.proto = shutil.copy(PROTOS[0], self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def compile(self):
+        return compile_protos([self.proto], self.output_dir, [self.include_dir])
+
+    def mark_compiled(self, compiled):
+        with open(compiled, 'w') as f:
+            f.write('# cached')
+
+    def is_marked(self, compiled):
+        with open(compiled) as f:
+            return f.read() == '# cached'
+
+    def testCache(self):
+        (compiled, schema_path, message_name), = self.compile()
+        self.assertEqual(compiled, os.path.join(self.output_dir,
+                                                'ifstatsbag_generic_pb2.py'))
+        self.assertEqual(schema_path, SCHEMA_PATH)
+        self.assertEqual(message_name, 'ifstatsbag_generic')
+        self.assertFalse(self.is_marked(compiled))
+
+        # Unchanged files are not compiled again.
+        self.mark_compiled(compiled)
+        self.assertEqual(self.compile(), [(compiled, schema_path, message_name)])
+        self.assertTrue(self.is_marked(compiled))
+
+        # Changing an imported file invalidates the cache.
+        with open(os.path.join(self.include_dir, 'descriptor.proto'), 'a') as f:
+            f.write('\n// changed\n')
+        self.compile()
+        self.assertFalse(self.is_marked(compiled))
+
+        # So does a missing compiled file.
+        os.remove(compiled)
+        self.compile()
+        self.assertTrue(os.path.isfile(compiled))
+
+    def testMissingFile(self):
+        self.assertRaises(ValueError, compile_protos,
+                          [os.path.join(self.tmp_dir, 'missing.proto')],
+                          self.output_dir, [])
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ProtoToDictTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(CompileProtosTest))
+    return suite
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
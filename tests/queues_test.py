@@ -0,0 +1,139 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric import TMClient
+from telemetric.client import TCPMsgType
+from telemetric.metrics import CollectorMetrics
+from telemetric.queues import BoundedQueue, schema_path
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+class BoundedQueueTest(unittest.TestCase):
+
+    def drain(self, queue):
+        items = []
+        while len(queue):
+            items.append(queue.get()[0])
+        return items
+
+    def testDropPolicies(self):
+        queue = BoundedQueue('test', 2, 'drop-newest')
+        self.assertEqual([queue.put(i) for i in range(4)],
+                         [True, True, False, False])
+        self.assertEqual(self.drain(queue), [0, 1])
+        self.assertEqual(queue.dropped, 2)
+
+        queue = BoundedQueue('test', 2, 'drop-oldest')
+        for i in range(4):
+            queue.put(i)
+        self.assertEqual(self.drain(queue), [2, 3])
+        self.assertEqual(queue.dropped, 2)
+        self.assertRaises(ValueError, BoundedQueue, 'test', 2, 'random')
+
+    def testBlock(self):
+        queue = BoundedQueue('test', 1)
+        queue.put(0)
+        thread = threading.Thread(target=queue.put, args=(1,))
+        thread.start()
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(queue.get(), (0, None))
+        thread.join()
+        self.assertEqual(queue.get(), (1, None))
+        self.assertEqual(queue.get(timeout=0.01), None)
+
+    def testPutWithoutWaiting(self):
+        # An event loop queues regardless and waits for a callback.
+        queue = BoundedQueue('test', 2)
+        woken = []
+        for i in range(3):
+            self.assertTrue(queue.put(i, wait=False))
+        self.assertTrue(queue.full())
+        queue.when_room(lambda: woken.append(True))
+        queue.get()
+        self.assertEqual(woken, [])
+        queue.get()
+        self.assertEqual(woken, [True])
+        queue.when_room(lambda: woken.append(True))
+        self.assertEqual(woken, [True, True])
+
+    def testSample(self):
+        # Once half full, every other item of each schema is accepted.
+        queue = BoundedQueue('test', 6, 'sample', schema=lambda i: i[0],
+                             sample_every=2)
+        for i in range(4):
+            queue.put(('a', i))
+            queue.put(('b', i))
+        self.assertEqual(self.drain(queue), [('a', 0), ('b', 0), ('a', 1),
+                                             ('b', 1), ('a', 2), ('b', 3)])
+        self.assertEqual(queue.dropped, 2)
+
+    def testMetrics(self):
+        metrics = CollectorMetrics()
+        queue = BoundedQueue('decode', 1, 'drop-newest',
+                             schema=lambda item: item, metrics=metrics)
+        queue.put('a/b', ('10.0.0.1', 5000))
+        queue.put('c/d', ('10.0.0.1', 5000))
+        self.assertTrue(queue.lag() >= 0)
+        text = metrics.registry.render()
+        self.assertTrue('telemetric_queue_depth{queue="decode"} 1' in text)
+        self.assertTrue('telemetric_queue_dropped_total{queue="decode",'
+                        'peer="10.0.0.1",schema_path="c/d"} 1' in text)
+        queue.get()
+        wait = metrics.queue_wait.labels('decode', '10.0.0.1', 'a/b')
+        self.assertTrue(wait.value >= 0)
+
+    def testSchemaPath(self):
+        client = TMClient('127.0.0.1', 0, PROTOS)
+        decoder = client.gpbdecoder
+        self.assertEqual(schema_path(TCPMsgType.GPB_COMPACT,
+                                     make_compact(decoder, ['Gi0'])),
+                         SCHEMA_PATH)
+        self.assertEqual(schema_path(TCPMsgType.GPB_KEY_VALUE,
+                                     make_kv(decoder, ['Gi0'])),
+                         'Cisco-IOS-XR-infra-statsd-oper')
+        self.assertEqual(schema_path(TCPMsgType.JSON,
+                                     b'{"encoding_path": "a/b", "data": 1}'),
+                         'a/b')
+        self.assertEqual(schema_path(TCPMsgType.JSON,
+                                     b'{"Policy": "p", "data": 1}', 'Policy'),
+                         'p')
+        self.assertEqual(schema_path(TCPMsgType.JSON, b'garbage'), '')
+
+    def testSchemaOncePerItem(self):
+        # The schema path is looked up once, however often it is needed.
+        calls = []
+        def schema(item):
+            calls.append(item)
+            return item
+        metrics = CollectorMetrics()
+        queue = BoundedQueue('decode', 4, 'sample', schema=schema,
+                             sample_every=1, metrics=metrics)
+        for item in ('a', 'b', 'c'):
+            queue.put(item)
+        self.assertEqual(len(self.drain(queue)), 3)
+        self.assertEqual(calls, ['c', 'a', 'b'])
+
+    def testClientQueue(self):
+        received = []
+        client = TMClient('127.0.0.1', 0, PROTOS,
+                          callback=lambda t, p, peer: received.append((t, p)),
+                          queue_size=10)
+        client.start_decode_queue()
+        handler = client.create_v2handler(('10.0.0.1', 5000))
+        payload = memoryview(bytearray(b'{"a": 1}'))
+        client.handle_frame(None, handler, ('10.0.0.1', 5000), 2,
+                            TCPMsgType.JSON, 0, payload)
+        # The queued message does not refer to the buffer of the reader.
+        payload[0:1] = b'['
+        client.handle_udp_message(('10.0.0.2', 5000), b'gpb')
+        client.decode_queue.join()
+        self.assertEqual(received, [(TCPMsgType.JSON, b'{"a": 1}'),
+                                    (TCPMsgType.GPB_COMPACT, b'gpb')])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(BoundedQueueTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
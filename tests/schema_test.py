@@ -0,0 +1,106 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric import protoutil, projection
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact
+
+OTHER_PROTO = '''syntax = "proto2";
+package schema_test;
+
+import "cisco.proto";
+
+message queue_counters {
+    option (cisco_msg).schema_path = "RootOper.SchemaTest.QueueCounters";
+    optional uint32 queue_id = 1;
+    optional uint64 packets = 2;
+}
+'''
+OTHER_SCHEMA_PATH = 'RootOper.SchemaTest.QueueCounters'
+
+class SchemaRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.other_proto = os.path.join(self.tmp_dir, 'schema_test.proto')
+        with open(self.other_proto, 'w') as f:
+            f.write(OTHER_PROTO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def create_decoder(self, **kwargs):
+        return GPBDecoder(PROTOS + [self.other_proto],
+                          os.path.join(self.tmp_dir, 'output'),
+                          [],
+                          lazy_schemas=True,
+                          **kwargs)
+
+    def testLazyLoading(self):
+        decoder = self.create_decoder()
+        self.assertEqual(sorted(decoder.schemas.index),
+                         [SCHEMA_PATH, OTHER_SCHEMA_PATH])
+        self.assertEqual(len(decoder.decoders), 0)
+
+        row_class = decoder.get_row_class(OTHER_SCHEMA_PATH)
+        self.assertEqual(row_class.DESCRIPTOR.name, 'queue_counters')
+        self.assertEqual(list(decoder.decoders), [OTHER_SCHEMA_PATH])
+        self.assertEqual(decoder.get_row_class('Unknown.Path'), None)
+
+        message = make_compact(GPBDecoder(PROTOS, '~/.telemetric/proto', []),
+                               ['Gi0/0/0/0'])
+        rows = decoder.compact_to_dict(message)['tables'][0]['row']
+        self.assertEqual(rows[0]['interface_name'], 'Gi0/0/0/0')
+        self.assertEqual(sorted(decoder.decoders),
+                         [SCHEMA_PATH, OTHER_SCHEMA_PATH])
+
+    def testDefer(self):
+        decoder = self.create_decoder()
+        done = threading.Event()
+        calls = []
+        def callback():
+            calls.append(sorted(decoder.decoders))
+            done.set()
+
+        self.assertTrue(decoder.schemas.defer([OTHER_SCHEMA_PATH, 'Unknown'],
+                                              callback))
+        self.assertTrue(done.wait(10))
+        self.assertEqual(calls, [[OTHER_SCHEMA_PATH]])
+
+        # Loaded and unknown schemas do not defer.
+        for i in range(100):
+            if not decoder.schemas.pending:
+                break
+            done.wait(0.01)
+        self.assertFalse(decoder.schemas.defer([OTHER_SCHEMA_PATH, 'Unknown'],
+                                               callback))
+
+    def testEviction(self):
+        decoder = self.create_decoder(max_schemas=1)
+        descriptor = decoder.get_row_class(OTHER_SCHEMA_PATH).DESCRIPTOR
+        protoutil.compile_converter(descriptor)
+        projection.compile_scanner(descriptor)
+        decoder.get_row_class(SCHEMA_PATH)
+        self.assertEqual(list(decoder.decoders), [SCHEMA_PATH])
+
+        # The converters and scanners of evicted schemas are dropped.
+        self.assertFalse((descriptor, ()) in protoutil._converters)
+        self.assertFalse(descriptor in projection._full_scanners)
+
+        # Evicted schemas are loaded again.
+        row_class = decoder.get_row_class(OTHER_SCHEMA_PATH)
+        row = row_class(queue_id=3, packets=7)
+        parsed = row_class()
+        parsed.ParseFromString(row.SerializeToString())
+        self.assertEqual(parsed.packets, 7)
+        self.assertEqual(list(decoder.decoders), [OTHER_SCHEMA_PATH])
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(SchemaRegistryTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,118 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType
+from telemetric.metrics import MetricsRegistry
+from telemetric.shards import ShardedPipeline, device_key
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+class ShardedPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.records = []
+        self.pipeline = None
+
+    def tearDown(self):
+        if self.pipeline is not None:
+            for worker in self.pipeline.workers:
+                worker.terminate()
+
+    def callback(self, key, msg_type, record):
+        self.records.append((key, msg_type, record))
+
+    def testDeviceKey(self):
+        compact = make_compact(self.decoder, ['Gi0'], identifier='r7')
+        self.assertEqual(device_key(TCPMsgType.GPB_COMPACT, compact), 'r7')
+        kv = make_kv(self.decoder, ['Gi0'])
+        self.assertEqual(device_key(TCPMsgType.GPB_KEY_VALUE, kv), 'sub1')
+        self.assertEqual(device_key(TCPMsgType.GPB_KEY_VALUE, kv,
+                                    ('10.0.0.1', 5000)), 'sub1@10.0.0.1')
+        self.assertEqual(device_key(TCPMsgType.JSON, b'{}', 'peer'), 'peer')
+        self.assertEqual(device_key(TCPMsgType.GPB_COMPACT, b'\xff', 'p'), 'p')
+
+    def testOrderPerDevice(self):
+        self.pipeline = ShardedPipeline(self.callback, PROTOS, processes=2)
+        # The routers share a connection, but are decoded by device.
+        for i in range(20):
+            for router in ('r1', 'r2', 'r3'):
+                compact = make_compact(self.decoder, ['Gi{}'.format(i)],
+                                       identifier=router)
+                self.pipeline.submit('conn', TCPMsgType.GPB_COMPACT, compact)
+        self.pipeline.submit('conn', TCPMsgType.GPB_COMPACT, b'garbage')
+        self.pipeline.close()
+
+        self.assertEqual(self.pipeline.errors, 1)
+        for router in ('r1', 'r2', 'r3'):
+            names = [r['tables'][0]['row'][0]['interface_name']
+                     for key, t, r in self.records
+                     if r['identifier'] == router]
+            self.assertEqual(names, ['Gi{}'.format(i) for i in range(20)])
+        stats = self.pipeline.stats()
+        self.assertEqual(sum(s['messages'] for s in stats), 61)
+        self.assertEqual(sum(s['slots'] for s in stats), 256)
+        self.assertEqual(self.pipeline.queued(), 0)
+
+    def testRebalance(self):
+        self.pipeline = ShardedPipeline(self.callback, PROTOS, processes=2,
+                                        rebalance_backlog=4)
+        pipeline = self.pipeline
+        busy = pipeline.slot_of('r1')
+        idle = pipeline.slot_of('r2')
+        pipeline.assignment[busy] = pipeline.assignment[idle] = 0
+        self.assertFalse(pipeline.rebalance())
+
+        # Worker 0 is overloaded by r1, so the idle slot of r2 moves.
+        pipeline.pending[0] = pipeline.slot_pending[busy] = 10
+        pipeline.slot_messages[busy] = 100
+        pipeline.slot_messages[idle] = 50
+        self.assertTrue(pipeline.rebalance())
+        self.assertEqual(pipeline.assignment[busy], 0)
+        self.assertEqual(pipeline.assignment[idle], 1)
+        self.assertEqual(pipeline.moves, 1)
+        self.assertFalse(pipeline.rebalance())
+
+        registry = MetricsRegistry()
+        pipeline.register_metrics(registry)
+        self.assertTrue('telemetric_shard_pending{shard="0"} 10'
+                        in registry.render())
+        pipeline.pending[0] = pipeline.slot_pending[busy] = 0
+        pipeline.close()
+
+    def testAggregate(self):
+        windows = []
+        self.pipeline = ShardedPipeline(windows.append, PROTOS, processes=2,
+                                        aggregate_interval=3600)
+        for i in range(3):
+            for router in ('r1', 'r2'):
+                compact = make_compact(self.decoder, ['Gi0', 'Gi1'],
+                                       identifier=router)
+                self.pipeline.submit('conn', TCPMsgType.GPB_COMPACT, compact)
+        self.pipeline.close()
+        aggregates = [a for window in windows for a in window]
+        path = SCHEMA_PATH + '[interface_name=Gi1]/bytes_sent'
+        series = [(a.node, a.count) for a in aggregates if a.path == path]
+        self.assertEqual(sorted(series), [('r1', 3), ('r2', 3)])
+
+    def testNoRebalanceWhileAggregating(self):
+        # The counter state of a device stays with its worker.
+        self.pipeline = ShardedPipeline(lambda a: None, PROTOS, processes=2,
+                                        aggregate_interval=3600,
+                                        rebalance_backlog=4)
+        pipeline = self.pipeline
+        idle = pipeline.slot_of('r2')
+        pipeline.assignment[idle] = 0
+        pipeline.pending[0] = 10
+        pipeline.slot_messages[idle] = 50
+        self.assertFalse(pipeline.rebalance())
+        self.assertEqual(pipeline.assignment[idle], 0)
+        pipeline.pending[0] = 0
+        pipeline.close()
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ShardedPipelineTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,99 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType
+from telemetric.store import LastValueStore, split_path
+from tests.gpb_test import PROTOS, SCHEMA_PATH, make_compact, make_kv
+
+class LastValueStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.store = LastValueStore(batch_size=2)
+
+    def testUpdate(self):
+        store = self.store
+        self.assertEqual(split_path('a[k=x/y]/b'), ('a[k=x/y]', 'b'))
+        store.update('r1', 'a/b', 1, 100)
+        store.update('r1', 'a/b', 2.5, 200)
+        store.update('r1', 'a/b', 3, 150)
+        self.assertEqual(store.get('r1', 'a/b'), ('r1', 'a/b', 2.5, 200))
+        store.update('r1', 'a/b', 'up', 300)
+        self.assertEqual(store.get('r1', 'a/b').value, 'up')
+        store.update('r1', 'a/b', 2**64 - 1, 400)
+        store.update('r1', 'a/c', True, 400)
+        self.assertEqual(store.get('r1', 'a/b').value, 2**64 - 1)
+        self.assertTrue(store.get('r1', 'a/c').value is True)
+        store.update('r1', 'a/b', 7, 500)
+        self.assertTrue(isinstance(store.get('r1', 'a/b').value, int))
+        self.assertEqual(store.objects, {1: True})
+        self.assertEqual(store.get('r2', 'a/b'), None)
+        self.assertEqual(store.get('r1', 'a/d'), None)
+        self.assertEqual(len(store), 2)
+        self.assertTrue(store.memory_size() > 0)
+
+    def testQuery(self):
+        store = self.store
+        for node in ('edge-1', 'edge-2', 'core-1'):
+            store.add_message(self.decoder, TCPMsgType.GPB_COMPACT,
+                              make_compact(self.decoder, ['Gi0/0/0/0',
+                                                          'Gi0/0/0/1'],
+                                           identifier=node))
+        row = SCHEMA_PATH + '[interface_name=Gi0/0/0/1]'
+        entry = store.get('edge-2', row + '/bytes_sent')
+        self.assertEqual((entry.value, entry.timestamp), (2000, 1500000000100))
+        self.assertEqual(store.get('edge-2', row + '/state').value, 1)
+
+        entries = list(store.query(row))
+        self.assertEqual(len(set(e.node for e in entries)), 3)
+        self.assertTrue(all(e.path.startswith(row) for e in entries))
+        nodes = sorted(e.node for e in store.query(SCHEMA_PATH, 'edge-*')
+                       if e.path == row + '/bytes_sent')
+        self.assertEqual(nodes, ['edge-1', 'edge-2'])
+        self.assertEqual([e.path for e in store.query(row + '/bytes_s',
+                                                      'core-1')],
+                         [row + '/bytes_sent'])
+        self.assertEqual(list(store.query(SCHEMA_PATH, 'edge-3')), [])
+        self.assertEqual(len(list(store.query())), len(store))
+
+        # Rows added later show up in the index.
+        store.update('edge-1', 'Another.Path[k=1]/f', 1, 0)
+        self.assertEqual([e.path for e in store.query('Another')],
+                         ['Another.Path[k=1]/f'])
+
+    def testKV(self):
+        self.store.add_message(self.decoder, TCPMsgType.GPB_KEY_VALUE,
+                               make_kv(self.decoder, ['Gi0', 'Gi1']))
+        paths = sorted(e.path for e in self.store.query('', 'sub1'))
+        self.assertTrue('Cisco-IOS-XR-infra-statsd-oper'
+                        '[interface-name=Gi1]/bytes-sent' in paths)
+        entry = self.store.get('sub1', 'Cisco-IOS-XR-infra-statsd-oper'
+                                       '[interface-name=Gi1]/load')
+        self.assertEqual(entry.value, 0.5)
+
+    def testConcurrentQuery(self):
+        store = self.store
+        done = threading.Event()
+
+        def ingest():
+            for i in range(2000):
+                store.update('r{}'.format(i % 7), 'p[k={}]/v'.format(i % 50),
+                             i, i)
+            done.set()
+
+        thread = threading.Thread(target=ingest)
+        thread.start()
+        while not done.is_set():
+            for entry in store.query('p[', 'r*'):
+                self.assertEqual(entry.value, entry.timestamp)
+        thread.join()
+        self.assertEqual(len(list(store.query('p['))), 350)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(LastValueStoreTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,78 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.client import TCPMsgType, JSONv1Handler, JSONv2Handler
+from telemetric.framing import parse_header
+from telemetric.synthetic import PayloadGenerator
+from tests.gpb_test import PROTOS, SCHEMA_PATH
+
+class PayloadGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = GPBDecoder(PROTOS, '~/.telemetric/proto', [])
+        self.generator = PayloadGenerator(self.decoder, seed=42)
+        self.messages = []
+
+    def collect(self, msg_type, payload, peer):
+        self.messages.append((msg_type, payload))
+
+    def payload(self, frame):
+        version, msg_type, flags, start, end = parse_header(frame, 0,
+                                                            len(frame))
+        self.assertEqual(end, len(frame))
+        return msg_type, flags, frame[start:end]
+
+    def testSeed(self):
+        other = PayloadGenerator(self.decoder, seed=42)
+        self.assertEqual(self.generator.compact(rows=5), other.compact(rows=5))
+        self.assertEqual(self.generator.kv(), other.kv())
+        self.assertEqual(self.generator.json(), other.json())
+        other = PayloadGenerator(self.decoder, seed=43)
+        self.assertNotEqual(self.generator.kv(), other.kv())
+
+    def testCompact(self):
+        message = self.generator.compact(tables=3, rows=7)
+        compact = self.decoder.decode_compact_lazy(message)
+        self.assertEqual(len(compact.tables), 3)
+        for table in compact.tables:
+            self.assertEqual(table.policy_path, SCHEMA_PATH)
+            self.assertEqual(len(list(table)), 7)
+
+    def testKV(self):
+        message = self.generator.kv(entries=2, depth=3, fanout=2, leaves=4)
+        records = list(self.decoder.iter_kv_records(message))
+        # One key and 2 * 2 * 4 leaves per entry.
+        self.assertEqual(len(records), 2 * (1 + 16))
+        path = records[-1][0]
+        self.assertEqual(len(path.split('/')), 3 + 3)
+
+    def testV1Stream(self):
+        handler = JSONv1Handler(None, self.collect)
+        for frame in self.generator.v1_stream(messages=3, entries=2):
+            msg_type, flags, payload = self.payload(frame)
+            handler.handle_payload(payload)
+        self.assertEqual(len(self.messages), 3)
+        for msg_type, payload in self.messages:
+            self.assertEqual(msg_type, TCPMsgType.JSON)
+            self.assertEqual(len(json.loads(payload)['Data']['synthetic']), 2)
+
+    def testV2Stream(self):
+        payloads = [self.generator.kv(entries=1) for i in range(3)]
+        for compress in (False, True):
+            handler = JSONv2Handler(None, self.collect)
+            frames = self.generator.v2_stream(TCPMsgType.GPB_KEY_VALUE,
+                                              payloads, compress)
+            for frame in frames:
+                handler.handle_payload(*self.payload(frame))
+            self.assertEqual(self.messages,
+                             [(TCPMsgType.GPB_KEY_VALUE, p) for p in payloads])
+            del self.messages[:]
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(PayloadGeneratorTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
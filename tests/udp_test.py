@@ -0,0 +1,113 @@
+from __future__ import unicode_literals, print_function
+import sys
+import unittest
+import os
+import time
+import socket
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telemetric.gpb import GPBDecoder
+from telemetric.udp import UDPIngest, receive_batch, read_udp_drops
+from tests.gpb_test import PROTOS, make_compact
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class UDPTest(unittest.TestCase):
+
+    def testReceiveBatch(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(5):
+            sender.sendto(b'x' * (i + 1), receiver.getsockname())
+        time.sleep(0.05)
+
+        views = [memoryview(bytearray(100)) for i in range(3)]
+        sizes = [0] * 3
+        addresses = [None] * 3
+        self.assertEqual(receive_batch(receiver, views, sizes, addresses), 3)
+        self.assertEqual(sizes, [1, 2, 3])
+        self.assertEqual(addresses[0][1], sender.getsockname()[1])
+        self.assertEqual(receive_batch(receiver, views, sizes, addresses), 2)
+        self.assertEqual(sizes[:2], [4, 5])
+        self.assertEqual(views[1][:5].tobytes(), b'xxxxx')
+
+        port = receiver.getsockname()[1]
+        if os.path.exists('/proc/net/udp'):
+            self.assertEqual(read_udp_drops(port), 0)
+        receiver.close()
+        sender.close()
+        self.assertEqual(read_udp_drops(port), None)
+
+    def testUDPIngestCounters(self):
+        ingest = UDPIngest('127.0.0.1', free_port(), PROTOS, processes=3)
+        self.assertEqual(len(ingest.counters), 12)
+        ingest.counters[4] = 2**32 - 1
+        stats = ingest.stats()
+        self.assertEqual((stats['datagrams'], stats['bytes'],
+                          stats['batches'], stats['errors']),
+                         (2**32 - 1, 0, 0, 0))
+
+    def testUDPIngest(self):
+        port = free_port()
+        ingest = UDPIngest('127.0.0.1', port, PROTOS, processes=2,
+                           rcvbuf=1024*1024, json_dump=True)
+        ingest.start()
+        message = make_compact(GPBDecoder(PROTOS, '~/.telemetric/proto', []),
+                               ['Gi0/0/0/0'])
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Wait for the workers to bind.
+            for i in range(500):
+                if read_udp_drops(port) is not None:
+                    break
+                time.sleep(0.01)
+            for i in range(10):
+                sender.sendto(message, ('127.0.0.1', port))
+            sender.sendto(b'garbage', ('127.0.0.1', port))
+            for i in range(500):
+                if ingest.stats()['datagrams'] == 11:
+                    break
+                time.sleep(0.01)
+            stats = ingest.stats()
+        finally:
+            sender.close()
+            ingest.stop()
+        self.assertEqual(stats['datagrams'], 11)
+        self.assertEqual(stats['bytes'], 10 * len(message) + 7)
+        self.assertEqual(stats['errors'], 1)
+
+    def testUDPIngestDeliver(self):
+        port = free_port()
+        received = []
+        ingest = UDPIngest('127.0.0.1', port, PROTOS, processes=2,
+                           rcvbuf=1024*1024,
+                           deliver=lambda a, m: received.append(m))
+        ingest.start()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for i in range(500):
+                if read_udp_drops(port) is not None:
+                    break
+                time.sleep(0.01)
+            for i in range(10):
+                sender.sendto(b'x' * (i + 1), ('127.0.0.1', port))
+            for i in range(500):
+                if len(received) == 10:
+                    break
+                time.sleep(0.01)
+        finally:
+            sender.close()
+            ingest.stop()
+        self.assertEqual(sorted(received, key=len),
+                         [b'x' * (i + 1) for i in range(10)])
+        self.assertEqual(ingest.stats()['datagrams'], 10)
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(UDPTest)
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())